@@ -3,6 +3,11 @@
 #----------------------------------------------------------------------------#
 
 import json
+import os
+from datetime import date, datetime, timedelta
+import click
+from functools import lru_cache
+from urllib.parse import urlencode
 import dateutil.parser
 import babel
 from flask import (
@@ -12,16 +17,40 @@ from flask import (
     Response, 
     flash, 
     redirect, 
-    url_for
+    url_for,
+    jsonify,
+    abort,
+    send_file,
+    stream_with_context
     )
 from flask_moment import Moment
 from flask_sqlalchemy import SQLAlchemy
 from flask_migrate import Migrate
-import logging
-from logging import Formatter, FileHandler
 from flask_wtf import Form
 from forms import *
 from models import * #imported db Models
+from cache import cache, precompile_templates
+from deletion import purger, soft_delete
+from genres import migrate_arrays, rebuild_facets
+from filters import Listing, parse_flag
+from geo import backfill_coordinates, geocoder, venue_locator
+import partitions
+from assets import assets
+from compression import compressor
+from suggest import suggestions
+from metrics import registry as metrics
+from request_log import request_log
+from ratelimit import limiter
+from sessions import server_sessions
+from health import check_database
+import events
+import tickets
+from reports import REPORTS, reports
+from tenants import current_tenant, tenancy, use_tenant
+from images import DIGEST, ImageError, images, sniff
+from snapshots import snapshots
+from sqlalchemy.orm import make_transient_to_detached
+from sqlalchemy.orm.exc import StaleDataError
 
 #----------------------------------------------------------------------------#
 # App Config.
@@ -30,7 +59,23 @@ from models import * #imported db Models
 app = Flask(__name__)
 moment = Moment(app)
 app.config.from_object('config')
-db = SQLAlchemy(app)
+db.init_app(app)
+cache.init_app(app)
+purger.init_app(app)
+venue_locator.init_app(app)
+partitions.maintainer.init_app(app)
+assets.init_app(app)
+compressor.init_app(app)
+suggestions.init_app(app)
+metrics.init_app(app)
+request_log.init_app(app)
+limiter.init_app(app)
+server_sessions.init_app(app)
+tickets.sweeper.init_app(app)
+reports.init_app(app)
+tenancy.init_app(app)
+images.init_app(app)
+snapshots.init_app(app)
 
 migrate = Migrate(app, db)
 
@@ -44,6 +89,8 @@ migrate = Migrate(app, db)
 # Filters.
 #----------------------------------------------------------------------------#
 
+# The same show times are formatted over and over across pages
+@lru_cache(maxsize=4096)
 def format_datetime(value, format='medium'):
     """
     Formats date and time associated with db models
@@ -68,6 +115,9 @@ def format_datetime(value, format='medium'):
 
 app.jinja_env.filters['datetime'] = format_datetime
 
+if app.config.get('TEMPLATE_PRECOMPILE'):
+    precompile_templates(app)
+
 #----------------------------------------------------------------------------#
 # Controllers.
 #----------------------------------------------------------------------------#
@@ -86,35 +136,122 @@ def index():
     return render_template('pages/home.html')
 
 
-#  Venues
+@app.route('/suggest')
+def suggest():
+    """
+    As-you-type suggestions of venue and artist names and cities
+
+    Answered from the in-memory prefix index, without a database query.
+
+    Args:
+        None (query string: q, the text typed so far; optional type, one of
+        venue, artist or city, repeatable; optional limit, default 10)
+
+    Returns:
+        JSON list of suggestions
+    """
+    q = request.args.get('q', '')
+    kinds = tuple(request.args.getlist('type')) or ('venue', 'artist', 'city')
+    limit = min(request.args.get('limit', 10, type=int), app.config['SUGGEST_MAX_RESULTS'])
+    data = suggestions.suggest(q, limit=limit, kinds=kinds)
+
+    return jsonify({'q': q, 'count': len(data), 'data': data})
+
+
+#  Health
 #  ----------------------------------------------------------------
 
-@app.route('/venues')
-def venues():
+@app.route('/healthz')
+def health():
     """
-    Displays list of venues for each city, state
+    Liveness check: the worker is up and answering
 
     Args:
         None
 
     Returns:
-        list of venues for each city, state
+        JSON status, always 200
     """
-    venues = Venue.query.with_entities(
-        Venue.city, Venue.state).group_by(Venue.city, Venue.state).all()
+    return jsonify({'status': 'ok', 'pid': os.getpid(), 'ppid': os.getppid()})
 
-    data = []
 
-    for venue in venues:
-        location_based_venues = Venue.query.filter(Venue.city == venue.city).filter(Venue.state == venue.state).all()
+@app.route('/readyz')
+def ready():
+    """
+    Readiness check: the worker can get a database connection
 
-        data.append({
-            'city': venue.city,
-            'state': venue.state,
-            'venues': location_based_venues
-        })
+    Fails with 503 when the database is unreachable or the connection pool
+    is exhausted, so load balancers stop sending requests to this worker.
+
+    Args:
+        None
+
+    Returns:
+        JSON status with the pool usage, 200 or 503
+    """
+    ok, details = check_database(db.engine)
+    details.update(status='ok' if ok else 'unavailable', pid=os.getpid(), ppid=os.getppid())
+
+    return jsonify(details), 200 if ok else 503
+
+
+#  Events
+#  ----------------------------------------------------------------
 
-    return render_template('pages/venues.html', areas=data)
+@app.route('/events')
+def events_feed():
+    """
+    Server-sent events for every show, venue and artist write
+
+    Redirects to the asynchronous event server when EVENTS_URL is set (see
+    serve.py events), naming the tenant in ?tenant=; otherwise streams
+    from this worker.
+
+    Args:
+        None (query string: optional cursor, the last event id seen, also
+        taken from the Last-Event-ID header; optional entity, one of show,
+        venue or artist, repeatable)
+
+    Returns:
+        text/event-stream response
+    """
+    if app.config['EVENTS_URL']:
+        args = request.args.to_dict(flat=False)
+        args.pop('tenant', None)
+        if current_tenant() is not None:
+            args['tenant'] = current_tenant()
+        query = urlencode(args, doseq=True)
+        return redirect(app.config['EVENTS_URL'] + ('?' + query if query else ''), 307)
+
+    cursor = events.parse_cursor(request.headers.get('Last-Event-ID', request.args.get('cursor')))
+    stream = events.stream(app, cursor, request.args.getlist('entity'))
+
+    return Response(stream_with_context(stream), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+
+#  Venues
+#  ----------------------------------------------------------------
+
+@app.route('/venues')
+def venues():
+    """
+    Displays list of venues for each city, state
+
+    Args:
+        None (query string: optional state, city, genre, seeking_talent,
+        upcoming and page)
+
+    Returns:
+        one page of the filtered venues grouped by city, state, with
+        venue counts per state, city, genre and flag
+    """
+    if snapshots.enabled:
+        listing = snapshots.listing(Venue, request.args)
+    else:
+        listing = Listing(Venue, request.args, app.config['LISTING_PAGE_SIZE'])
+
+    return render_template('pages/venues.html', areas=listing.areas(), listing=listing)
 
 
 @app.route('/venues/search', methods=['POST'])
@@ -131,7 +268,7 @@ def search_venues():
     data = []
 
     search_term = request.form.get('search_term', '')
-    search_results = Venue.query.filter(
+    search_results = Venue.live().filter(
         Venue.name.ilike(f'%{search_term}%')).all()
 
     for search_result in search_results:
@@ -149,6 +286,60 @@ def search_venues():
     return render_template('pages/search_venues.html', results=response, search_term=request.form.get('search_term', ''))
 
 
+@app.route('/venues/nearby')
+def nearby_venues():
+    """
+    Venues near a location, nearest first
+
+    Args:
+        None (query string: lat & lng, or city & state to geocode offline;
+        optional radius_km, up to GEO_MAX_RADIUS_KM, and k, the number of
+        venues, default 20, up to GEO_MAX_RESULTS)
+
+    Returns:
+        JSON list of venues with their distance in km, or 400 for a
+        location or limit out of range
+    """
+    try:
+        if 'lat' in request.args:
+            point = (float(request.args['lat']), float(request.args['lng']))
+        else:
+            point = geocoder.geocode(request.args.get('city'), request.args.get('state'))
+    except (KeyError, ValueError):
+        point = None
+    # The comparisons are False for nan
+    if not point or not (-90 <= point[0] <= 90 and -180 <= point[1] <= 180):
+        return jsonify({'error': 'pass lat and lng, or a known city and state'}), 400
+
+    max_radius = app.config['GEO_MAX_RADIUS_KM']
+    radius_km = request.args.get('radius_km', type=float)
+    if radius_km is not None and not 0 < radius_km <= max_radius:
+        return jsonify({'error': f'radius_km must be more than 0 and at most {max_radius}'}), 400
+    max_results = app.config['GEO_MAX_RESULTS']
+    k = request.args.get('k', 20, type=int)
+    if not 1 <= k <= max_results:
+        return jsonify({'error': f'k must be between 1 and {max_results}'}), 400
+
+    found = venue_locator.nearby(point[0], point[1], radius_km=radius_km, k=k)
+    venues = {venue.id: venue for venue in Venue.live().filter(Venue.id.in_([venue_id for venue_id, _ in found]))}
+
+    data = []
+    for venue_id, distance in found:
+        venue = venues.get(venue_id)
+        if venue:
+            data.append({
+                'id': venue.id,
+                'name': venue.name,
+                'city': venue.city,
+                'state': venue.state,
+                'latitude': venue.latitude,
+                'longitude': venue.longitude,
+                'distance_km': round(distance, 3)
+            })
+
+    return jsonify({'latitude': point[0], 'longitude': point[1], 'count': len(data), 'data': data})
+
+
 @app.route('/venues/<int:venue_id>')
 def show_venue(venue_id):
     """
@@ -160,14 +351,14 @@ def show_venue(venue_id):
     Returns:
         fetch and display specific venue
     """
-    venue = Venue.query.get(venue_id)
+    venue = Venue.live().filter_by(id=venue_id).first()
 
     if not venue:
-        return redirect(url_for('not_found_errors'))
+        return not_found_error(None)
 
-    upcoming_shows = db.session.query(Show).join(Artist).filter(
+    upcoming_shows = db.session.query(Show).join(Artist).filter(Artist.deleted_at.is_(None)).filter(
         Show.venue_id == venue_id).filter(Show.start_time > datetime.now()).all()
-    past_shows = db.session.query(Show).join(Artist).filter(
+    past_shows = db.session.query(Show).join(Artist).filter(Artist.deleted_at.is_(None)).filter(
         Show.venue_id == venue_id).filter(Show.start_time < datetime.now()).all()
     upcoming_shows_list = []
     past_shows_list = []
@@ -267,8 +458,14 @@ def create_venue_submission():
                       facebook_link=facebook_link,
                       seeking_talent=seeking_talent,
                       seeking_description=seeking_description)
+        venue.latitude, venue.longitude = geocoder.geocode(city, state) or (None, None)
         db.session.add(venue)
+        db.session.flush()
+        events.record('venue', venue.id, 'created',
+                      {'name': name, 'city': city, 'state': state, 'genres': genres})
         db.session.commit()
+        venue_locator.update(venue.id, venue.latitude, venue.longitude)
+        suggestions.update('venue', venue.id, venue.name, venue.city, venue.state)
     except:
         error = True
         db.session.rollback()
@@ -282,32 +479,70 @@ def create_venue_submission():
     return render_template('pages/home.html')
 
 
-@app.route('/venues/<venue_id>', methods=['DELETE'])
+@app.route('/venues/<int:venue_id>', methods=['DELETE'])
 def delete_venue(venue_id):
     """
     Delete a specific venue
 
+    Soft-deletes by default, hiding the venue and its shows from every page.
+    With ?hard=1 the venue and its shows are removed for good; venues with
+    many shows are purged in the background.
+
     Args:
         venue_id
 
     Returns:
         refreshed page with a the venue being deleted
     """
+    return delete_entity(Venue, venue_id)
+
+
+def delete_entity(model, entity_id):
+    """
+    Soft or hard delete of a venue or artist, shared by the delete routes
+
+    Args:
+        model: Venue or Artist
+        entity_id
+
+    Returns:
+        home page with a flash message, or 404 page if there's no such row
+        or it is deleted already
+    """
+    kind = model.__name__
+    entity = model.live().filter(model.id == entity_id).first()
+
+    if not entity:
+        return not_found_error(None)
+
+    name = entity.name
     error = False
+    status = None
 
     try:
-        venue = Venue.query.filter_by(id=venue_id).delete()
-        db.session.commit()
+        hard = parse_flag(request.args.get('hard', '').lower()) is True
+        # Committed with the delete
+        events.record(kind.lower(), entity_id, 'deleted', {'hard': hard})
+        if hard:
+            status = purger.delete(model, entity_id)
+        else:
+            soft_delete(model, entity_id)
+            db.session.commit()
+        cache.bump_version(kind.lower(), entity_id)
+        suggestions.remove(kind.lower(), entity_id)
+        if model is Venue:
+            venue_locator.remove(entity_id)
     except:
         error = True
         db.session.rollback()
     finally:
         db.session.close()
     if error:
-        flash('Error: Venue ' +
-              request.form['name'] + ' could not be deleted!')
+        flash('Error: ' + kind + ' ' + name + ' could not be deleted!')
+    elif status == 'queued':
+        flash(kind + ' ' + name + ' was deleted, its shows are being removed.')
     else:
-        flash('Venue ' + request.form['name'] + ' was successfully deleted!')
+        flash(kind + ' ' + name + ' was successfully deleted!')
 
     return render_template('pages/home.html')
 
@@ -320,13 +555,18 @@ def artists():
     Displays list of artists 
 
     Args:
-        None
+        None (query string: optional state, city, genre, seeking_venue,
+        upcoming and page)
 
     Returns:
-        list of venues for each city, state
+        one page of the filtered artists, with artist counts per state,
+        city, genre and flag
     """
-    data = Artist.query.all()
-    return render_template('pages/artists.html', artists=data)
+    if snapshots.enabled:
+        listing = snapshots.listing(Artist, request.args)
+    else:
+        listing = Listing(Artist, request.args, app.config['LISTING_PAGE_SIZE'])
+    return render_template('pages/artists.html', artists=listing.items, listing=listing)
 
 
 @app.route('/artists/search', methods=['POST'])
@@ -343,7 +583,7 @@ def search_artists():
     data = []
 
     search_term = request.form.get('search_term', '')
-    search_results = Artist.query.filter(
+    search_results = Artist.live().filter(
         Artist.name.ilike(f'%{search_term}%')).all()
 
     for search_result in search_results:
@@ -372,14 +612,14 @@ def show_artist(artist_id):
     Returns:
         fetch and display specific artists
     """
-    artist = Artist.query.get(artist_id)
+    artist = Artist.live().filter_by(id=artist_id).first()
 
     if not artist:
-        return redirect(url_for('not_found_errors'))
+        return not_found_error(None)
 
-    upcoming_shows = db.session.query(Show).join(Venue).filter(
+    upcoming_shows = db.session.query(Show).join(Venue).filter(Venue.deleted_at.is_(None)).filter(
         Show.artist_id == artist_id).filter(Show.start_time > datetime.now()).all()
-    past_shows = db.session.query(Show).join(Venue).filter(
+    past_shows = db.session.query(Show).join(Venue).filter(Venue.deleted_at.is_(None)).filter(
         Show.artist_id == artist_id).filter(Show.start_time < datetime.now()).all()
     upcoming_shows_list = []
     past_shows_list = []
@@ -420,9 +660,123 @@ def show_artist(artist_id):
 
     return render_template('pages/show_artist.html', artist=data)
 
+
+@app.route('/artists/<int:artist_id>', methods=['DELETE'])
+def delete_artist(artist_id):
+    """
+    Delete a specific artist
+
+    Same as delete_venue: soft delete by default, ?hard=1 to remove the
+    artist and their shows.
+
+    Args:
+        artist_id
+
+    Returns:
+        refreshed page with a the artist being deleted
+    """
+    return delete_entity(Artist, artist_id)
+
 #  Update
 #  ----------------------------------------------------------------
 
+# Columns the edit forms can change; checkboxes and multi-selects are left
+# out of the request when nothing is ticked, so their absence means false
+# or empty rather than unchanged
+ARTIST_FIELDS = ('name', 'city', 'state', 'phone', 'genres', 'website', 'image_link',
+                 'facebook_link', 'seeking_venue', 'seeking_description')
+VENUE_FIELDS = ('name', 'city', 'state', 'address', 'phone', 'genres', 'website', 'image_link',
+                'facebook_link', 'seeking_talent', 'seeking_description')
+CHECKBOX_FIELDS = ('seeking_venue', 'seeking_talent')
+LIST_FIELDS = ('genres',)
+
+
+def edit_form_state(entity, fields):
+    """
+    Values an edit form starts from, as the form renders them
+
+    Sent back with the submission so only the columns the user changed are
+    written.
+
+    Args:
+        entity: Venue or Artist
+        fields: editable column names
+
+    Returns:
+        dict of column -> value
+    """
+    original = {}
+    for field in fields:
+        value = getattr(entity, field)
+        if field in CHECKBOX_FIELDS:
+            value = bool(value)
+        elif field in LIST_FIELDS:
+            value = sorted(value or [])
+        elif value is None:
+            value = ''
+        original[field] = value
+    return original
+
+
+def submitted_changes(fields):
+    """
+    Columns the submitted edit form changes
+
+    Args:
+        fields: editable column names
+
+    Returns:
+        dict of column -> new value; every submitted column when the form
+        didn't send its original values
+    """
+    values = {}
+    for field in fields:
+        if field in CHECKBOX_FIELDS:
+            values[field] = field in request.form
+        elif field in LIST_FIELDS:
+            values[field] = sorted(request.form.getlist(field))
+        elif field in request.form:
+            values[field] = request.form[field]
+    try:
+        original = json.loads(request.form['original'])
+    except (KeyError, ValueError):
+        return values
+    return {field: value for field, value in values.items() if original.get(field) != value}
+
+
+def versioned_entity(model, entity_id):
+    """
+    The row an edit applies to, without loading it when possible
+
+    With the version the edit form was rendered from, a placeholder with
+    only id and version_id is attached to the session, so the changes are
+    flushed as a single `UPDATE ... WHERE id = ? AND version_id = ?`.
+    Clients that don't send a version get the row loaded, and last write
+    wins as before.
+
+    Either way the row must exist and not be deleted. With a version it is
+    locked until commit, so it can't be deleted before the UPDATE; where
+    the database doesn't lock rows, a delete that got in first bumped the
+    version and the UPDATE fails with StaleDataError.
+
+    Args:
+        model: Venue or Artist
+        entity_id
+
+    Returns:
+        the entity, or None if the row doesn't exist or is deleted
+    """
+    version_id = request.form.get('version_id', type=int)
+    if version_id is None:
+        return model.live().filter_by(id=entity_id).first()
+    if model.live().filter_by(id=entity_id).with_entities(model.id).with_for_update().first() is None:
+        return None
+    entity = model(id=entity_id, version_id=version_id)
+    make_transient_to_detached(entity)
+    db.session.add(entity)
+    return entity
+
+
 @app.route('/artists/<int:artist_id>/edit', methods=['GET'])
 def edit_artist(artist_id):
     """
@@ -434,22 +788,15 @@ def edit_artist(artist_id):
     Returns:
         fetch and display specific artist info to be editted
     """
-    form = ArtistForm()
-    artist = Artist.query.get(artist_id)
+    artist = Artist.live().filter_by(id=artist_id).first()
+
+    if not artist:
+        return not_found_error(None)
 
-    if artist:
-        form.name.data: artist.name
-        form.city.data: artist.city
-        form.state.data: artist.state
-        form.phone.data: artist.phone
-        form.genres.data: artist.genres
-        form.website.data: artist.website
-        form.image_link.data: artist.image_link
-        form.facebook_link.data: artist.facebook_link
-        form.seeking_venue.data: artist.seeking_venue
-        form.seeking_description.data: artist.seeking_description
+    form = ArtistForm(obj=artist)
+    original = json.dumps(edit_form_state(artist, ARTIST_FIELDS))
 
-    return render_template('forms/edit_artist.html', form=form, artist=artist)
+    return render_template('forms/edit_artist.html', form=form, artist=artist, original=original)
 
 
 @app.route('/artists/<int:artist_id>/edit', methods=['POST'])
@@ -457,6 +804,9 @@ def edit_artist_submission(artist_id):
     """
     Submit artist info to be posted after edit
 
+    Only the changed columns are written, and only if nobody else edited
+    the artist since the form was loaded.
+
     Args:
         artist_id
 
@@ -464,35 +814,42 @@ def edit_artist_submission(artist_id):
         edit submission of artist info
     """
     error = False
-    artist = Artist.query.get(artist_id)
+    conflict = False
+    changes = submitted_changes(ARTIST_FIELDS)
 
     try:
-        artist.name = request.form['name']
-        artist.city = request.form['city']
-        artist.state = request.form['state']
-        artist.phone = request.form['phone']
-        # as genres is stored as an array in db
-        artist.genres = request.form.getlist('genres')
-        artist.website = request.form['website']
-        artist.image_link = request.form['image_link']
-        artist.facebook_link = request.form['facebook_link']
-        if 'seeking_venue' in request.form:
-            artist.seeking_venue = True
-        else:
-            artist.seeking_venue = False
-        artist.seeking_description = request.form['seeking_description']
+        artist = versioned_entity(Artist, artist_id)
+        if not artist:
+            return not_found_error(None)
+        for field, value in changes.items():
+            setattr(artist, field, value)
+        events.record('artist', artist_id, 'updated', changes)
 
         db.session.commit()
+        cache.bump_version('artist', artist_id)
+    except StaleDataError:
+        db.session.rollback()
+        # Deleted since the form was loaded, rather than edited
+        if not Artist.live().filter_by(id=artist_id).first():
+            return not_found_error(None)
+        conflict = True
     except:
         error = True
         db.session.rollback()
     finally:
         db.session.close()
 
+    if conflict:
+        flash('Artist ' + request.form['name'] + ' was changed by someone else while you were '
+              'editing it. Your changes were not saved; please review the current details.')
+        return redirect(url_for('edit_artist', artist_id=artist_id))
     if error:
         flash('Error: Artist ' +
               request.form['name'] + ' could not be edited!')
     else:
+        if changes.keys() & {'name', 'city', 'state'}:
+            suggestions.update('artist', artist_id, *db.session.query(
+                Artist.name, Artist.city, Artist.state).filter_by(id=artist_id).one())
         flash('Artist ' + request.form['name'] + ' is edited successfully!')
 
     return redirect(url_for('show_artist', artist_id=artist_id))
@@ -509,23 +866,15 @@ def edit_venue(venue_id):
     Returns:
         fetch and display specific venue info to be editted
     """
-    form = VenueForm()
-    venue = Venue.query.get(venue_id)
+    venue = Venue.live().filter_by(id=venue_id).first()
+
+    if not venue:
+        return not_found_error(None)
 
-    if venue:
-        form.name.data: venue.name
-        form.city.data: venue.city
-        form.state.data: venue.state
-        form.phone.data: venue.phone
-        form.address.data: venue.address
-        form.genres.data: venue.genres
-        form.website.data: venue.website
-        form.image_link.data: venue.image_link
-        form.facebook_link.data: venue.facebook_link
-        form.seeking_talent.data: venue.seeking_talent
-        form.seeking_description.data: venue.seeking_description
+    form = VenueForm(obj=venue)
+    original = json.dumps(edit_form_state(venue, VENUE_FIELDS))
 
-    return render_template('forms/edit_venue.html', form=form, venue=venue)
+    return render_template('forms/edit_venue.html', form=form, venue=venue, original=original)
 
 
 @app.route('/venues/<int:venue_id>/edit', methods=['POST'])
@@ -533,32 +882,61 @@ def edit_venue_submission(venue_id):
     """
     Submit venue info to be posted after edit
 
+    Only the changed columns are written, and only if nobody else edited
+    the venue since the form was loaded.
+
     Args:
         venue_id
 
     Returns:
         edit submission of venue info
     """
-    venue = Venue.query.get(venue_id)
+    error = False
+    conflict = False
+    changes = submitted_changes(VENUE_FIELDS)
+    moved = bool(changes.keys() & {'city', 'state'})
+    if moved:
+        changes['latitude'], changes['longitude'] = geocoder.geocode(
+            request.form.get('city'), request.form.get('state')) or (None, None)
 
     try:
-        venue.name = request.form['name']
-        venue.city = request.form['city']
-        venue.state = request.form['state']
-        venue.address = request.form['address']
-        venue.phone = request.form['phone']
-        # as genres is stored as an array in db
-        venue.genres = request.form.getlist('genres')
-        venue.website = request.form['website']
-        venue.image_link = request.form['image_link']
-        venue.facebook_link = request.form['facebook_link']
-        if 'seeking_talent' in request.form:
-            artist.seeking_talent = True
-        else:
-            artist.seeking_talent = False
-        artist.seeking_description = request.form['seeking_description']
+        venue = versioned_entity(Venue, venue_id)
+        if not venue:
+            return not_found_error(None)
+        for field, value in changes.items():
+            setattr(venue, field, value)
+        events.record('venue', venue_id, 'updated', changes)
+
+        db.session.commit()
+        cache.bump_version('venue', venue_id)
+        if moved:
+            venue_locator.update(venue_id, changes['latitude'], changes['longitude'])
+    except StaleDataError:
+        db.session.rollback()
+        # Deleted since the form was loaded, rather than edited
+        if not Venue.live().filter_by(id=venue_id).first():
+            return not_found_error(None)
+        conflict = True
+    except:
+        error = True
+        db.session.rollback()
     finally:
-        return redirect(url_for('show_venue', venue_id=venue_id))
+        db.session.close()
+
+    if conflict:
+        flash('Venue ' + request.form['name'] + ' was changed by someone else while you were '
+              'editing it. Your changes were not saved; please review the current details.')
+        return redirect(url_for('edit_venue', venue_id=venue_id))
+    if error:
+        flash('Error: Venue ' +
+              request.form['name'] + ' could not be edited!')
+    else:
+        if changes.keys() & {'name', 'city', 'state'}:
+            suggestions.update('venue', venue_id, *db.session.query(
+                Venue.name, Venue.city, Venue.state).filter_by(id=venue_id).one())
+        flash('Venue ' + request.form['name'] + ' is edited successfully!')
+
+    return redirect(url_for('show_venue', venue_id=venue_id))
 
 #  Create Artist
 #  ----------------------------------------------------------------
@@ -617,7 +995,11 @@ def create_artist_submission():
                         seeking_venue=seeking_venue,
                         seeking_description=seeking_description)
         db.session.add(artist)
+        db.session.flush()
+        events.record('artist', artist.id, 'created',
+                      {'name': name, 'city': city, 'state': state, 'genres': genres})
         db.session.commit()
+        suggestions.update('artist', artist.id, artist.name, artist.city, artist.state)
     except:
         error = True
         db.session.rollback()
@@ -646,8 +1028,11 @@ def shows():
     Returns:
         list of artists shows in venues
     """
+    if snapshots.enabled:
+        return render_template('pages/shows.html', shows=snapshots.get('shows').rows)
 
-    shows = db.session.query(Show).join(Artist).join(Venue).all()
+    shows = db.session.query(Show).join(Artist).join(Venue).filter(
+        Artist.deleted_at.is_(None)).filter(Venue.deleted_at.is_(None)).all()
     data = []
 
     for show in shows:
@@ -663,6 +1048,62 @@ def shows():
     return render_template('pages/shows.html', shows=data)
 
 
+@app.route('/shows/calendar')
+def shows_calendar():
+    """
+    Displays shows day by day over a date range
+
+    Only the monthly partitions of the show table overlapping the range are
+    read on PostgreSQL.
+
+    Args:
+        None (query string: from & to as YYYY-MM-DD, to is exclusive and
+        defaults to 30 days after from; format=json for the API)
+
+    Returns:
+        calendar page, or JSON list of shows
+    """
+    try:
+        start = datetime.strptime(request.args['from'], '%Y-%m-%d') if 'from' in request.args \
+            else datetime.combine(date.today(), datetime.min.time())
+        end = datetime.strptime(request.args['to'], '%Y-%m-%d') if 'to' in request.args \
+            else start + timedelta(days=30)
+    except ValueError:
+        return jsonify({'error': 'from and to must be dates formatted YYYY-MM-DD'}), 400
+
+    if end <= start or (end - start).days > app.config['CALENDAR_MAX_DAYS']:
+        return jsonify({'error': 'to must be after from and at most %d days later'
+                        % app.config['CALENDAR_MAX_DAYS']}), 400
+
+    data = []
+    for show in partitions.shows_between(start, end):
+        data.append({
+            'venue_id': show.venue_id,
+            'venue_name': show.venue.name,
+            'artist_id': show.artist_id,
+            'artist_name': show.artist.name,
+            'artist_image_link': show.artist.image_link,
+            'start_time': show.start_time
+        })
+
+    if request.args.get('format') == 'json':
+        for show in data:
+            show['start_time'] = show['start_time'].isoformat()
+        return jsonify({'from': start.date().isoformat(), 'to': end.date().isoformat(),
+                        'count': len(data), 'data': data})
+
+    days = []
+    for show in data:
+        day = show['start_time'].date()
+        if not days or days[-1]['date'] != day:
+            days.append({'date': day, 'shows': []})
+        show['start_time'] = show['start_time'].strftime("%m/%d/%Y, %H:%M")
+        days[-1]['shows'].append(show)
+
+    return render_template('pages/calendar.html', days=days, start=start, end=end,
+                           previous_start=start - (end - start), next_end=end + (end - start))
+
+
 @app.route('/shows/create')
 def create_shows():
     """
@@ -678,6 +1119,41 @@ def create_shows():
     return render_template('forms/new_show.html', form=form)
 
 
+def picked_id(model, field):
+    """
+    Id of the artist or venue chosen in a show form picker
+
+    The typeahead fills in the id of the suggestion picked, which must be
+    a live row; only a name typed without picking one is looked up, and
+    must match exactly one live row.
+
+    Args:
+        model: Artist or Venue
+        field: picker name, 'artist' or 'venue'
+
+    Returns:
+        id
+
+    Raises:
+        ValueError: when the picked row doesn't exist or is deleted, or
+        nothing or more than one row is named so
+    """
+    picked = request.form.get(f'{field}_id', '').strip()
+    if picked:
+        row = model.live().with_entities(model.id).filter(model.id == int(picked)).first() \
+            if picked.isdigit() else None
+        if row is None:
+            raise ValueError(f'no {field} with id {picked}')
+        return row[0]
+    name = request.form.get(field, '').strip()
+    # Name lookups use the partial ix_*_live_name indexes
+    ids = [row_id for row_id, in model.live().with_entities(model.id)
+           .filter(model.name == name).limit(2)]
+    if len(ids) != 1:
+        raise ValueError(f'{len(ids) or "no"} {field}s named {name!r}')
+    return ids[0]
+
+
 @app.route('/shows/create', methods=['POST'])
 def create_show_submission():
     """
@@ -689,19 +1165,34 @@ def create_show_submission():
     Returns:
         submitted show info
     """
-    error = True
+    error = False
+    reason = None
 
     try:
-        artist_id = request.form['artist_id']
-        venue_id = request.form['venue_id']
-        start_time = request.form['start_time']
+        artist_id = picked_id(Artist, 'artist')
+        venue_id = picked_id(Venue, 'venue')
+        start_time = dateutil.parser.parse(request.form['start_time'])
 
         show = Show(artist_id=artist_id,
                     venue_id=venue_id,
-                    start_time=start_times)
+                    start_time=start_time)
 
         db.session.add(show)
-        db.session.close()
+        db.session.flush()
+        # Tickets go on sale with the show, as many as the form or the
+        # venue says
+        capacity = int(request.form['capacity']) if request.form.get('capacity') \
+            else db.session.query(Venue.capacity).filter_by(id=venue_id).scalar()
+        if capacity:
+            tickets.open_sales(show.id, capacity, app.config['TICKET_SHARDS'])
+        events.record('show', show.id, 'created',
+                      {'artist_id': artist_id, 'venue_id': venue_id,
+                       'start_time': start_time.isoformat(), 'capacity': capacity})
+        db.session.commit()
+    except ValueError as e:
+        error = True
+        reason = str(e)
+        db.session.rollback()
     except:
         error = True
         db.session.rollback()
@@ -709,13 +1200,285 @@ def create_show_submission():
         db.session.close()
 
     if error:
-        flash('Error: Show could not be listed!')
+        flash('Error: Show could not be listed' + (': ' + reason if reason else '!'))
     else:
         flash('Show was successfully listed!')
 
     return render_template('pages/home.html')
 
 
+#  Reports
+#  ----------------------------------------------------------------
+
+@app.route('/reports')
+def reports_index():
+    """
+    Lists the reports
+
+    Args:
+        None
+
+    Returns:
+        reports page
+    """
+    return render_template('pages/reports.html', reports=REPORTS.values())
+
+
+@app.route('/reports/<name>')
+def show_report(name):
+    """
+    Displays a report over the shows starting in a date range
+
+    Args:
+        name: report name (query string: from & to as YYYY-MM-DD, to is
+        exclusive; defaults to REPORT_DEFAULT_DAYS before and after today;
+        rows caps the rows shown; format=json for the API)
+
+    Returns:
+        report page, or JSON with its columns and rows
+    """
+    if name not in REPORTS:
+        abort(404)
+    today = datetime.combine(date.today(), datetime.min.time())
+    days = timedelta(days=app.config['REPORT_DEFAULT_DAYS'])
+    try:
+        start = datetime.strptime(request.args['from'], '%Y-%m-%d') if 'from' in request.args \
+            else today - days
+        end = datetime.strptime(request.args['to'], '%Y-%m-%d') if 'to' in request.args \
+            else today + days
+    except ValueError:
+        return jsonify({'error': 'from and to must be dates formatted YYYY-MM-DD'}), 400
+    if end <= start or (end - start).days > app.config['REPORT_MAX_DAYS']:
+        return jsonify({'error': 'to must be after from and at most %d days later'
+                        % app.config['REPORT_MAX_DAYS']}), 400
+    rows = min(max(request.args.get('rows', app.config['REPORT_ROWS'], type=int), 1), 1000)
+
+    entry, served = reports.result(name, start, end)
+    table = REPORTS[name].render(entry['result'], rows)
+    if request.args.get('format') == 'json':
+        return jsonify({'report': name, 'title': REPORTS[name].title,
+                        'from': start.date().isoformat(), 'to': end.date().isoformat(),
+                        'computed_at': entry['computed_at'], 'served': served, **table})
+    return render_template('pages/report.html', report=REPORTS[name], table=table, entry=entry,
+                           start=start, end=end)
+
+
+#  Tickets
+#  ----------------------------------------------------------------
+
+@app.route('/shows/<int:show_id>/tickets')
+def show_tickets(show_id):
+    """
+    Ticket counts of a show
+
+    Args:
+        show_id
+
+    Returns:
+        JSON with capacity, remaining, held and sold; 404 when the show
+        isn't on sale
+    """
+    counts = tickets.availability(show_id)
+    if counts is None:
+        return jsonify({'error': 'show is not on sale'}), 404
+    return jsonify(counts)
+
+
+@app.route('/shows/<int:show_id>/holds', methods=['POST'])
+def hold_tickets(show_id):
+    """
+    Holds tickets for TICKET_HOLD_SECONDS, until they are purchased
+
+    Args:
+        show_id (form or JSON body: quantity, default 1)
+
+    Returns:
+        201 with the hold id and expiry, 409 when sold out, 404 when the
+        show isn't on sale, has started or its venue or artist is deleted
+    """
+    body = request.get_json(silent=True)
+    if body is None:
+        body = request.form
+    elif not isinstance(body, dict):
+        return jsonify({'error': 'body must be a JSON object'}), 400
+    try:
+        quantity = int(body.get('quantity', 1))
+    except (TypeError, ValueError):
+        quantity = 0
+    if not 1 <= quantity <= app.config['TICKET_MAX_PER_HOLD']:
+        return jsonify({'error': 'quantity must be between 1 and %d'
+                        % app.config['TICKET_MAX_PER_HOLD']}), 400
+    if not tickets.shard_count(show_id) or not tickets.bookable(show_id):
+        return jsonify({'error': 'show is not on sale'}), 404
+
+    tickets.sweeper.start()
+    held = tickets.hold(show_id, quantity, app.config['TICKET_HOLD_SECONDS'])
+    if held is None:
+        return jsonify({'error': 'sold out'}), 409
+    hold_id, expires_at = held
+    return jsonify({'hold': hold_id, 'show_id': show_id, 'quantity': quantity,
+                    'expires_at': expires_at.isoformat()}), 201
+
+
+@app.route('/holds/<hold_id>/purchase', methods=['POST'])
+def purchase_tickets(hold_id):
+    """
+    Confirms the purchase of held tickets
+
+    Args:
+        hold_id
+
+    Returns:
+        200 once purchased (also when it already was), 410 when the hold
+        expired, was released or doesn't exist
+    """
+    if tickets.purchase(hold_id) is None:
+        return jsonify({'error': 'hold expired'}), 410
+    return jsonify({'hold': hold_id, 'status': 'purchased'})
+
+
+@app.route('/holds/<hold_id>', methods=['DELETE'])
+def release_tickets(hold_id):
+    """
+    Gives held tickets back before the hold expires
+
+    Args:
+        hold_id
+
+    Returns:
+        number of tickets given back
+    """
+    return jsonify({'hold': hold_id, 'released': tickets.release(hold_id)})
+
+
+#  Images
+#  ----------------------------------------------------------------
+
+def send_image(path, digest, max_age, immutable=False):
+    """
+    Serves a file of the image store
+
+    Its name is the digest of its content (and size), which is all an ETag
+    needs, so revalidations are answered without reading the file.
+
+    Args:
+        path: file in the image store
+        digest: ETag
+        max_age: Cache-Control max-age, in seconds
+        immutable: whether the URL always serves these bytes
+
+    Returns:
+        response
+    """
+    with open(path, 'rb') as f:
+        mimetype = sniff(f.read(12))
+    response = send_file(path, mimetype=mimetype, etag=digest, max_age=max_age, conditional=True)
+    response.cache_control.public = True
+    response.cache_control.immutable = immutable
+    return response
+
+
+@app.route('/img/<size>/<signature>')
+def image_proxy(size, signature):
+    """
+    Thumbnail of a remote venue or artist image
+
+    Pages link here through the thumb filter, which signs the URL. The
+    image is fetched into the store on the first request; until the
+    thumbnail is ready, or when the image can't be fetched, the request is
+    redirected to the original.
+
+    Args:
+        size: a key of IMAGE_SIZES
+        signature: of the image URL (query string: src, the image URL)
+
+    Returns:
+        the thumbnail, a 307 redirect to the original, or 404 for an
+        unsigned URL or unknown size
+    """
+    src = request.args.get('src', '')
+    if size not in images.sizes or not src or not images.verify(src, signature):
+        abort(404)
+    found = images.thumbnail(src, size)
+    if found is None:
+        return redirect(src, 307)
+    path, digest = found
+    return send_image(path, f'{digest}-{size}', images.max_age)
+
+
+@app.route('/images/<digest>')
+def stored_image(digest):
+    """
+    An uploaded image, as uploaded
+
+    Args:
+        digest: SHA-256 of the image
+
+    Returns:
+        the image, cached for a year
+    """
+    if not DIGEST.match(digest) or not os.path.exists(images.original_path(digest)):
+        abort(404)
+    return send_image(images.original_path(digest), digest, 365 * 86400, immutable=True)
+
+
+@app.route('/images/<digest>/<size>')
+def image_thumbnail(digest, size):
+    """
+    Thumbnail of an uploaded image
+
+    Args:
+        digest: SHA-256 of the image
+        size: a key of IMAGE_SIZES
+
+    Returns:
+        the thumbnail cached for a year, or a 307 redirect to the original
+        while it is being made
+    """
+    if size not in images.sizes or not DIGEST.match(digest) \
+            or not os.path.exists(images.original_path(digest)):
+        abort(404)
+    path = images.stored_thumbnail(digest, size)
+    if path is None:
+        return redirect(url_for('stored_image', digest=digest), 307)
+    return send_image(path, f'{digest}-{size}', 365 * 86400, immutable=True)
+
+
+@app.route('/images', methods=['POST'])
+def upload_image():
+    """
+    Stores an image for a venue's or artist's image_link
+
+    Thumbnails are made in the background.
+
+    Args:
+        None (multipart form: image, the file; or the image as the body)
+
+    Returns:
+        201 with the image's URL and its thumbnails' URLs; 413 when it is
+        larger than IMAGE_MAX_BYTES, 400 when it isn't an image
+    """
+    if (request.content_length or 0) > images.max_bytes + 64 * 1024:
+        return jsonify({'error': f'larger than {images.max_bytes} bytes'}), 413
+    upload = request.files.get('image')
+    stream = upload.stream if upload is not None else request.stream
+    data = stream.read(images.max_bytes + 1)
+    if len(data) > images.max_bytes:
+        return jsonify({'error': f'larger than {images.max_bytes} bytes'}), 413
+    try:
+        digest = images.store(data)
+    except ImageError as e:
+        return jsonify({'error': str(e)}), 400
+    images.thumbnails_of(digest)
+
+    return jsonify({
+        'digest': digest,
+        'url': url_for('stored_image', digest=digest, _external=True),
+        'thumbnails': {size: url_for('image_thumbnail', digest=digest, size=size, _external=True)
+                       for size in images.sizes},
+    }), 201
+
+
 @app.errorhandler(404)
 def not_found_error(error):
     """
@@ -744,16 +1507,214 @@ def server_error(error):
     return render_template('errors/500.html'), 500
 
 
-if not app.debug:
-    file_handler = FileHandler('error.log')
-    file_handler.setFormatter(
-        Formatter(
-            '%(asctime)s %(levelname)s: %(message)s [in %(pathname)s:%(lineno)d]')
-    )
-    app.logger.setLevel(logging.INFO)
-    file_handler.setLevel(logging.INFO)
-    app.logger.addHandler(file_handler)
-    app.logger.info('errors')
+#----------------------------------------------------------------------------#
+# Commands.
+#----------------------------------------------------------------------------#
+
+@app.cli.group('partitions')
+def partitions_command():
+    """
+    Manages the monthly partitions of the show table (PostgreSQL only)
+    """
+
+
+@partitions_command.command('ensure')
+@click.option('--since', help='first month to create, YYYY-MM (default: this month)')
+@click.option('--months-ahead', type=int, help='months after this one to create')
+def ensure_partitions_command(since, months_ahead):
+    """
+    Creates missing monthly partitions, moving rows out of the default one
+    """
+    since = datetime.strptime(since, '%Y-%m').date() if since else None
+    created = partitions.ensure_partitions(
+        months_ahead or app.config['SHOW_PARTITION_MONTHS_AHEAD'], since=since)
+    print('created ' + (', '.join(created) or 'nothing'))
+
+
+@partitions_command.command('archive')
+@click.option('--before', required=True, help='archive months ending by this date, YYYY-MM-DD')
+@click.option('--schema', default='archive', show_default=True)
+def archive_partitions_command(before, schema):
+    """
+    Detaches old monthly partitions and moves them to an archive schema
+    """
+    archived = partitions.archive_partitions(datetime.strptime(before, '%Y-%m-%d').date(), schema)
+    print('archived ' + (', '.join(archived) or 'nothing'))
+
+
+@app.cli.group('genres')
+def genres_command():
+    """
+    Manages the genre tables and their facet counts
+    """
+
+
+@genres_command.command('migrate')
+@click.option('--drop-columns', is_flag=True, help='drop the old genres array columns afterwards')
+def migrate_genres_command(drop_columns):
+    """
+    Moves genres out of the venue and artist array columns
+    """
+    migrated = migrate_arrays(drop_columns)
+    print(', '.join(f'{count} {kind} rows' for kind, count in migrated.items()) or 'nothing to migrate')
+
+
+@genres_command.command('rebuild-facets')
+def rebuild_facets_command():
+    """
+    Recounts the genre facets from scratch
+    """
+    rebuild_facets()
+    print('genre facets rebuilt')
+
+
+@app.cli.group('events')
+def events_command():
+    """
+    Manages the change log behind /events
+    """
+
+
+@events_command.command('prune')
+@click.option('--days', type=int, default=30, show_default=True, help='entries to keep, in days')
+def prune_events_command(days):
+    """
+    Deletes change log entries older than --days
+    """
+    print(f'{events.prune(datetime.now() - timedelta(days=days))} entries deleted')
+
+
+@app.cli.group('tickets')
+def tickets_command():
+    """
+    Manages ticket inventory
+    """
+
+
+@tickets_command.command('open')
+@click.argument('show_id', type=int)
+@click.option('--capacity', type=int, help="tickets for sale, defaults to the venue's capacity")
+def open_sales_command(show_id, capacity):
+    """
+    Puts the tickets of a show on sale
+    """
+    show = db.session.get(Show, show_id)
+    if show is None:
+        raise click.ClickException(f'no show {show_id}')
+    capacity = capacity or show.venue.capacity
+    if not capacity:
+        raise click.ClickException('pass --capacity, the venue has no capacity set')
+    shards = tickets.open_sales(show_id, capacity, app.config['TICKET_SHARDS'])
+    db.session.commit()
+    print(f'{capacity} tickets on sale in {shards} shards' if shards else 'show is already on sale')
+
+
+@tickets_command.command('venue-capacity')
+@click.argument('venue_id', type=int)
+@click.argument('capacity', type=int)
+def venue_capacity_command(venue_id, capacity):
+    """
+    Sets the tickets new shows at a venue go on sale with
+    """
+    venue = db.session.get(Venue, venue_id)
+    if venue is None:
+        raise click.ClickException(f'no venue {venue_id}')
+    venue.capacity = capacity
+    db.session.commit()
+    print(f'{venue.name}: capacity {capacity}')
+
+
+@tickets_command.command('sweep')
+def sweep_holds_command():
+    """
+    Gives the tickets of expired holds back to sale
+    """
+    print(f'{tickets.sweep(app.config["TICKET_SWEEP_BATCH_SIZE"])} tickets returned')
+
+
+@app.cli.group('sessions')
+def sessions_command():
+    """
+    Manages server-side sessions
+    """
+
+
+@sessions_command.command('cleanup')
+def cleanup_sessions_command():
+    """
+    Deletes expired sessions from the sql:// session store
+    """
+    store = server_sessions.store
+    if not hasattr(store, 'cleanup'):
+        print(f'{app.config["SESSION_STORAGE_URL"]} sessions expire on their own')
+        return
+    print(f'{store.cleanup()} expired sessions deleted')
+
+
+@app.cli.group('tenants')
+def tenants_command():
+    """
+    Manages the tenants of a multi-tenant deployment
+    """
+
+
+@tenants_command.command('create')
+@click.argument('names', nargs=-1, required=True)
+def create_tenants_command(names):
+    """
+    Provisions tenants: a schema (PostgreSQL) or database file (SQLite) each
+    """
+    for name in names:
+        tenancy.create(name)
+        with use_tenant(name), app.app_context():
+            partitions.ensure_partitions(app.config['SHOW_PARTITION_MONTHS_AHEAD'])
+        print(f'created tenant {name}')
+
+
+@tenants_command.command('list')
+def list_tenants_command():
+    """
+    Lists the provisioned tenants
+    """
+    for name in sorted(tenancy.discover()):
+        print(name)
+
+
+@app.cli.group('images')
+def images_command():
+    """
+    Manages the image store
+    """
+
+
+@images_command.command('import')
+def import_images_command():
+    """
+    Fetches every venue and artist image and makes its thumbnails
+    """
+    links = {link for model in (Venue, Artist)
+             for (link,) in model.live().with_entities(model.image_link) if link}
+    db.session.remove()
+    futures = [images.import_url(link) for link in sorted(links)
+               if images.source_digest(link) is None]
+    imported = failed = 0
+    for future in futures:
+        try:
+            if future is not None:
+                future.result()
+                imported += 1
+        except ImageError as e:
+            failed += 1
+            print(e)
+    print(f'{len(links)} images, {imported} imported, {failed} failed')
+
+
+@app.cli.command('geocode-venues')
+def geocode_venues_command():
+    """
+    Fills in venue coordinates from the bundled city/state centroid table
+    """
+    print(f'{backfill_coordinates()} venues geocoded')
 
 #----------------------------------------------------------------------------#
 # Launch.
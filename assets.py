@@ -0,0 +1,324 @@
+#----------------------------------------------------------------------------#
+# Imports
+#----------------------------------------------------------------------------#
+
+import gzip
+import hashlib
+import json
+import mimetypes
+import os
+import re
+
+import click
+from flask import current_app, request, send_from_directory
+from flask.cli import AppGroup
+
+try:
+    import brotli
+except ImportError:  # brotli is optional, gzip is always built
+    brotli = None
+
+try:
+    import rcssmin
+except ImportError:  # see requirements.txt; builds fall back to minify_css's regexes
+    rcssmin = None
+
+try:
+    import rjsmin
+except ImportError:  # see requirements.txt; builds then leave JavaScript as it is
+    rjsmin = None
+
+#----------------------------------------------------------------------------#
+# Bundles.
+#----------------------------------------------------------------------------#
+
+# Bundle name -> source files under static/, concatenated in this order
+BUNDLES = {
+    'main.css': [
+        'css/bootstrap.min.css',
+        'css/layout.main.css',
+        'css/main.css',
+        'css/main.responsive.css',
+        'css/main.quickfix.css',
+    ],
+    # loaded blocking in <head>
+    'head.js': [
+        'js/libs/modernizr-2.8.2.min.js',
+        'js/libs/moment.min.js',
+    ],
+    # loaded deferred at the end of <body>
+    'main.js': [
+        'js/libs/jquery-1.11.1.min.js',
+        'js/libs/bootstrap-3.1.1.min.js',
+        'js/plugins.js',
+        'js/script.js',
+    ],
+}
+
+# Bundles are written next to static/css and static/js, so relative url()
+# references such as ../fonts/ keep resolving without rewriting
+DIST_DIR = 'dist'
+MANIFEST = 'manifest.json'
+IMMUTABLE = 'public, max-age=31536000, immutable'
+
+
+def minify_css(source):
+    """
+    Minifies CSS with rcssmin when installed, else a conservative fallback
+
+    Args:
+        source: CSS text
+
+    Returns:
+        minified CSS text
+    """
+    if rcssmin is not None:
+        return rcssmin.cssmin(source)
+    source = re.sub(r'/\*.*?\*/', '', source, flags=re.S)
+    source = re.sub(r'\s+', ' ', source)
+    # not around ':' where whitespace can be a descendant combinator
+    source = re.sub(r'\s*([{};,>])\s*', r'\1', source)
+    return source.replace(';}', '}').strip()
+
+
+def minify_js(source):
+    """
+    Minifies JavaScript with rjsmin when installed
+
+    Without it the source is only trimmed. Either way most of the bundle
+    bytes are libraries shipped minified already, so the transfer size
+    comes down mostly through the .gz and .br copies.
+
+    Args:
+        source: JavaScript text
+
+    Returns:
+        minified JavaScript text
+    """
+    if rjsmin is not None:
+        return rjsmin.jsmin(source)
+    return source.strip()
+
+
+def _read(static_folder, path):
+    with open(os.path.join(static_folder, path), encoding='utf-8') as f:
+        return f.read()
+
+
+def build_bundle(static_folder, name, sources):
+    """
+    Concatenates and minifies one bundle
+
+    Args:
+        static_folder: app static folder
+        name: bundle name, its extension picks the minifier
+        sources: source paths relative to static_folder
+
+    Returns:
+        bundle contents as bytes
+    """
+    parts = [_read(static_folder, path) for path in sources]
+    if name.endswith('.css'):
+        return '\n'.join(minify_css(part) for part in parts).encode('utf-8')
+    # the semicolon guards against files that don't end their last statement
+    return '\n;'.join(minify_js(part) for part in parts).encode('utf-8')
+
+
+def _write(path, data):
+    with open(path, 'wb') as f:
+        f.write(data)
+
+
+def build(static_folder, bundles=BUNDLES):
+    """
+    Builds every bundle with a content-hashed name, plus .gz and .br copies
+
+    Args:
+        static_folder: app static folder
+        bundles: bundle name -> list of source paths
+
+    Returns:
+        the manifest, bundle name -> path relative to static_folder
+    """
+    out_dir = os.path.join(static_folder, DIST_DIR)
+    os.makedirs(out_dir, exist_ok=True)
+    manifest = {}
+    for name, sources in bundles.items():
+        data = build_bundle(static_folder, name, sources)
+        stem, ext = os.path.splitext(name)
+        filename = f'{stem}.{hashlib.sha256(data).hexdigest()[:12]}{ext}'
+        path = os.path.join(out_dir, filename)
+        _write(path, data)
+        _write(path + '.gz', gzip.compress(data, compresslevel=9, mtime=0))
+        if brotli is not None:
+            _write(path + '.br', brotli.compress(data, quality=11))
+        manifest[name] = f'{DIST_DIR}/{filename}'
+    _write(os.path.join(out_dir, MANIFEST), json.dumps(manifest, indent=2, sort_keys=True).encode())
+    return manifest
+
+#----------------------------------------------------------------------------#
+# Serving.
+#----------------------------------------------------------------------------#
+
+class Assets:
+    """
+    Resolves bundle names to fingerprinted URLs and serves the bundles
+
+    Without a built manifest (e.g. in development) templates fall back to
+    the individual source files.
+
+    Args:
+        None
+
+    Returns:
+        None
+    """
+
+    def __init__(self):
+        self.app = None
+        self.manifest = {}
+        self.enabled = True
+
+    def init_app(self, app):
+        self.app = app
+        self.enabled = app.config.get('ASSETS_ENABLED', True)
+        self.load_manifest()
+        app.extensions['assets'] = self
+        app.jinja_env.globals.update(asset_url=self.url, asset_urls=self.urls,
+                                     asset_version=self.version)
+        app.add_url_rule(f'{app.static_url_path}/{DIST_DIR}/<path:filename>',
+                         endpoint='dist_asset', view_func=self.send)
+        app.cli.add_command(assets_command)
+
+    def load_manifest(self):
+        path = os.path.join(self.app.static_folder, DIST_DIR, MANIFEST)
+        try:
+            with open(path) as f:
+                self.manifest = json.load(f)
+        except (OSError, ValueError):
+            self.manifest = {}
+
+    def version(self):
+        """
+        Identifies the current build, for keying cached markup that embeds it
+        """
+        if not (self.enabled and self.manifest):
+            return 'src'
+        return hashlib.sha1(json.dumps(self.manifest, sort_keys=True).encode()).hexdigest()[:12]
+
+    def urls(self, name):
+        """
+        URLs to include for a bundle
+
+        Args:
+            name: bundle name, e.g. 'main.css'
+
+        Returns:
+            [fingerprinted bundle URL], or the source file URLs when unbuilt
+        """
+        static = self.app.static_url_path
+        if self.enabled and name in self.manifest:
+            return [f'{static}/{self.manifest[name]}']
+        return [f'{static}/{path}' for path in BUNDLES[name]]
+
+    def url(self, name):
+        return self.urls(name)[0]
+
+    def send(self, filename):
+        """
+        Serves a built file, precompressed when the client accepts it
+
+        Args:
+            filename: path under static/dist
+
+        Returns:
+            response with far-future immutable caching
+        """
+        directory = os.path.join(self.app.static_folder, DIST_DIR)
+        accepted = request.accept_encodings
+        encoding = None
+        for candidate, suffix in (('br', '.br'), ('gzip', '.gz')):
+            if accepted[candidate] and os.path.isfile(os.path.join(directory, filename + suffix)):
+                encoding = candidate
+                break
+        mimetype = mimetypes.guess_type(filename)[0]
+        if encoding:
+            response = send_from_directory(directory, filename + ('.br' if encoding == 'br' else '.gz'),
+                                           mimetype=mimetype, max_age=31536000)
+            response.headers['Content-Encoding'] = encoding
+        else:
+            response = send_from_directory(directory, filename, mimetype=mimetype, max_age=31536000)
+        response.headers['Cache-Control'] = IMMUTABLE
+        response.vary.add('Accept-Encoding')
+        return response
+
+
+assets = Assets()
+
+#----------------------------------------------------------------------------#
+# Commands.
+#----------------------------------------------------------------------------#
+
+assets_command = AppGroup('assets', help='Builds and reports on static asset bundles')
+
+
+@assets_command.command('build')
+def build_command():
+    """
+    Bundles, minifies, fingerprints and precompresses CSS and JS
+    """
+    manifest = build(current_app.static_folder)
+    assets.load_manifest()
+    for name, path in sorted(manifest.items()):
+        click.echo(f'{name} -> {path}')
+    if brotli is None:
+        click.echo('brotli is not installed, only .gz files were written')
+    if rcssmin is None or rjsmin is None:
+        click.echo('rcssmin or rjsmin is not installed, bundles were not fully minified')
+
+
+def page_weight(app, path='/'):
+    """
+    CSS and JS a page makes the browser fetch
+
+    Args:
+        app: Flask app
+        path: page to render
+
+    Returns:
+        dict with request count, raw and gzip bytes of local assets, and
+        the external URLs that couldn't be measured
+    """
+    html = app.test_client().get(path).get_data(as_text=True)
+    # legacy-IE conditional comments aren't fetched by current browsers
+    html = re.sub(r'<!--\[if.*?<!\[endif\]-->', '', html, flags=re.S)
+    urls = re.findall(r'<link[^>]+rel="stylesheet"[^>]+href="([^"]+)"', html)
+    urls += re.findall(r'<script[^>]+src="([^"]+)"', html)
+    weight = {'requests': len(urls), 'bytes': 0, 'gzip_bytes': 0, 'external': []}
+    static = app.static_url_path + '/'
+    for url in urls:
+        if not url.startswith(static):
+            weight['external'].append(url)
+            continue
+        with open(os.path.join(app.static_folder, url[len(static):]), 'rb') as f:
+            data = f.read()
+        weight['bytes'] += len(data)
+        weight['gzip_bytes'] += len(gzip.compress(data, compresslevel=9))
+    return weight
+
+
+@assets_command.command('report')
+@click.option('--path', default='/', show_default=True, help='page to weigh')
+def report_command(path):
+    """
+    Page weight and request count with and without the built bundles
+    """
+    app = current_app._get_current_object()
+    results = {}
+    for label, enabled in (('before', False), ('after', True)):
+        assets.enabled = enabled
+        app.extensions['cache'].clear()
+        results[label] = page_weight(app, path)
+    assets.enabled = app.config.get('ASSETS_ENABLED', True)
+    app.extensions['cache'].clear()
+    click.echo(json.dumps(results, indent=2))
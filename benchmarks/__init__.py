@@ -0,0 +1,12 @@
+"""
+Benchmark and load-test suite for Fyyur
+
+Seeds a synthetic dataset into SQLite or PostgreSQL, drives every route of
+app.py through the Flask test client and a concurrent HTTP load generator,
+and writes the results as JSON so runs can be compared with each other.
+
+Usage:
+    python -m benchmarks seed --database-url sqlite:///bench.db --shows 1000000
+    python -m benchmarks run --database-url sqlite:///bench.db --out results.json
+    python -m benchmarks compare baseline.json results.json
+"""
@@ -0,0 +1,125 @@
+"""
+Command line entry point: python -m benchmarks {seed,run,compare}
+"""
+
+import argparse
+import os
+import sys
+
+
+def _app(database_url):
+    """
+    Imports the app against the requested database
+
+    config.py reads DATABASE_URL, RATELIMIT_ENABLED and SUGGEST_PRELOAD at
+    import time, so they have to be set first.
+    """
+    if database_url:
+        os.environ['DATABASE_URL'] = database_url
+    # the load generator is a single client, so it measures the routes
+    # themselves; ratelimit_bench exercises the limiter
+    os.environ.setdefault('RATELIMIT_ENABLED', '0')
+    # seeding recreates the tables under the startup index build
+    os.environ.setdefault('SUGGEST_PRELOAD', '0')
+    from app import app
+    return app
+
+
+def cmd_seed(args):
+    from benchmarks import datagen
+    app = _app(args.database_url)
+    with app.app_context():
+        counts = datagen.seed(cities=args.cities, venues=args.venues, artists=args.artists,
+                              shows=args.shows, seed=args.seed)
+    print(', '.join(f'{count} {table} rows' for table, count in counts.items()))
+
+
+def cmd_run(args):
+    from benchmarks import harness, report
+    from models import db
+    app = _app(args.database_url)
+    with app.app_context():
+        dataset = harness.Dataset.from_database()
+        dialect = db.engine.dialect.name
+    scenarios = harness.select(args.routes, include_writes=not args.read_only)
+    uncovered = harness.uncovered_endpoints(app)
+    if uncovered:
+        print('warning: no scenario for ' + ', '.join(uncovered), file=sys.stderr)
+
+    results = {'meta': report.metadata(database=dialect, venues=dataset.venues,
+                                       artists=dataset.artists, uncovered_endpoints=uncovered)}
+    if not args.skip_client:
+        results['client'] = harness.run_client(app, scenarios, dataset,
+                                               iterations=args.iterations,
+                                               memory=not args.no_memory)
+    if not args.skip_http:
+        if args.url:
+            results['http'] = harness.run_http(args.url, scenarios, dataset,
+                                               concurrency=args.concurrency, duration=args.duration)
+        else:
+            with harness.LocalServer(app) as server:
+                results['http'] = harness.run_http(server.url, scenarios, dataset,
+                                                   concurrency=args.concurrency,
+                                                   duration=args.duration)
+    report.write(results, args.out)
+    if args.check:
+        failed = sorted(name for section in ('client', 'http')
+                        for name, stats in results.get(section, {}).items()
+                        if any(int(status) >= 500 for status in stats['status_codes']))
+        if failed:
+            print('error: server errors from ' + ', '.join(failed), file=sys.stderr)
+        return 1 if failed or uncovered else 0
+
+
+def cmd_compare(args):
+    from benchmarks import report
+    rows, regressions = report.compare(report.load(args.baseline), report.load(args.current),
+                                       threshold=args.threshold, metric=args.metric)
+    for section, route, old, new, change in rows:
+        flag = '  REGRESSION' if change > args.threshold else ''
+        print(f'{section:6} {route:40} {old:10.3f} -> {new:10.3f} ({change:+.1%}){flag}')
+    return 1 if regressions else 0
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m benchmarks', description=__doc__)
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    seed = commands.add_parser('seed', help='seed a synthetic dataset')
+    seed.add_argument('--database-url', help='defaults to config.py / $DATABASE_URL')
+    seed.add_argument('--cities', type=int, default=40)
+    seed.add_argument('--venues', type=int, default=2000)
+    seed.add_argument('--artists', type=int, default=10000)
+    seed.add_argument('--shows', type=int, default=100000)
+    seed.add_argument('--seed', type=int, default=42)
+    seed.set_defaults(func=cmd_seed)
+
+    run = commands.add_parser('run', help='benchmark every route')
+    run.add_argument('--database-url', help='defaults to config.py / $DATABASE_URL')
+    run.add_argument('--out', default='-', help="JSON output path, '-' for stdout")
+    run.add_argument('--routes', nargs='*', help='endpoint names to benchmark')
+    run.add_argument('--read-only', action='store_true', help='skip routes that write')
+    run.add_argument('--iterations', type=int, default=50)
+    run.add_argument('--no-memory', action='store_true', help='skip peak memory measurement')
+    run.add_argument('--skip-client', action='store_true', help='skip the test client pass')
+    run.add_argument('--skip-http', action='store_true', help='skip the HTTP load pass')
+    run.add_argument('--url', help='load-test an already running server instead')
+    run.add_argument('--concurrency', type=int, default=16)
+    run.add_argument('--duration', type=float, default=5.0, help='seconds of load per route')
+    run.add_argument('--check', action='store_true',
+                     help='exit 1 when a route has no scenario or answers with a server error')
+    run.set_defaults(func=cmd_run)
+
+    compare = commands.add_parser('compare', help='compare two result files')
+    compare.add_argument('baseline')
+    compare.add_argument('current')
+    compare.add_argument('--threshold', type=float, default=0.10)
+    compare.add_argument('--metric', default='p95_ms')
+    compare.set_defaults(func=cmd_compare)
+
+    args = parser.parse_args(argv)
+    return args.func(args) or 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
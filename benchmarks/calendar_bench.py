@@ -0,0 +1,92 @@
+"""
+Upcoming-show query latency as show history grows
+
+Seeds a fixed set of upcoming shows, then grows the past shows from 1x to
+100x and times the upcoming queries the app runs at each step. On
+PostgreSQL the show table is partitioned by month, elsewhere the
+(venue_id, start_time) indexes do the work; either way the upcoming
+queries should stay flat.
+
+Usage:
+    python -m benchmarks.calendar_bench --database-url sqlite:///calendar.db --out calendar.json
+"""
+
+import argparse
+import os
+import random
+import time
+from datetime import datetime, timedelta
+
+
+def _time(query, repeat):
+    latencies = []
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        query()
+        latencies.append(time.perf_counter() - t0)
+    return latencies
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--database-url')
+    parser.add_argument('--venues', type=int, default=500)
+    parser.add_argument('--artists', type=int, default=2000)
+    parser.add_argument('--upcoming', type=int, default=5000)
+    parser.add_argument('--history', type=int, default=5000, help='past shows at 1x')
+    parser.add_argument('--scales', type=int, nargs='*', default=[1, 10, 100])
+    parser.add_argument('--repeat', type=int, default=50)
+    parser.add_argument('--out', default='-')
+    args = parser.parse_args(argv)
+    if args.database_url:
+        os.environ['DATABASE_URL'] = args.database_url
+
+    from app import app
+    from models import db, Show
+    import partitions
+    from benchmarks import datagen, report
+
+    rng = random.Random(3)
+    results = {}
+    with app.app_context():
+        datagen.seed(venues=args.venues, artists=args.artists, shows=0)
+        partitions.ensure_partitions(since=datetime.now() - timedelta(days=3 * 365))
+        datagen._insert(Show.__table__, datagen.generate_shows(
+            args.upcoming, args.venues, args.artists, rng, past_days=0, future_days=365))
+        db.session.commit()
+
+        history = 0
+        for scale in sorted(args.scales):
+            target = args.history * scale
+            datagen._insert(Show.__table__, datagen.generate_shows(
+                target - history, args.venues, args.artists, rng, past_days=3 * 365, future_days=0))
+            db.session.commit()
+            history = target
+
+            now = datetime.now()
+            venue_id = 1
+
+            def upcoming_for_venue():
+                Show.query.filter(Show.venue_id == venue_id).filter(Show.start_time > now).all()
+
+            def next_month():
+                partitions.shows_between(now, now + timedelta(days=30))
+
+            def upcoming_count():
+                Show.query.filter(Show.start_time > now).count()
+
+            results[f'{scale}x'] = {
+                'past_shows': history,
+                'upcoming_shows': args.upcoming,
+                'upcoming_for_venue': report.summarize(_time(upcoming_for_venue, args.repeat)),
+                'calendar_next_30_days': report.summarize(_time(next_month, max(args.repeat // 10, 3))),
+                'upcoming_count': report.summarize(_time(upcoming_count, args.repeat)),
+            }
+        dialect = db.engine.dialect.name
+
+    report.write({'meta': report.metadata(database=dialect, partitioned=dialect == 'postgresql'),
+                  'scales': results}, args.out)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,74 @@
+"""
+CPU per request and bytes on the wire with response compression
+
+Renders the large listing pages once per Accept-Encoding and measures the
+process CPU time and body size of each response: uncompressed, compressed
+on every request (compressed-body cache disabled), and compressed with the
+compressed-body cache warm. Codecs whose package isn't installed are
+skipped.
+
+Usage:
+    python -m benchmarks.compression_bench --database-url sqlite:///bench.db --out compression.json
+"""
+
+import argparse
+import os
+import time
+
+PATHS = ('/shows', '/venues', '/artists')
+ENCODINGS = ('identity', 'gzip', 'br', 'zstd')
+
+
+def _measure(client, path, encoding, repeat):
+    cpu = []
+    size = 0
+    for _ in range(repeat):
+        t0 = time.process_time()
+        response = client.get(path, headers={'Accept-Encoding': encoding})
+        body = response.get_data()
+        cpu.append(time.process_time() - t0)
+        size = len(body)
+    return cpu, size, response.headers.get('Content-Encoding', 'identity')
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--database-url')
+    parser.add_argument('--seed', action='store_true', help='seed the default dataset first')
+    parser.add_argument('--paths', nargs='*', default=list(PATHS))
+    parser.add_argument('--repeat', type=int, default=30)
+    parser.add_argument('--out', default='-')
+    args = parser.parse_args(argv)
+    if args.database_url:
+        os.environ['DATABASE_URL'] = args.database_url
+
+    from app import app
+    from compression import compressor
+    from benchmarks import datagen, report
+
+    if args.seed:
+        with app.app_context():
+            datagen.seed()
+
+    client = app.test_client()
+    cache = compressor.cache
+    results = {}
+    for path in args.paths:
+        client.get(path)  # warm the fragment cache, only compression varies below
+        for encoding in ENCODINGS:
+            if encoding != 'identity' and encoding not in compressor.codecs:
+                continue
+            modes = (('uncached', None), ('cached', cache)) if encoding != 'identity' else (('plain', cache),)
+            for mode, mode_cache in modes:
+                compressor.cache = mode_cache
+                cpu, size, served = _measure(client, path, encoding, args.repeat)
+                results[f'{path} {encoding} {mode}'] = dict(
+                    report.summarize(cpu), bytes=size, content_encoding=served)
+    compressor.cache = cache
+
+    report.write({'meta': report.metadata(codecs=sorted(compressor.codecs)),
+                  'results': results, 'stats': compressor.stats}, args.out)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,320 @@
+"""
+Synthetic dataset generator for benchmarks
+
+Venues are spread across N cities, artists carry one to three genres, and
+shows follow a realistic calendar: most of them on Thursday to Saturday
+evenings, more history than future bookings, and a long-tail popularity
+curve so a few venues and artists host most of the shows.
+"""
+
+import itertools
+import random
+from datetime import date, datetime, timedelta
+
+from sqlalchemy import func, select, text
+
+import tickets
+from models import db, Venue, Artist, Show, TicketHold, TicketShard
+from genres import GENRES, GENRE_LINKS, ensure_genres, rebuild_facets
+from geo import geocoder
+from partitions import ensure_partitions
+from suggest import suggestions
+
+CITIES = (
+    ('New York', 'NY'), ('Los Angeles', 'CA'), ('Chicago', 'IL'),
+    ('Houston', 'TX'), ('Phoenix', 'AZ'), ('Philadelphia', 'PA'),
+    ('San Antonio', 'TX'), ('San Diego', 'CA'), ('Dallas', 'TX'),
+    ('San Jose', 'CA'), ('Austin', 'TX'), ('Jacksonville', 'FL'),
+    ('San Francisco', 'CA'), ('Columbus', 'OH'), ('Indianapolis', 'IN'),
+    ('Seattle', 'WA'), ('Denver', 'CO'), ('Washington', 'DC'),
+    ('Boston', 'MA'), ('Nashville', 'TN'), ('Detroit', 'MI'),
+    ('Portland', 'OR'), ('Las Vegas', 'NV'), ('Memphis', 'TN'),
+    ('Louisville', 'KY'), ('Baltimore', 'MD'), ('Milwaukee', 'WI'),
+    ('Albuquerque', 'NM'), ('Atlanta', 'GA'), ('Miami', 'FL'),
+    ('Minneapolis', 'MN'), ('New Orleans', 'LA'), ('Cleveland', 'OH'),
+    ('Kansas City', 'MO'), ('Omaha', 'NE'), ('Raleigh', 'NC'),
+    ('Salt Lake City', 'UT'), ('Pittsburgh', 'PA'), ('St. Louis', 'MO'),
+    ('Tampa', 'FL'),
+)
+
+# Thursday to Saturday evenings carry most of the bookings
+WEEKDAY_WEIGHTS = (4, 4, 6, 14, 26, 30, 16)
+HOUR_WEIGHTS = {17: 2, 18: 6, 19: 18, 20: 30, 21: 24, 22: 12, 23: 5}
+
+BATCH_SIZE = 10000
+
+
+def _zipf_cum_weights(n, skew=1.1):
+    """
+    Cumulative long-tail weights for picking ids 1..n
+
+    Args:
+        n: number of ids
+        skew: Zipf exponent, higher means a steeper head
+
+    Returns:
+        list of cumulative weights usable with random.choices
+    """
+    return list(itertools.accumulate(1.0 / (rank ** skew) for rank in range(1, n + 1)))
+
+
+def _cities(count):
+    """
+    Picks `count` (city, state) pairs, numbering repeats past the builtin list
+
+    Args:
+        count: number of cities
+
+    Returns:
+        list of (city, state) tuples
+    """
+    cities = []
+    for i in range(count):
+        city, state = CITIES[i % len(CITIES)]
+        if i >= len(CITIES):
+            city = f'{city} {i // len(CITIES) + 1}'
+        cities.append((city, state))
+    return cities
+
+
+def generate_venues(count, cities, rng):
+    """
+    Generates venue rows
+
+    Args:
+        count: number of venues
+        cities: list of (city, state) tuples
+        rng: random.Random instance
+
+    Returns:
+        generator of dicts keyed by Venue column names
+    """
+    for venue_id in range(1, count + 1):
+        city, state = cities[rng.randrange(len(cities))]
+        # spread venues around the centroid of their city
+        lat, lng = geocoder.geocode(city.rstrip(' 0123456789'), state)
+        yield {
+            'id': venue_id,
+            'name': f'Venue {venue_id}',
+            'city': city,
+            'state': state,
+            'latitude': lat + rng.gauss(0, 0.08),
+            'longitude': lng + rng.gauss(0, 0.08),
+            'address': f'{rng.randint(1, 9999)} Main Street',
+            'phone': f'{rng.randint(200, 999)}{rng.randint(0, 9999999):07d}',
+            'image_link': f'https://images.example.com/venues/{venue_id}.jpg',
+            'website': f'https://venue{venue_id}.example.com',
+            'facebook_link': f'https://www.facebook.com/venue{venue_id}',
+            'genres': rng.sample(GENRES, rng.randint(1, 3)),
+            'seeking_talent': rng.random() < 0.3,
+            'seeking_description': 'Looking for local acts',
+        }
+
+
+def generate_artists(count, cities, rng):
+    """
+    Generates artist rows
+
+    Args:
+        count: number of artists
+        cities: list of (city, state) tuples
+        rng: random.Random instance
+
+    Returns:
+        generator of dicts keyed by Artist column names
+    """
+    for artist_id in range(1, count + 1):
+        city, state = cities[rng.randrange(len(cities))]
+        yield {
+            'id': artist_id,
+            'name': f'Artist {artist_id}',
+            'city': city,
+            'state': state,
+            'phone': f'{rng.randint(200, 999)}{rng.randint(0, 9999999):07d}',
+            'genres': rng.sample(GENRES, rng.randint(1, 3)),
+            'website': f'https://artist{artist_id}.example.com',
+            'image_link': f'https://images.example.com/artists/{artist_id}.jpg',
+            'facebook_link': f'https://www.facebook.com/artist{artist_id}',
+            'seeking_venue': rng.random() < 0.4,
+            'seeking_description': 'Looking for shows',
+        }
+
+
+def generate_shows(count, venues, artists, rng, past_days=3 * 365, future_days=365, now=None):
+    """
+    Generates show rows with a realistic calendar distribution
+
+    Args:
+        count: number of shows
+        venues: number of venues (ids 1..venues)
+        artists: number of artists (ids 1..artists)
+        rng: random.Random instance
+        past_days: how far back the history goes
+        future_days: how far ahead bookings go
+        now: reference time, defaults to datetime.now()
+
+    Returns:
+        generator of dicts keyed by Show column names
+    """
+    now = (now or datetime.now()).replace(minute=0, second=0, microsecond=0)
+    start_day = (now - timedelta(days=past_days)).date()
+    # history is denser than the booking horizon
+    span = past_days + future_days
+    day_weights = [(3 if day < past_days else 1) * WEEKDAY_WEIGHTS[(start_day + timedelta(days=day)).weekday()]
+                   for day in range(span)]
+    day_cum = list(itertools.accumulate(day_weights))
+    hours, hour_weights = zip(*HOUR_WEIGHTS.items())
+    venue_cum = _zipf_cum_weights(venues)
+    artist_cum = _zipf_cum_weights(artists, skew=0.9)
+    venue_ids = range(1, venues + 1)
+    artist_ids = range(1, artists + 1)
+
+    produced = 0
+    while produced < count:
+        batch = min(BATCH_SIZE, count - produced)
+        days = rng.choices(range(span), cum_weights=day_cum, k=batch)
+        show_hours = rng.choices(hours, weights=hour_weights, k=batch)
+        venue_batch = rng.choices(venue_ids, cum_weights=venue_cum, k=batch)
+        artist_batch = rng.choices(artist_ids, cum_weights=artist_cum, k=batch)
+        # booked a few weeks ahead on average, never after `now`
+        leads = [rng.expovariate(1 / 45.0) for _ in range(batch)]
+        for day, hour, venue_id, artist_id, lead in zip(days, show_hours, venue_batch, artist_batch, leads):
+            start = datetime.combine(start_day + timedelta(days=day), datetime.min.time())
+            start = start.replace(hour=hour, minute=rng.choice((0, 30)))
+            yield {
+                'venue_id': venue_id,
+                'artist_id': artist_id,
+                'start_time': start,
+                'created_at': min(start - timedelta(days=lead), now),
+            }
+        produced += batch
+
+
+def _insert(table, rows):
+    """
+    Bulk inserts rows in batches with executemany
+
+    Args:
+        table: SQLAlchemy Table
+        rows: iterable of dicts
+
+    Returns:
+        number of inserted rows
+    """
+    total = 0
+    iterator = iter(rows)
+    while True:
+        batch = list(itertools.islice(iterator, BATCH_SIZE))
+        if not batch:
+            return total
+        db.session.execute(table.insert(), batch)
+        total += len(batch)
+
+
+def _genre_links(model, rows, genre_ids, links):
+    """
+    Moves the genres out of generated rows into association rows
+
+    Args:
+        model: Venue or Artist
+        rows: iterable of dicts with a genres list
+        genre_ids: dict of genre name -> id
+        links: list the association rows are appended to
+
+    Returns:
+        generator of the rows without genres
+    """
+    foreign_key = GENRE_LINKS[model][1].name
+    for row in rows:
+        links.extend({foreign_key: row['id'], 'genre_id': genre_ids[genre]} for genre in row.pop('genres'))
+        yield row
+
+
+def _reset_sequences():
+    """
+    Moves PostgreSQL id sequences past the explicitly seeded ids
+
+    Args:
+        None
+
+    Returns:
+        None
+    """
+    if db.engine.dialect.name != 'postgresql':
+        return
+    for table in ('venue', 'artist', 'show'):
+        db.session.execute(text(
+            f"SELECT setval(pg_get_serial_sequence('{table}', 'id'), "
+            f"COALESCE((SELECT MAX(id) FROM {table}), 1))"))
+
+
+def open_sales(shows=20, capacity=1000000, holds=2):
+    """
+    Puts the first upcoming shows on sale and holds tickets of the first
+    one, for the ticket routes to work with
+
+    The holds last a year, so they outlive any benchmark run; purchasing
+    or releasing one again still answers 200.
+
+    Args:
+        shows: shows put on sale
+        capacity: tickets per show, enough to outlast the hold scenarios
+        holds: holds of one ticket each
+
+    Returns:
+        None
+    """
+    show_ids = db.session.execute(
+        select(Show.id).where(Show.start_time > datetime.now()).order_by(Show.id).limit(shows)).scalars().all()
+    for show_id in show_ids:
+        tickets.open_sales(show_id, capacity)
+    db.session.commit()
+    for _ in range(holds if show_ids else 0):
+        tickets.hold(show_ids[0], 1, 365 * 24 * 3600)
+
+
+def seed(cities=40, venues=2000, artists=10000, shows=100000, seed=42, reset=True):
+    """
+    Seeds the synthetic dataset into the app's database
+
+    Must be called inside an application context.
+
+    Args:
+        cities: number of distinct cities
+        venues: number of venues
+        artists: number of artists
+        shows: number of shows
+        seed: random seed, so runs are reproducible
+        reset: drop and recreate all tables first
+
+    Returns:
+        dict of row counts per table
+    """
+    rng = random.Random(seed)
+    if reset:
+        db.drop_all()
+        db.create_all()
+    city_list = _cities(cities)
+    genre_ids = ensure_genres()
+    venue_links, artist_links = [], []
+    counts = {
+        'venue': _insert(Venue.__table__, _genre_links(
+            Venue, generate_venues(venues, city_list, rng), genre_ids, venue_links)),
+        'artist': _insert(Artist.__table__, _genre_links(
+            Artist, generate_artists(artists, city_list, rng), genre_ids, artist_links)),
+    }
+    _insert(GENRE_LINKS[Venue][0], venue_links)
+    _insert(GENRE_LINKS[Artist][0], artist_links)
+    db.session.commit()
+    rebuild_facets()
+    # On PostgreSQL every month of shows needs its partition first, or they
+    # would all land in show_default (see generate_shows for the range)
+    ensure_partitions(months_ahead=12, since=date.today() - timedelta(days=3 * 365))
+    counts['show'] = _insert(Show.__table__, generate_shows(shows, venues, artists, rng))
+    _reset_sequences()
+    db.session.commit()
+    open_sales()
+    for model in (TicketShard, TicketHold):
+        counts[model.__tablename__] = db.session.execute(select(func.count()).select_from(model)).scalar()
+    suggestions.invalidate()
+    return counts
@@ -0,0 +1,115 @@
+"""
+Concurrent edits of one venue: conflicts and lost updates
+
+Each thread owns one column of the same venue and keeps setting it to a
+new value through the edit page: load the form, change its column,
+submit. Submissions race with the other threads' and are retried after a
+conflict. Runs with versioned partial updates (what the edit pages send)
+and with legacy full-row submissions without a version, and checks at
+the end whether every column still holds the last value its thread
+successfully saved.
+
+Usage:
+    python -m benchmarks.edit_bench --database-url sqlite:///bench.db --out edits.json
+"""
+
+import argparse
+import html
+import json
+import os
+import re
+import threading
+import time
+
+FIELDS = ('name', 'address', 'phone', 'website', 'image_link', 'facebook_link', 'seeking_description')
+
+
+def _load(client, venue_id):
+    page = client.get(f'/venues/{venue_id}/edit').get_data(as_text=True)
+    version = re.search(r'name="version_id" value="(\d+)"', page).group(1)
+    original = html.unescape(re.search(r'name="original" value="([^"]*)"', page).group(1))
+    return version, original
+
+
+def _form(original, field, value, version, versioned):
+    values = json.loads(original)
+    form = {key: value for key, value in values.items() if key not in ('genres', 'seeking_talent')}
+    form['genres'] = values['genres']
+    if values['seeking_talent']:
+        form['seeking_talent'] = 'y'
+    form[field] = value
+    if versioned:
+        form.update(version_id=version, original=original)
+    return form
+
+
+def _editor(app, venue_id, field, versioned, stop, stats, saved):
+    client = app.test_client()
+    attempt = 0
+    while not stop.is_set():
+        attempt += 1
+        value = f'{field}-{attempt}'
+        version, original = _load(client, venue_id)
+        t0 = time.perf_counter()
+        response = client.post(f'/venues/{venue_id}/edit',
+                               data=_form(original, field, value, version, versioned))
+        stats['latency'].append(time.perf_counter() - t0)
+        if response.headers.get('Location', '').endswith('/edit'):
+            stats['conflicts'] += 1
+        else:
+            stats['saved'] += 1
+            saved[field] = value
+
+
+def run(app, venue_id, versioned, threads, duration):
+    from models import db, Venue
+
+    stop = threading.Event()
+    stats = {'saved': 0, 'conflicts': 0, 'latency': []}
+    saved = {}
+    with app.app_context():
+        before = db.session.get(Venue, venue_id).version_id
+    workers = [threading.Thread(target=_editor, args=(app, venue_id, field, versioned, stop, stats, saved))
+               for field in FIELDS[:threads]]
+    for worker in workers:
+        worker.start()
+    time.sleep(duration)
+    stop.set()
+    for worker in workers:
+        worker.join()
+    with app.app_context():
+        venue = db.session.get(Venue, venue_id)
+        lost = [field for field, value in saved.items() if getattr(venue, field) != value]
+        versions = venue.version_id - before
+        db.session.remove()
+    return dict(stats, lost_updates=lost, version_increments=versions)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--database-url')
+    parser.add_argument('--venue-id', type=int, default=1)
+    parser.add_argument('--threads', type=int, default=len(FIELDS), help=f'at most {len(FIELDS)}')
+    parser.add_argument('--duration', type=float, default=10.0)
+    parser.add_argument('--out', default='-')
+    args = parser.parse_args(argv)
+    if args.database_url:
+        os.environ['DATABASE_URL'] = args.database_url
+    os.environ['RATELIMIT_ENABLED'] = '0'
+    os.environ.setdefault('SUGGEST_PRELOAD', '0')
+
+    from app import app
+    from benchmarks import report
+
+    results = {}
+    for label, versioned in (('versioned', True), ('legacy_full_row', False)):
+        result = run(app, args.venue_id, versioned, args.threads, args.duration)
+        result['latency'] = report.summarize(result['latency'], args.duration)
+        results[label] = result
+
+    report.write({'meta': report.metadata(threads=args.threads, duration=args.duration),
+                  'results': results}, args.out)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,154 @@
+"""
+Thousands of idle /events subscribers on one event server process
+
+Starts `serve.py events`, connects --subscribers clients, then lists
+--shows shows through /shows/create one after the other. Reports the
+server's memory per subscriber and how long each show took from its
+commit to reaching every subscriber.
+
+Usage:
+    python -m benchmarks.events_bench --database-url sqlite:///bench.db --subscribers 5000 --out events.json
+"""
+
+import argparse
+import asyncio
+import os
+import random
+import subprocess
+import sys
+import threading
+import time
+import urllib.request
+
+basedir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def _rss_kb(pid):
+    with open(f'/proc/{pid}/status') as f:
+        for line in f:
+            if line.startswith('VmRSS:'):
+                return int(line.split()[1])
+
+
+def _wait_up(port, timeout=30):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            urllib.request.urlopen(f'http://127.0.0.1:{port}/healthz', timeout=1).read()
+            return
+        except OSError:
+            time.sleep(0.2)
+    raise RuntimeError('the event server did not start')
+
+
+async def _subscribe(port, arrivals, connected):
+    reader, writer = await asyncio.open_connection('127.0.0.1', port)
+    writer.write(b'GET /events?entity=show HTTP/1.1\r\nHost: bench\r\nAccept: text/event-stream\r\n\r\n')
+    await writer.drain()
+    await reader.readuntil(b'\r\n\r\n')
+    connected.append(writer)
+    while True:
+        line = await reader.readline()
+        if not line:
+            return
+        if line.startswith(b'id: '):
+            arrivals.setdefault(int(line[4:]), []).append(time.time())
+
+
+async def _clients(port, count, arrivals, ready, stop):
+    connected = []
+    tasks = []
+    for i in range(count):
+        tasks.append(asyncio.create_task(_subscribe(port, arrivals, connected)))
+        if i % 200 == 199:
+            await asyncio.sleep(0.05)
+    while len(connected) < count:
+        await asyncio.sleep(0.1)
+    ready.set()
+    while not stop.is_set():
+        await asyncio.sleep(0.1)
+    for writer in connected:
+        writer.close()
+    for task in tasks:
+        task.cancel()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--database-url')
+    parser.add_argument('--subscribers', type=int, default=5000)
+    parser.add_argument('--shows', type=int, default=20)
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--out', default='-')
+    args = parser.parse_args(argv)
+    if args.database_url:
+        os.environ['DATABASE_URL'] = args.database_url
+    os.environ['RATELIMIT_ENABLED'] = '0'
+    os.environ.setdefault('SUGGEST_PRELOAD', '0')
+
+    from app import app
+    from benchmarks import report
+    from models import db, ChangeLog, Venue, Artist
+
+    with app.app_context():
+        db.create_all()
+        venue_id = db.session.query(Venue.id).first()[0]
+        artist_id = db.session.query(Artist.id).first()[0]
+        db.session.remove()
+
+    server = subprocess.Popen([sys.executable, 'serve.py', 'events', '--bind', f'127.0.0.1:{args.port}'],
+                              cwd=basedir, stderr=subprocess.DEVNULL)
+    try:
+        _wait_up(args.port)
+        idle_kb = _rss_kb(server.pid)
+
+        arrivals, ready, stop = {}, threading.Event(), threading.Event()
+        t0 = time.perf_counter()
+        clients = threading.Thread(target=asyncio.run,
+                                   args=(_clients(args.port, args.subscribers, arrivals, ready, stop),))
+        clients.start()
+        ready.wait()
+        connect_seconds = time.perf_counter() - t0
+        time.sleep(1)
+        subscribed_kb = _rss_kb(server.pid)
+
+        client = app.test_client()
+        committed = {}
+        for i in range(args.shows):
+            client.post('/shows/create', data={'artist_id': artist_id, 'venue_id': venue_id,
+                                               'start_time': f'2031-01-{i % 28 + 1:02d} 20:00:00'})
+            with app.app_context():
+                committed[db.session.query(db.func.max(ChangeLog.id)).scalar()] = time.time()
+                db.session.remove()
+            # Random gaps, so commits don't fall into step with the polling
+            time.sleep(random.uniform(0.2, 0.8))
+        time.sleep(2)
+        stop.set()
+        clients.join()
+
+        first, last = [], []
+        for event_id, commit_time in committed.items():
+            times = sorted(arrivals.get(event_id, []))
+            if times:
+                first.append(times[0] - commit_time)
+                last.append(times[-1] - commit_time)
+        delivered = sum(len(arrivals.get(event_id, [])) for event_id in committed)
+        results = {
+            'subscribers': args.subscribers,
+            'connect_seconds': round(connect_seconds, 3),
+            'server_rss_kb': {'idle': idle_kb, 'subscribed': subscribed_kb,
+                              'per_subscriber': round((subscribed_kb - idle_kb) / args.subscribers, 2)},
+            'deliveries': {'expected': args.subscribers * len(committed), 'delivered': delivered},
+            'commit_to_first_subscriber': report.summarize(first),
+            'commit_to_last_subscriber': report.summarize(last),
+        }
+    finally:
+        server.terminate()
+        server.wait()
+
+    report.write({'meta': report.metadata(poll_interval=app.config['EVENTS_POLL_INTERVAL']),
+                  'results': results}, args.out)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,73 @@
+"""
+Render time of the form pages
+
+Times GETs of the create and edit pages of venues and artists and of the
+show create page, then the state and genre selects on their own: rendered
+by the cached widget the forms use and by WTForms' stock Select.
+
+Usage:
+    python -m benchmarks.form_bench --database-url sqlite:///bench.db --out forms.json
+"""
+
+import argparse
+import os
+import time
+
+
+def _timed(call, requests):
+    latencies = []
+    for _ in range(requests):
+        t0 = time.perf_counter()
+        call()
+        latencies.append(time.perf_counter() - t0)
+    return latencies
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--database-url')
+    parser.add_argument('--requests', type=int, default=1000)
+    parser.add_argument('--out', default='-')
+    args = parser.parse_args(argv)
+    if args.database_url:
+        os.environ['DATABASE_URL'] = args.database_url
+    os.environ['RATELIMIT_ENABLED'] = '0'
+    os.environ.setdefault('SUGGEST_PRELOAD', '0')
+
+    from wtforms.widgets import Select
+
+    from app import app
+    from benchmarks import report
+    from forms import VenueForm
+    from models import db, Artist, Venue
+
+    with app.app_context():
+        venue_id = Venue.live().with_entities(Venue.id).first()[0]
+        artist_id = Artist.live().with_entities(Artist.id).first()[0]
+        db.session.remove()
+
+    client = app.test_client()
+    results = {}
+    for path in ('/venues/create', '/artists/create', '/shows/create',
+                 f'/venues/{venue_id}/edit', f'/artists/{artist_id}/edit'):
+        _timed(lambda: client.get(path), 20)
+        results[path] = report.summarize(_timed(lambda: client.get(path), args.requests))
+
+    stock = Select()
+    with app.test_request_context():
+        form = VenueForm(data={'state': 'NY', 'genres': ['Jazz', 'Folk']})
+        for name in ('state', 'genres'):
+            field = form[name]
+            stock.multiple = field.widget.multiple
+            results[f'{name}_select'] = {
+                'cached': report.summarize(_timed(lambda: field(), args.requests)),
+                'stock': report.summarize(_timed(lambda: stock(field), args.requests)),
+            }
+
+    report.write({'meta': report.metadata(requests=args.requests,
+                                          database=app.config['SQLALCHEMY_DATABASE_URI'].split(':')[0]),
+                  'results': results}, args.out)
+
+
+if __name__ == '__main__':
+    main()
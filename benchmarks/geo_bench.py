@@ -0,0 +1,69 @@
+"""
+Spatial index benchmark: build time, memory and query latency of the
+in-process GridIndex behind /venues/nearby
+
+Usage:
+    python -m benchmarks.geo_bench --points 1000000 --out geo.json
+"""
+
+import argparse
+import random
+import time
+import tracemalloc
+
+from benchmarks import report
+from benchmarks.datagen import CITIES
+from geo import GridIndex, geocoder
+
+
+def build(points, cell_deg, rng):
+    centres = [geocoder.geocode(city, state) for city, state in CITIES]
+    index = GridIndex(cell_deg)
+    for point_id in range(1, points + 1):
+        lat, lng = centres[rng.randrange(len(centres))]
+        index.add(point_id, lat + rng.gauss(0, 0.15), lng + rng.gauss(0, 0.15))
+    return index, centres
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--points', type=int, default=1000000)
+    parser.add_argument('--cell-deg', type=float, default=0.1)
+    parser.add_argument('--queries', type=int, default=200)
+    parser.add_argument('--out', default='-')
+    args = parser.parse_args(argv)
+    rng = random.Random(7)
+
+    tracemalloc.start()
+    started = time.perf_counter()
+    index, centres = build(args.points, args.cell_deg, rng)
+    build_seconds = time.perf_counter() - started
+    memory_mb = tracemalloc.get_traced_memory()[0] / 2 ** 20
+    tracemalloc.stop()
+
+    queries = {
+        'radius_5km_k20': lambda lat, lng: index.within(lat, lng, 5, limit=20),
+        'radius_25km_k20': lambda lat, lng: index.within(lat, lng, 25, limit=20),
+        'nearest_k10': lambda lat, lng: index.nearest(lat, lng, 10),
+        'nearest_k10_rural': lambda lat, lng: index.nearest(lat + 3, lng + 3, 10),
+    }
+    results = {}
+    for name, query in queries.items():
+        latencies = []
+        for _ in range(args.queries):
+            lat, lng = centres[rng.randrange(len(centres))]
+            t0 = time.perf_counter()
+            query(lat + rng.gauss(0, 0.1), lng + rng.gauss(0, 0.1))
+            latencies.append(time.perf_counter() - t0)
+        results[name] = report.summarize(latencies)
+
+    report.write({
+        'meta': report.metadata(points=args.points, cell_deg=args.cell_deg),
+        'build_seconds': round(build_seconds, 2),
+        'index_memory_mb': round(memory_mb, 1),
+        'queries': results,
+    }, args.out)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,456 @@
+"""
+Route drivers for benchmarks
+
+Every route in app.py is described by a Scenario. The in-process driver runs
+them through the Flask test client and records latency, SQL statements per
+request and peak Python memory; the HTTP driver serves the app on a local
+port and hammers each route with concurrent clients.
+"""
+
+import hashlib
+import itertools
+import os
+import threading
+import time
+import tracemalloc
+import urllib.error
+import urllib.parse
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from functools import lru_cache
+from typing import Callable, Optional
+
+from sqlalchemy import event, func
+from werkzeug.serving import WSGIRequestHandler, make_server
+
+from assets import assets
+from images import images
+from models import db, Venue, Artist, TicketHold, TicketShard
+from reports import REPORTS
+from benchmarks.report import summarize
+
+
+@dataclass
+class Scenario:
+    """
+    One benchmarked route
+
+    Args:
+        endpoint: Flask endpoint name the scenario covers
+        method: HTTP method
+        path: callable (Dataset) -> URL path
+        data: optional callable (Dataset) -> form dict for POST requests,
+            or bytes sent as the raw body
+        mutates: whether the request writes to the database
+        stream: the response never ends; only its first chunk is read
+    """
+    endpoint: str
+    method: str
+    path: Callable
+    data: Optional[Callable] = None
+    mutates: bool = False
+    name: str = field(default='')
+    stream: bool = False
+
+    def __post_init__(self):
+        if not self.name:
+            self.name = f'{self.method} {self.endpoint}'
+
+
+class Dataset:
+    """
+    Id ranges of the seeded data, used to build request paths
+
+    Args:
+        venues: highest venue id
+        artists: highest artist id
+        on_sale: ids of shows with tickets on sale (see datagen.open_sales)
+        holds: ids of ticket holds
+    """
+
+    def __init__(self, venues, artists, on_sale=(), holds=()):
+        self.venues = max(venues, 1)
+        self.artists = max(artists, 1)
+        self.on_sale = list(on_sale) or [1]
+        self.holds = list(holds) or ['none']
+        self._counter = itertools.count()
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_database(cls):
+        return cls(db.session.query(func.max(Venue.id)).scalar() or 1,
+                   db.session.query(func.max(Artist.id)).scalar() or 1,
+                   [show_id for show_id, in db.session.query(TicketShard.show_id).distinct()
+                    .order_by(TicketShard.show_id).limit(100)],
+                   [hold_id for hold_id, in db.session.query(TicketHold.id)
+                    .order_by(TicketHold.created_at).limit(2)])
+
+    def next(self):
+        with self._lock:
+            return next(self._counter)
+
+    def venue_id(self):
+        # hot ids first, like the long-tail popularity of the seeded shows
+        return self.next() % min(self.venues, 100) + 1
+
+    def artist_id(self):
+        return self.next() % min(self.artists, 100) + 1
+
+    def show_id(self):
+        return self.on_sale[self.next() % len(self.on_sale)]
+
+    def hold_id(self, i):
+        return self.holds[i % len(self.holds)]
+
+
+def _venue_form(dataset):
+    n = dataset.next()
+    return {
+        'name': f'Bench Venue {n}', 'city': 'Austin', 'state': 'TX',
+        'address': '1 Bench Way', 'phone': '5125550100', 'genres': ['Jazz', 'Blues'],
+        'image_link': 'https://images.example.com/bench.jpg',
+        'website': 'https://bench.example.com', 'facebook_link': 'https://www.facebook.com/bench',
+        'seeking_talent': 'y', 'seeking_description': 'benchmark',
+    }
+
+
+def _artist_form(dataset):
+    n = dataset.next()
+    return {
+        'name': f'Bench Artist {n}', 'city': 'Austin', 'state': 'TX',
+        'phone': '5125550100', 'genres': ['Jazz'],
+        'image_link': 'https://images.example.com/bench.jpg',
+        'website': 'https://bench.example.com', 'facebook_link': 'https://www.facebook.com/bench',
+        'seeking_venue': 'y', 'seeking_description': 'benchmark',
+    }
+
+
+@lru_cache(maxsize=None)
+def _upload():
+    with open(os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                           'static', 'img', 'Homepage.png'), 'rb') as f:
+        return f.read()
+
+
+def _upload_digest():
+    return hashlib.sha256(_upload()).hexdigest()
+
+
+def _show_form(dataset):
+    return {'artist_id': dataset.artist_id(), 'venue_id': dataset.venue_id(),
+            'start_time': '2030-01-01 20:00:00'}
+
+
+SCENARIOS = [
+    Scenario('index', 'GET', lambda d: '/'),
+    Scenario('static', 'GET', lambda d: '/static/css/main.css'),
+    # the first source file instead until `flask assets build` has been run
+    Scenario('dist_asset', 'GET', lambda d: assets.url('main.css')),
+    Scenario('suggest', 'GET', lambda d: f'/suggest?q=venue {d.venue_id()}'),
+    Scenario('metrics', 'GET', lambda d: '/metrics'),
+    Scenario('events_feed', 'GET', lambda d: '/events?entity=show', stream=True),
+    Scenario('health', 'GET', lambda d: '/healthz'),
+    Scenario('ready', 'GET', lambda d: '/readyz'),
+    Scenario('venues', 'GET', lambda d: '/venues'),
+    Scenario('venues', 'GET', lambda d: '/venues?state=NY&genre=Jazz&upcoming=1&page=2',
+             name='GET venues filtered'),
+    Scenario('nearby_venues', 'GET', lambda d: '/venues/nearby?city=Austin&state=TX&radius_km=25&k=20'),
+    Scenario('show_venue', 'GET', lambda d: f'/venues/{d.venue_id()}'),
+    Scenario('search_venues', 'POST', lambda d: '/venues/search',
+             data=lambda d: {'search_term': 'Venue 1'}),
+    Scenario('create_venue_form', 'GET', lambda d: '/venues/create'),
+    Scenario('create_venue_submission', 'POST', lambda d: '/venues/create',
+             data=_venue_form, mutates=True),
+    Scenario('edit_venue', 'GET', lambda d: f'/venues/{d.venue_id()}/edit'),
+    Scenario('edit_venue_submission', 'POST', lambda d: f'/venues/{d.venue_id()}/edit',
+             data=_venue_form, mutates=True),
+    Scenario('delete_venue', 'DELETE', lambda d: f'/venues/{d.venues - d.next()}', mutates=True),
+    Scenario('artists', 'GET', lambda d: '/artists'),
+    Scenario('artists', 'GET', lambda d: '/artists?genre=Jazz&seeking_venue=1&page=2',
+             name='GET artists filtered'),
+    Scenario('delete_artist', 'DELETE', lambda d: f'/artists/{d.artists - d.next()}', mutates=True),
+    Scenario('show_artist', 'GET', lambda d: f'/artists/{d.artist_id()}'),
+    Scenario('search_artists', 'POST', lambda d: '/artists/search',
+             data=lambda d: {'search_term': 'Artist 1'}),
+    Scenario('create_artist_form', 'GET', lambda d: '/artists/create'),
+    Scenario('create_artist_submission', 'POST', lambda d: '/artists/create',
+             data=_artist_form, mutates=True),
+    Scenario('edit_artist', 'GET', lambda d: f'/artists/{d.artist_id()}/edit'),
+    Scenario('edit_artist_submission', 'POST', lambda d: f'/artists/{d.artist_id()}/edit',
+             data=_artist_form, mutates=True),
+    Scenario('shows', 'GET', lambda d: '/shows'),
+    Scenario('shows_calendar', 'GET', lambda d: '/shows/calendar'),
+    Scenario('shows_calendar', 'GET', lambda d: '/shows/calendar?format=json', name='GET calendar json'),
+    Scenario('create_shows', 'GET', lambda d: '/shows/create'),
+    Scenario('create_show_submission', 'POST', lambda d: '/shows/create',
+             data=_show_form, mutates=True),
+    Scenario('reports_index', 'GET', lambda d: '/reports'),
+    Scenario('show_report', 'GET', lambda d: '/reports/venue-months'),
+    # Cached after the first request, as they are in production
+    *[Scenario('show_report', 'GET', lambda d, name=name: f'/reports/{name}?format=json',
+               name=f'GET report {name} json') for name in REPORTS],
+    Scenario('upload_image', 'POST', lambda d: '/images', data=lambda d: _upload(), mutates=True),
+    # The upload above stored it
+    Scenario('stored_image', 'GET', lambda d: f'/images/{_upload_digest()}'),
+    Scenario('image_thumbnail', 'GET', lambda d: f'/images/{_upload_digest()}/tile'),
+    # The seeded image links don't resolve, so this measures the redirect
+    # to the original once the failed fetch is remembered
+    Scenario('image_proxy', 'GET', lambda d: '/img/tile/%s?src=%s' % (
+        images.sign('https://images.example.com/bench.jpg'),
+        urllib.parse.quote('https://images.example.com/bench.jpg', safe=''))),
+    Scenario('show_tickets', 'GET', lambda d: f'/shows/{d.show_id()}/tickets'),
+    Scenario('hold_tickets', 'POST', lambda d: f'/shows/{d.show_id()}/holds',
+             data=lambda d: {'quantity': 2}, mutates=True),
+    # Purchasing or releasing a hold again still succeeds
+    Scenario('purchase_tickets', 'POST', lambda d: f'/holds/{d.hold_id(0)}/purchase', mutates=True),
+    Scenario('release_tickets', 'DELETE', lambda d: f'/holds/{d.hold_id(1)}', mutates=True),
+]
+
+
+def uncovered_endpoints(app, scenarios=SCENARIOS):
+    """
+    Lists endpoints of the app that no scenario exercises
+
+    Args:
+        app: Flask app
+        scenarios: scenarios to check
+
+    Returns:
+        sorted list of endpoint names
+    """
+    covered = {scenario.endpoint for scenario in scenarios}
+    return sorted({rule.endpoint for rule in app.url_map.iter_rules()} - covered)
+
+
+def select(names=None, include_writes=True):
+    """
+    Filters the scenario list
+
+    Args:
+        names: endpoint names to keep, or None for all
+        include_writes: keep scenarios that write to the database
+
+    Returns:
+        list of Scenario
+    """
+    return [s for s in SCENARIOS
+            if (names is None or s.endpoint in names) and (include_writes or not s.mutates)]
+
+
+class StatementCounter:
+    """
+    Counts SQL statements executed by the current thread
+
+    Args:
+        engine: SQLAlchemy engine to listen on
+    """
+
+    def __init__(self, engine):
+        self.engine = engine
+        self._local = threading.local()
+
+    def __enter__(self):
+        event.listen(self.engine, 'before_cursor_execute', self._count)
+        return self
+
+    def __exit__(self, *exc):
+        event.remove(self.engine, 'before_cursor_execute', self._count)
+
+    def _count(self, *args, **kwargs):
+        self._local.count = getattr(self._local, 'count', 0) + 1
+
+    def reset(self):
+        self._local.count = 0
+
+    @property
+    def count(self):
+        return getattr(self._local, 'count', 0)
+
+
+def _client_request(client, scenario, dataset):
+    kwargs = {}
+    if scenario.data:
+        kwargs['data'] = scenario.data(dataset)
+        if isinstance(kwargs['data'], bytes):
+            kwargs['content_type'] = 'application/octet-stream'
+    if not scenario.stream:
+        return client.open(scenario.path(dataset), method=scenario.method, **kwargs)
+    response = client.open(scenario.path(dataset), method=scenario.method, buffered=False, **kwargs)
+    next(iter(response.response), None)
+    response.close()
+    return response
+
+
+def run_client(app, scenarios, dataset, iterations=50, warmup=3, memory=True):
+    """
+    Drives scenarios in-process through the Flask test client
+
+    Args:
+        app: Flask app
+        scenarios: list of Scenario
+        dataset: Dataset
+        iterations: measured requests per scenario
+        warmup: unmeasured requests per scenario
+        memory: also measure peak traced memory per request
+
+    Returns:
+        dict of scenario name -> statistics
+    """
+    client = app.test_client()
+    results = {}
+    with app.app_context():
+        counter = StatementCounter(db.engine)
+    with counter:
+        for scenario in scenarios:
+            for _ in range(warmup):
+                _client_request(client, scenario, dataset)
+            latencies, statements, statuses = [], [], {}
+            started = time.perf_counter()
+            for _ in range(iterations):
+                counter.reset()
+                t0 = time.perf_counter()
+                response = _client_request(client, scenario, dataset)
+                latencies.append(time.perf_counter() - t0)
+                statements.append(counter.count)
+                statuses[response.status_code] = statuses.get(response.status_code, 0) + 1
+            stats = summarize(latencies, time.perf_counter() - started)
+            stats['sql_statements_avg'] = round(sum(statements) / len(statements), 2)
+            stats['sql_statements_max'] = max(statements)
+            stats['status_codes'] = statuses
+            if memory:
+                stats['peak_memory_kb'] = _peak_memory(client, scenario, dataset)
+            results[scenario.name] = stats
+    return results
+
+
+def _peak_memory(client, scenario, dataset, samples=3):
+    """
+    Peak traced Python allocations of a single request, in KiB
+
+    Measured separately because tracemalloc slows every allocation down.
+    """
+    peaks = []
+    tracemalloc.start()
+    try:
+        for _ in range(samples):
+            tracemalloc.reset_peak()
+            baseline = tracemalloc.get_traced_memory()[0]
+            _client_request(client, scenario, dataset)
+            peaks.append(tracemalloc.get_traced_memory()[1] - baseline)
+    finally:
+        tracemalloc.stop()
+    return round(max(peaks) / 1024.0, 1)
+
+
+class _QuietHandler(WSGIRequestHandler):
+    # per-request access logging would dominate the measurements
+    def log_request(self, *args, **kwargs):
+        pass
+
+
+class LocalServer:
+    """
+    Serves the app on an ephemeral localhost port in a background thread
+
+    Args:
+        app: Flask app
+    """
+
+    def __init__(self, app):
+        self.server = make_server('127.0.0.1', 0, app, threaded=True,
+                                  request_handler=_QuietHandler)
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    @property
+    def url(self):
+        return f'http://127.0.0.1:{self.server.server_port}'
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.server.shutdown()
+        self.thread.join()
+
+
+class _LocalRedirects(urllib.request.HTTPRedirectHandler):
+    # Redirects off the server under test (the image proxy's, to the
+    # original) count as their own status instead of being followed
+    def redirect_request(self, req, fp, code, msg, headers, newurl):
+        if urllib.parse.urlsplit(newurl).netloc != urllib.parse.urlsplit(req.full_url).netloc:
+            return None
+        return super().redirect_request(req, fp, code, msg, headers, newurl)
+
+
+_opener = urllib.request.build_opener(_LocalRedirects)
+
+
+def _http_request(base_url, scenario, dataset, timeout):
+    body, headers = None, {}
+    if scenario.data:
+        body = scenario.data(dataset)
+        if isinstance(body, bytes):
+            headers['Content-Type'] = 'application/octet-stream'
+        else:
+            body = urllib.parse.urlencode(body, doseq=True).encode()
+    req = urllib.request.Request(base_url + scenario.path(dataset), data=body, headers=headers,
+                                 method=scenario.method)
+    try:
+        with _opener.open(req, timeout=timeout) as response:
+            response.read()
+            return response.status
+    except urllib.error.HTTPError as e:
+        return e.code
+
+
+def run_http(base_url, scenarios, dataset, concurrency=16, duration=5.0, timeout=30.0):
+    """
+    Load-tests each scenario with concurrent HTTP clients
+
+    Args:
+        base_url: server root, e.g. http://127.0.0.1:5000
+        scenarios: list of Scenario
+        dataset: Dataset
+        concurrency: number of client threads
+        duration: seconds of load per scenario
+        timeout: per-request timeout in seconds
+
+    Returns:
+        dict of scenario name -> statistics
+    """
+    results = {}
+    for scenario in scenarios:
+        # Every closed stream would hold a server thread until its next
+        # heartbeat finds the client gone
+        if scenario.stream:
+            continue
+        latencies, statuses, errors = [], {}, []
+        lock = threading.Lock()
+        deadline = time.perf_counter() + duration
+
+        def worker():
+            while time.perf_counter() < deadline:
+                t0 = time.perf_counter()
+                try:
+                    status = _http_request(base_url, scenario, dataset, timeout)
+                except OSError as e:
+                    with lock:
+                        errors.append(repr(e))
+                    continue
+                elapsed = time.perf_counter() - t0
+                with lock:
+                    latencies.append(elapsed)
+                    statuses[status] = statuses.get(status, 0) + 1
+
+        started = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=concurrency) as pool:
+            for _ in range(concurrency):
+                pool.submit(worker)
+        stats = summarize(latencies, time.perf_counter() - started)
+        stats['concurrency'] = concurrency
+        stats['status_codes'] = statuses
+        stats['errors'] = len(errors)
+        results[scenario.name] = stats
+    return results
@@ -0,0 +1,136 @@
+"""
+Image proxy: fetch, thumbnail and cache
+
+Serves the images in static/img from a local HTTP server, each under
+--images URLs with a few distinct trailing bytes so every URL is a
+different image to the store, and requests their tiles through /img:
+first from an empty store (cold: fetched, thumbnailed and stored), then
+again (warm: a file read), then revalidated with the ETag (304). Bytes
+served are compared with the originals, which the pages linked to before.
+Finally `flask images import` is timed on --images new URLs. Runs offline.
+
+Usage:
+    python -m benchmarks.images_bench --out images.json
+"""
+
+import argparse
+import functools
+import http.server
+import os
+import tempfile
+import threading
+import time
+from urllib.parse import urlsplit
+
+basedir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+FIXTURES = os.path.join(basedir, 'static', 'img')
+
+
+class _FixtureHandler(http.server.BaseHTTPRequestHandler):
+    """
+    Serves /<n>/<fixture>: the fixture image followed by n as padding
+    """
+
+    def do_GET(self):
+        _, n, name = self.path.split('/', 2)
+        with open(os.path.join(FIXTURES, os.path.basename(name)), 'rb') as f:
+            body = f.read() + n.encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'image/jpeg' if name.endswith('.jpg') else 'image/png')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+def _timed(call, items):
+    latencies, results = [], []
+    for item in items:
+        t0 = time.perf_counter()
+        results.append(call(item))
+        latencies.append(time.perf_counter() - t0)
+    return latencies, results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--database-url')
+    parser.add_argument('--dir', help='image store, a new temporary directory by default')
+    parser.add_argument('--images', type=int, default=100)
+    parser.add_argument('--size', default='tile')
+    parser.add_argument('--out', default='-')
+    args = parser.parse_args(argv)
+    if args.database_url:
+        os.environ['DATABASE_URL'] = args.database_url
+    os.environ.update({
+        'IMAGE_STORE_DIR': args.dir or tempfile.mkdtemp(prefix='fyyur_images_'),
+        # the fixture server is on loopback
+        'IMAGE_ALLOW_PRIVATE': '1',
+        'RATELIMIT_ENABLED': '0',
+    })
+    os.environ.setdefault('SUGGEST_PRELOAD', '0')
+
+    from app import app
+    from benchmarks import report
+    from images import Image, images
+
+    images.wait = 60
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), _FixtureHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    base = f'http://127.0.0.1:{server.server_port}'
+    fixtures = sorted(name for name in os.listdir(FIXTURES) if name.endswith(('.jpg', '.png')))
+    sources = [f'{base}/{i}/{fixtures[i % len(fixtures)]}' for i in range(args.images)]
+
+    client = app.test_client()
+    with app.test_request_context():
+        urls = [images.thumb_url(src, args.size) for src in sources]
+
+    def get(url, headers=None):
+        parts = urlsplit(url)
+        return client.get(parts.path, query_string=parts.query, headers=headers)
+
+    cold, responses = _timed(get, urls)
+    warm, _ = _timed(get, urls)
+    etags = {url: response.headers.get('ETag') for url, response in zip(urls, responses)}
+    revalidated, revalidations = _timed(lambda url: get(url, {'If-None-Match': etags[url]}), urls)
+    original_bytes = sum(os.path.getsize(os.path.join(FIXTURES, fixtures[i % len(fixtures)]))
+                         for i in range(args.images))
+
+    # flask images import, on URLs the store hasn't seen
+    fresh = [f'{base}/{args.images + i}/{fixtures[i % len(fixtures)]}' for i in range(args.images)]
+    t0 = time.perf_counter()
+    for future in [images.import_url(src) for src in fresh]:
+        future.result()
+    import_seconds = time.perf_counter() - t0
+    server.shutdown()
+
+    results = {
+        'cold': report.summarize(cold),
+        'warm': report.summarize(warm),
+        'revalidated': report.summarize(revalidated),
+        'statuses': {
+            'cold': sorted({response.status_code for response in responses}),
+            'revalidated': sorted({response.status_code for response in revalidations}),
+        },
+        'bytes': {
+            'originals': original_bytes,
+            'served': sum(len(response.data) for response in responses),
+        },
+        'cache_control': responses[0].headers.get('Cache-Control'),
+        'import': {
+            'images': len(fresh),
+            'seconds': round(import_seconds, 3),
+            'images_per_second': round(len(fresh) / import_seconds, 2),
+        },
+    }
+    report.write({'meta': report.metadata(images=args.images, size=args.size,
+                                          thumbnail_size=list(images.sizes[args.size]),
+                                          workers=app.config['IMAGE_WORKERS'],
+                                          pillow=Image is not None),
+                  'results': results}, args.out)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,136 @@
+"""
+Request throughput with request logging off and on
+
+Drives --paths round-robin from --concurrency threads with request
+logging off, then on: through the queue and background writer (every
+request, then sampled at --sample-rate), and for comparison written
+synchronously by the file handler in each request thread, as the old
+error.log handler did. The modes take turns for --rounds rounds. Log
+files go to a new temporary directory; the records and bytes written and
+any records dropped for a full queue are reported per mode.
+
+Usage:
+    python -m benchmarks.logging_bench --database-url sqlite:///bench.db --out logging.json
+"""
+
+import argparse
+import os
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+# Cheap pages, where what logging costs per request shows
+PATHS = ('/', '/venues', '/healthz', '/nope')
+MODES = ('off', 'queued', 'sampled', 'synchronous')
+
+
+def _drive(app, paths, requests, concurrency):
+    """
+    Sends `requests` GETs cycling through `paths`, `concurrency` at a time
+
+    Returns:
+        (latencies, elapsed seconds, status codes)
+    """
+    local = threading.local()
+    latencies, statuses = [], set()
+
+    def send(i):
+        if not hasattr(local, 'client'):
+            local.client = app.test_client()
+        t0 = time.perf_counter()
+        response = local.client.get(paths[i % len(paths)])
+        latencies.append(time.perf_counter() - t0)
+        statuses.add(response.status_code)
+
+    t0 = time.perf_counter()
+    with ThreadPoolExecutor(concurrency) as pool:
+        list(pool.map(send, range(requests)))
+    return latencies, time.perf_counter() - t0, sorted(statuses)
+
+
+def _written(directory):
+    records = size = 0
+    for name in os.listdir(directory):
+        with open(os.path.join(directory, name), 'rb') as f:
+            data = f.read()
+        records += data.count(b'\n')
+        size += len(data)
+    return records, size
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--database-url')
+    parser.add_argument('--requests', type=int, default=2000, help='per mode and round')
+    parser.add_argument('--rounds', type=int, default=3)
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--sample-rate', type=float, default=0.1)
+    parser.add_argument('--paths', nargs='*', default=list(PATHS))
+    parser.add_argument('--out', default='-')
+    args = parser.parse_args(argv)
+    if args.database_url:
+        os.environ['DATABASE_URL'] = args.database_url
+    directory = tempfile.mkdtemp(prefix='fyyur_logs_')
+    os.environ.update({'LOG_FILE': os.path.join(directory, 'app.log'), 'RATELIMIT_ENABLED': '0'})
+    os.environ.setdefault('SUGGEST_PRELOAD', '0')
+
+    from app import app
+    from benchmarks import report
+    from metrics import registry
+    from request_log import file_handler, request_log
+
+    logger = request_log.logger
+    queued = request_log.handler
+    dropped = registry.get('log_records_dropped_total')
+    # Warm the caches the way a running server would have them
+    _drive(app, args.paths, args.concurrency * len(args.paths), args.concurrency)
+
+    runs = {mode: {'latencies': [], 'elapsed': 0, 'statuses': set(), 'records': 0, 'bytes': 0,
+                   'dropped': 0} for mode in MODES}
+    for _ in range(args.rounds):
+        for mode in MODES:
+            run = runs[mode]
+            request_log.enabled = mode != 'off'
+            request_log.sample_rate = args.sample_rate if mode == 'sampled' else 1.0
+            if mode == 'synchronous':
+                direct = file_handler(os.path.join(directory, 'sync.log'))
+                direct.filters = queued.filters
+                logger.removeHandler(queued)
+                logger.addHandler(direct)
+            queued.flush()
+            before_records, before_bytes = _written(directory)
+            before_dropped = dropped.value()
+
+            latencies, elapsed, statuses = _drive(app, args.paths, args.requests, args.concurrency)
+            queued.flush()
+            records, size = _written(directory)
+            run['latencies'] += latencies
+            run['elapsed'] += elapsed
+            run['statuses'].update(statuses)
+            run['records'] += records - before_records
+            run['bytes'] += size - before_bytes
+            run['dropped'] += dropped.value() - before_dropped
+            if mode == 'synchronous':
+                logger.removeHandler(direct)
+                direct.close()
+                logger.addHandler(queued)
+    results = {}
+    for mode, run in runs.items():
+        summary = report.summarize(run.pop('latencies'), run.pop('elapsed'))
+        run['statuses'] = sorted(run['statuses'])
+        results[mode] = dict(summary, **run)
+    results['throughput_vs_off'] = {mode: round(results[mode]['throughput_rps']
+                                                / results['off']['throughput_rps'], 3)
+                                    for mode in MODES[1:]}
+
+    report.write({'meta': report.metadata(requests=args.requests, rounds=args.rounds,
+                                          concurrency=args.concurrency,
+                                          sample_rate=args.sample_rate, paths=args.paths,
+                                          queue_size=app.config['LOG_QUEUE_SIZE'],
+                                          database=app.config['SQLALCHEMY_DATABASE_URI'].split(':')[0]),
+                  'results': results}, args.out)
+
+
+if __name__ == '__main__':
+    main()
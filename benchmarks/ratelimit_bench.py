@@ -0,0 +1,107 @@
+"""
+A scraper hammering /artists/search next to regular users
+
+Scraper threads post one-letter search terms as fast as they can from one
+address while user threads browse venue and artist pages and search now
+and then, each from its own address. Runs once with the limiter off and
+once on, and reports the users' latency, the status codes each side got
+and the limiter metrics.
+
+Usage:
+    python -m benchmarks.ratelimit_bench --database-url sqlite:///bench.db --out ratelimit.json
+"""
+
+import argparse
+import collections
+import os
+import random
+import string
+import threading
+import time
+
+
+def _scraper(client, stop, statuses):
+    rng = random.Random()
+    while not stop.is_set():
+        response = client.post('/artists/search', data={'search_term': rng.choice(string.ascii_lowercase)})
+        statuses[response.status_code] += 1
+
+
+def _user(client, dataset, stop, statuses, latencies, seed):
+    rng = random.Random(seed)
+    while not stop.is_set():
+        pick = rng.random()
+        t0 = time.perf_counter()
+        if pick < 0.45:
+            response = client.get(f'/venues/{rng.randint(1, dataset.venues)}')
+        elif pick < 0.9:
+            response = client.get(f'/artists/{rng.randint(1, dataset.artists)}')
+        else:
+            response = client.post('/artists/search', data={'search_term': f'Artist {rng.randint(1, 99)}'})
+        latencies.append(time.perf_counter() - t0)
+        statuses[response.status_code] += 1
+        time.sleep(0.05)
+
+
+def _client(app, address):
+    client = app.test_client()
+    client.environ_base['REMOTE_ADDR'] = address
+    return client
+
+
+def run(app, dataset, scrapers, users, duration):
+    stop = threading.Event()
+    scraper_statuses = collections.Counter()
+    user_statuses = collections.Counter()
+    latencies = []
+    threads = [threading.Thread(target=_scraper, args=(
+        _client(app, '10.0.0.1'), stop, scraper_statuses))
+        for _ in range(scrapers)]
+    threads += [threading.Thread(target=_user, args=(
+        _client(app, f'10.1.0.{i + 1}'),
+        dataset, stop, user_statuses, latencies, i)) for i in range(users)]
+    for thread in threads:
+        thread.start()
+    time.sleep(duration)
+    stop.set()
+    for thread in threads:
+        thread.join()
+    return {'scraper_statuses': dict(scraper_statuses), 'user_statuses': dict(user_statuses),
+            'user_latency': latencies}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--database-url')
+    parser.add_argument('--scrapers', type=int, default=16)
+    parser.add_argument('--users', type=int, default=8)
+    parser.add_argument('--duration', type=float, default=20.0)
+    parser.add_argument('--out', default='-')
+    args = parser.parse_args(argv)
+    if args.database_url:
+        os.environ['DATABASE_URL'] = args.database_url
+    os.environ['RATELIMIT_ENABLED'] = '1'
+
+    from app import app
+    from metrics import registry
+    from ratelimit import limiter
+    from benchmarks import harness, report
+
+    with app.app_context():
+        dataset = harness.Dataset.from_database()
+
+    results = {}
+    for label, enabled in (('limiter_off', False), ('limiter_on', True)):
+        limiter.enabled = enabled
+        result = run(app, dataset, args.scrapers, args.users, args.duration)
+        result['user_latency'] = report.summarize(result['user_latency'], args.duration)
+        results[label] = result
+    results['metrics'] = registry.render().splitlines()
+
+    report.write({'meta': report.metadata(scrapers=args.scrapers, users=args.users,
+                                          duration=args.duration),
+                  'results': results}, args.out)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,135 @@
+"""
+Latency statistics and machine-readable benchmark reports
+"""
+
+import json
+import os
+import platform
+import subprocess
+import sys
+from datetime import datetime, timezone
+
+
+def percentile(samples, pct):
+    """
+    Nearest-rank percentile
+
+    Args:
+        samples: sorted list of numbers
+        pct: percentile between 0 and 100
+
+    Returns:
+        the percentile value, or None for an empty sample
+    """
+    if not samples:
+        return None
+    rank = max(int(round(pct / 100.0 * len(samples) + 0.5)) - 1, 0)
+    return samples[min(rank, len(samples) - 1)]
+
+
+def summarize(latencies, elapsed=None):
+    """
+    Summarizes latencies (in seconds) into milliseconds statistics
+
+    Args:
+        latencies: list of request latencies in seconds
+        elapsed: wall clock seconds the sample took, for throughput
+
+    Returns:
+        dict with count, throughput and p50/p95/p99/max in ms
+    """
+    samples = sorted(latencies)
+    summary = {
+        'count': len(samples),
+        'p50_ms': _ms(percentile(samples, 50)),
+        'p95_ms': _ms(percentile(samples, 95)),
+        'p99_ms': _ms(percentile(samples, 99)),
+        'max_ms': _ms(samples[-1] if samples else None),
+    }
+    if elapsed:
+        summary['throughput_rps'] = round(len(samples) / elapsed, 2)
+    return summary
+
+
+def _ms(seconds):
+    return None if seconds is None else round(seconds * 1000.0, 3)
+
+
+def metadata(**extra):
+    """
+    Describes the environment a run was made in
+
+    Args:
+        extra: additional keys, e.g. the dataset size
+
+    Returns:
+        dict of run metadata
+    """
+    try:
+        revision = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'],
+                                  capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        revision = None
+    meta = {
+        'timestamp': datetime.now(timezone.utc).isoformat(),
+        'git_revision': revision,
+        'python': sys.version.split()[0],
+        'platform': platform.platform(),
+        'cpus': os.cpu_count(),
+    }
+    meta.update(extra)
+    return meta
+
+
+def write(results, path):
+    """
+    Writes results as JSON, or to stdout when path is '-'
+
+    Args:
+        results: JSON-serializable dict
+        path: output file path
+
+    Returns:
+        None
+    """
+    payload = json.dumps(results, indent=2, sort_keys=True, default=str)
+    if path == '-':
+        print(payload)
+        return
+    with open(path, 'w') as f:
+        f.write(payload + '\n')
+
+
+def load(path):
+    with open(path) as f:
+        return json.load(f)
+
+
+def compare(baseline, current, threshold=0.10, metric='p95_ms'):
+    """
+    Compares two runs route by route
+
+    Args:
+        baseline: results dict of the reference run
+        current: results dict of the new run
+        threshold: relative slowdown that counts as a regression
+        metric: latency statistic to compare
+
+    Returns:
+        (rows, regressions): rows of (section, route, old, new, change)
+        and the subset of rows that regressed
+    """
+    rows = []
+    regressions = []
+    for section in ('client', 'http'):
+        old_routes = baseline.get(section, {})
+        for route, stats in sorted(current.get(section, {}).items()):
+            old, new = old_routes.get(route, {}).get(metric), stats.get(metric)
+            if not old or new is None:
+                continue
+            change = (new - old) / old
+            row = (section, route, old, new, change)
+            rows.append(row)
+            if change > threshold:
+                regressions.append(row)
+    return rows, regressions
@@ -0,0 +1,65 @@
+"""
+Report latency computed from scratch, from cache and incrementally
+
+For every report: the first request (computed in full), a repeat (served
+from cache), and a request after --new-shows shows were listed through
+/shows/create (the cached result plus those shows).
+
+Usage:
+    python -m benchmarks.reports_bench --database-url sqlite:///bench.db --out reports.json
+"""
+
+import argparse
+import os
+import time
+from datetime import datetime, timedelta
+
+
+def _timed(client, path):
+    t0 = time.perf_counter()
+    response = client.get(path)
+    return time.perf_counter() - t0, response.get_json()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--database-url')
+    parser.add_argument('--new-shows', type=int, default=20)
+    parser.add_argument('--out', default='-')
+    args = parser.parse_args(argv)
+    if args.database_url:
+        os.environ['DATABASE_URL'] = args.database_url
+    os.environ['RATELIMIT_ENABLED'] = '0'
+    os.environ.setdefault('SUGGEST_PRELOAD', '0')
+
+    from app import app
+    from benchmarks import report
+    from models import db, Artist, Venue
+    import reports
+
+    with app.app_context():
+        venue_id = db.session.query(Venue.id).first()[0]
+        artist_id = db.session.query(Artist.id).first()[0]
+        db.session.remove()
+
+    client = app.test_client()
+    results = {}
+    for name in reports.REPORTS:
+        path = f'/reports/{name}?format=json'
+        full, _ = _timed(client, path)
+        cached, _ = _timed(client, path)
+        start = datetime.now() + timedelta(days=7)
+        for i in range(args.new_shows):
+            client.post('/shows/create', data={'artist_id': artist_id, 'venue_id': venue_id,
+                                               'start_time': (start + timedelta(hours=i)).isoformat()})
+        incremental, body = _timed(client, path)
+        results[name] = {'full_ms': round(full * 1000, 3), 'cached_ms': round(cached * 1000, 3),
+                         'incremental_ms': round(incremental * 1000, 3), 'served': body['served']}
+
+    report.write({'meta': report.metadata(new_shows=args.new_shows, numpy=reports.np is not None,
+                                          chunk_size=app.config['REPORT_CHUNK_SIZE']),
+                  'results': results}, args.out)
+
+
+if __name__ == '__main__':
+    main()
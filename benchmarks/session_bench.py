@@ -0,0 +1,93 @@
+"""
+Per-request cost of each session store
+
+Runs the same three requests against signed cookie sessions (Flask's
+default) and every server-side store: a request that never touches the
+session (/healthz with a session cookie), a page that reads the flashes
+('/') and a request that writes a flash. Each client keeps a session with
+a CSRF token and a few flashes' worth of data, so reads and writes move
+realistic payloads.
+
+Usage:
+    python -m benchmarks.session_bench --database-url sqlite:///bench.db --out sessions.json
+    python -m benchmarks.session_bench --redis-url redis://localhost:6379/15
+"""
+
+import argparse
+import os
+import time
+
+
+def _timed(client, path, requests):
+    latencies = []
+    for _ in range(requests):
+        t0 = time.perf_counter()
+        client.get(path)
+        latencies.append(time.perf_counter() - t0)
+    return latencies
+
+
+def run(app, requests):
+    client = app.test_client()
+    # Give the client a session to carry
+    client.get('/bench/flash')
+    results = {}
+    for label, path in (('untouched', '/healthz'), ('read_flashes', '/'), ('write_flash', '/bench/flash')):
+        client.get('/bench/flash')
+        _timed(client, path, 20)
+        results[label] = _timed(client, path, requests)
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--database-url')
+    parser.add_argument('--redis-url', help='also measure a real Redis server')
+    parser.add_argument('--requests', type=int, default=2000)
+    parser.add_argument('--out', default='-')
+    args = parser.parse_args(argv)
+    if args.database_url:
+        os.environ['DATABASE_URL'] = args.database_url
+    os.environ['RATELIMIT_ENABLED'] = '0'
+    os.environ.setdefault('SUGGEST_PRELOAD', '0')
+
+    from flask import flash, get_flashed_messages, session
+    from flask.sessions import SecureCookieSessionInterface
+
+    from app import app
+    from benchmarks import report
+    from models import db
+    from sessions import ServerSessionInterface, create_store
+
+    @app.route('/bench/flash')
+    def bench_flash():
+        session.setdefault('csrf_token', os.urandom(20).hex())
+        # One pending flash at a time, so the session doesn't grow
+        get_flashed_messages()
+        flash('Venue Bench Venue was successfully listed!')
+        return 'ok'
+
+    with app.app_context():
+        db.create_all()
+
+    urls = ['memory://', 'sql://', 'redis+local://']
+    if args.redis_url:
+        urls.append(args.redis_url)
+    interfaces = {'cookie': SecureCookieSessionInterface()}
+    for url in urls:
+        interfaces[url] = ServerSessionInterface(create_store(url, app), app.config['SESSION_LIFETIME'])
+
+    results = {}
+    for label, interface in interfaces.items():
+        app.session_interface = interface
+        with app.app_context():
+            latencies = run(app, args.requests)
+        results[label] = {case: report.summarize(samples) for case, samples in latencies.items()}
+
+    report.write({'meta': report.metadata(requests=args.requests,
+                                          database=app.config['SQLALCHEMY_DATABASE_URI'].split(':')[0]),
+                  'results': results}, args.out)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,130 @@
+"""
+Listing pages from snapshots against querying per request
+
+Drives /venues, /artists and /shows (with and without filters) from
+--concurrency threads, first querying the database per request as usual,
+then from the in-memory snapshots. Also times building each snapshot, and
+how long a committed write takes to show on /venues (the refresher picks
+it up from the change log). /shows renders every show, so seed a dataset
+whose show count suits --requests.
+
+Usage:
+    python -m benchmarks.snapshot_bench --database-url sqlite:///bench.db --out snapshots.json
+"""
+
+import argparse
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+PATHS = ('/venues', '/venues?page=2', '/venues?state=NY&upcoming=1', '/artists',
+         '/artists?genre=Jazz', '/shows')
+
+
+def _drive(app, path, requests, concurrency):
+    """
+    Sends `requests` GETs of `path`, `concurrency` at a time
+
+    Returns:
+        (latencies, elapsed seconds, status codes, largest staleness header)
+    """
+    local = threading.local()
+    latencies, statuses, staleness = [], set(), []
+
+    def send(_):
+        if not hasattr(local, 'client'):
+            local.client = app.test_client()
+        t0 = time.perf_counter()
+        response = local.client.get(path)
+        latencies.append(time.perf_counter() - t0)
+        statuses.add(response.status_code)
+        if 'X-Snapshot-Staleness' in response.headers:
+            staleness.append(float(response.headers['X-Snapshot-Staleness']))
+
+    t0 = time.perf_counter()
+    with ThreadPoolExecutor(concurrency) as pool:
+        list(pool.map(send, range(requests)))
+    return latencies, time.perf_counter() - t0, sorted(statuses), max(staleness, default=None)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--database-url')
+    parser.add_argument('--requests', type=int, default=200)
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--writes', type=int, default=5)
+    parser.add_argument('--paths', nargs='*', default=list(PATHS))
+    parser.add_argument('--out', default='-')
+    args = parser.parse_args(argv)
+    if args.database_url:
+        os.environ['DATABASE_URL'] = args.database_url
+    os.environ.update({'SNAPSHOT_ENABLED': '1', 'RATELIMIT_ENABLED': '0'})
+    os.environ.setdefault('SUGGEST_PRELOAD', '0')
+
+    from markupsafe import escape
+
+    from app import app
+    from benchmarks import report
+    from cache import cache
+    import events
+    from models import db, Venue
+    from snapshots import snapshots
+
+    results = {'direct': {}, 'snapshot': {}}
+    for mode in results:
+        snapshots.enabled = mode == 'snapshot'
+        for path in args.paths:
+            _drive(app, path, args.concurrency, args.concurrency)
+            latencies, elapsed, statuses, staleness = _drive(app, path, args.requests, args.concurrency)
+            results[mode][path] = dict(report.summarize(latencies, elapsed), statuses=statuses)
+            if staleness is not None:
+                results[mode][path]['max_staleness_s'] = staleness
+    results['speedup'] = {path: round(results['snapshot'][path]['throughput_rps']
+                                      / results['direct'][path]['throughput_rps'], 2)
+                          for path in args.paths}
+
+    builds = {}
+    with app.app_context():
+        for listing in ('venues', 'artists', 'shows'):
+            t0 = time.perf_counter()
+            snapshot, _ = snapshots.refresh(listing, 'benchmark')
+            builds[listing] = {'rows': len(snapshot.rows), 'seconds': round(time.perf_counter() - t0, 3)}
+    results['builds'] = builds
+
+    # Rename a venue and wait for /venues to list the new name; it sorts
+    # first, on the first page of its city
+    lags = []
+    client = app.test_client()
+    with app.app_context():
+        venue = Venue.live().order_by(Venue.id).first()
+        venue_id, name, path = venue.id, venue.name, f'/venues?state={venue.state}&city={venue.city}'
+    def rename(to):
+        # as the edit route does
+        with app.app_context():
+            db.session.get(Venue, venue_id).name = to
+            events.record('venue', venue_id, 'updated', {'name': to})
+            db.session.commit()
+            cache.bump_version('venue', venue_id)
+
+    for i in range(args.writes):
+        renamed = f'{i:03d} {name}'
+        rename(renamed)
+        t0 = time.perf_counter()
+        while str(escape(renamed)) not in client.get(path).get_data(as_text=True):
+            if time.perf_counter() - t0 > 60:
+                raise RuntimeError('the write did not show on /venues within 60 s')
+            time.sleep(0.005)
+        lags.append(time.perf_counter() - t0)
+    rename(name)
+    results['write_to_visible'] = report.summarize(lags)
+    snapshots.stop()
+
+    report.write({'meta': report.metadata(requests=args.requests, concurrency=args.concurrency,
+                                          check_interval=app.config['SNAPSHOT_CHECK_INTERVAL'],
+                                          database=app.config['SQLALCHEMY_DATABASE_URI'].split(':')[0]),
+                  'results': results}, args.out)
+
+
+if __name__ == '__main__':
+    main()
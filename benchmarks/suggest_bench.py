@@ -0,0 +1,100 @@
+"""
+Typeahead index benchmark: rebuild time, memory and lookup latency of the
+PrefixIndex behind /suggest
+
+Names are made of two or three words drawn from small vocabularies, so
+prefixes match long runs of entries as real names do.
+
+Usage:
+    python -m benchmarks.suggest_bench --names 1000000 --out suggest.json
+"""
+
+import argparse
+import random
+import time
+import tracemalloc
+
+from benchmarks import report
+from benchmarks.datagen import CITIES, GENRES
+from suggest import PrefixIndex
+
+WORDS = (
+    'Blue', 'Red', 'Golden', 'Silver', 'Electric', 'Velvet', 'Midnight',
+    'Rusty', 'Lucky', 'Wild', 'Little', 'Big', 'Old', 'New', 'Royal', 'Lost',
+    'Broken', 'Crystal', 'Dueling', 'Hidden', 'Howling', 'Neon', 'Paper',
+    'Iron', 'Stone', 'Cosmic', 'Black', 'White', 'Green', 'Sunset',
+)
+NOUNS = (
+    'Pianos', 'Room', 'Lounge', 'Hall', 'Tavern', 'Garden', 'Theatre', 'Club',
+    'Kings', 'Wolves', 'Riders', 'Sisters', 'Brothers', 'Collective', 'Band',
+    'Orchestra', 'Trio', 'Quartet', 'Owls', 'Foxes', 'Saints', 'Rebels',
+    'Lights', 'Echoes', 'Strings', 'Horns', 'Drums', 'Engine', 'Factory',
+    'Cellar',
+) + GENRES
+
+
+def entries(count, rng):
+    places = [f'{city}, {state}' for city, state in CITIES]
+    for entity_id in range(1, count + 1):
+        kind = 'venue' if entity_id % 5 == 0 else 'artist'
+        words = rng.sample(WORDS, rng.randint(1, 2)) + [rng.choice(NOUNS)]
+        yield kind, entity_id, f"{' '.join(words)} {entity_id}", rng.choice(places)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--names', type=int, default=1000000)
+    parser.add_argument('--queries', type=int, default=2000)
+    parser.add_argument('--updates', type=int, default=200)
+    parser.add_argument('--out', default='-')
+    args = parser.parse_args(argv)
+
+    rows = list(entries(args.names, random.Random(11)))
+    index = PrefixIndex()
+    started = time.perf_counter()
+    index.load(rows)
+    rebuild_seconds = time.perf_counter() - started
+
+    # measured on a second build, tracing slows the build down a lot
+    del index
+    tracemalloc.start()
+    index = PrefixIndex()
+    index.load(rows)
+    memory_mb = tracemalloc.get_traced_memory()[0] / 2 ** 20
+    tracemalloc.stop()
+
+    rng = random.Random(5)
+    prefixes = {
+        'one_letter': lambda: rng.choice(WORDS)[:1],
+        'three_letters': lambda: rng.choice(WORDS + NOUNS)[:3],
+        'word_and_letter': lambda: f'{rng.choice(WORDS)} {rng.choice(NOUNS)[:1]}',
+        'no_match': lambda: 'zzq',
+    }
+    results = {}
+    for name, prefix in prefixes.items():
+        latencies = []
+        for _ in range(args.queries):
+            q = prefix()
+            t0 = time.perf_counter()
+            index.search(q, limit=10)
+            latencies.append(time.perf_counter() - t0)
+        results[name] = report.summarize(latencies)
+
+    latencies = []
+    for kind, entity_id, text, label in entries(args.updates, rng):
+        t0 = time.perf_counter()
+        index.add(kind, args.names + entity_id, text, label)
+        latencies.append(time.perf_counter() - t0)
+    results['incremental_add'] = report.summarize(latencies)
+
+    report.write({
+        'meta': report.metadata(names=args.names),
+        'keys': len(index._keys),
+        'rebuild_seconds': round(rebuild_seconds, 2),
+        'index_memory_mb': round(memory_mb, 1),
+        'queries': results,
+    }, args.out)
+
+
+if __name__ == '__main__':
+    main()
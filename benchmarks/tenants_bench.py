@@ -0,0 +1,188 @@
+"""
+Hundreds of tenants served by one server
+
+Provisions --tenants tenants with a small dataset each (database files
+under --dir on SQLite, schemas on PostgreSQL), starts `serve.py run` with
+multi-tenancy on and requests a few pages of every tenant once (cold: each
+tenant's database, cache entries and indexes are set up on first use),
+then --requests pages of random tenants (warm). The same server is then
+measured serving a single tenant, i.e. what each promoter's separate copy
+of the app would take. Memory is the resident set of the whole process
+group, master and workers.
+
+Usage:
+    python -m benchmarks.tenants_bench --out tenants.json
+    python -m benchmarks.tenants_bench --database-url postgresql://localhost/fyyur_bench --tenants 500
+"""
+
+import argparse
+import http.client
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+
+basedir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DOMAIN = 'bench.test'
+PAGES = ('/', '/venues', '/artists', '/venues/1', '/artists/1', '/shows/calendar',
+         '/suggest?q=ve&type=venue')
+
+
+def _rss_kb(pid):
+    with open(f'/proc/{pid}/status') as f:
+        for line in f:
+            if line.startswith('VmRSS:'):
+                return int(line.split()[1])
+
+
+def _group_rss_kb(pid):
+    with open(f'/proc/{pid}/task/{pid}/children') as f:
+        children = [int(child) for child in f.read().split()]
+    return _rss_kb(pid) + sum(_rss_kb(child) for child in children)
+
+
+def _wait_up(port, timeout=60):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            connection = http.client.HTTPConnection('127.0.0.1', port, timeout=1)
+            connection.request('GET', '/healthz')
+            if connection.getresponse().status == 200:
+                return
+        except OSError:
+            time.sleep(0.2)
+    raise RuntimeError('the server did not start')
+
+
+def _drive(port, requests, concurrency):
+    """
+    Sends (tenant, path) requests, `concurrency` at a time
+
+    Returns:
+        (latencies, Counter of status codes)
+    """
+    latencies, statuses = [], Counter()
+    local = threading.local()
+
+    def send(request):
+        tenant, path = request
+        if not hasattr(local, 'connection'):
+            local.connection = http.client.HTTPConnection('127.0.0.1', port, timeout=30)
+        t0 = time.perf_counter()
+        local.connection.request('GET', path, headers={'Host': f'{tenant}.{DOMAIN}'})
+        response = local.connection.getresponse()
+        response.read()
+        latencies.append(time.perf_counter() - t0)
+        statuses[response.status] += 1
+
+    with ThreadPoolExecutor(concurrency) as pool:
+        list(pool.map(send, requests))
+    return latencies, statuses
+
+
+def run(args, env, tenants):
+    """
+    Starts a server, warms every tenant in `tenants` and drives random traffic
+
+    Returns:
+        dict of memory and latency figures
+    """
+    from benchmarks import report
+
+    server = subprocess.Popen(
+        [sys.executable, 'serve.py', 'run', '--bind', f'127.0.0.1:{args.port}',
+         '--workers', str(args.workers), '--pidfile', os.path.join(args.dir, 'serve.pid')],
+        cwd=basedir, env=env, stderr=subprocess.DEVNULL)
+    try:
+        _wait_up(args.port)
+        idle_kb = _group_rss_kb(server.pid)
+        cold, cold_statuses = _drive(args.port, [(tenant, path) for tenant in tenants for path in PAGES],
+                                     args.concurrency)
+        cold_kb = _group_rss_kb(server.pid)
+        rng = random.Random(len(tenants))
+        warm, warm_statuses = _drive(args.port, [(rng.choice(tenants), rng.choice(PAGES))
+                                                 for _ in range(args.requests)], args.concurrency)
+        warm_kb = _group_rss_kb(server.pid)
+    finally:
+        server.terminate()
+        server.wait()
+    return {
+        'tenants': len(tenants),
+        'rss_kb': {'idle': idle_kb, 'after_cold': cold_kb, 'after_warm': warm_kb},
+        'cold': report.summarize(cold),
+        'warm': report.summarize(warm),
+        'statuses': dict(cold_statuses + warm_statuses),
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--database-url', help='PostgreSQL server; SQLite files under --dir otherwise')
+    parser.add_argument('--dir', default=os.path.join(tempfile.gettempdir(), 'fyyur_tenant_bench'))
+    parser.add_argument('--tenants', type=int, default=500)
+    parser.add_argument('--venues', type=int, default=20)
+    parser.add_argument('--artists', type=int, default=50)
+    parser.add_argument('--shows', type=int, default=500)
+    parser.add_argument('--requests', type=int, default=5000)
+    parser.add_argument('--concurrency', type=int, default=16)
+    parser.add_argument('--workers', type=int, default=2)
+    parser.add_argument('--port', type=int, default=8766)
+    parser.add_argument('--out', default='-')
+    args = parser.parse_args(argv)
+    os.makedirs(args.dir, exist_ok=True)
+    os.environ.update({
+        'DATABASE_URL': args.database_url or f'sqlite:///{os.path.join(args.dir, "default.db")}',
+        'TENANCY_ENABLED': '1',
+        'TENANT_DOMAIN': DOMAIN,
+        'TENANT_SQLITE_DIR': os.path.join(args.dir, 'tenants'),
+        'RATELIMIT_ENABLED': '0',
+        'SUGGEST_PRELOAD': '0',
+    })
+    os.environ.setdefault('SECRET_KEY', os.urandom(16).hex())
+
+    from app import app
+    from benchmarks import datagen, report
+    from models import db
+    from tenants import tenancy, use_tenant
+
+    with app.app_context():
+        db.create_all()
+    tenants = [f't{i:04d}' for i in range(args.tenants)]
+    existing = set(tenancy.discover())
+    t0 = time.perf_counter()
+    for i, tenant in enumerate(tenants):
+        if tenant in existing:
+            continue
+        tenancy.create(tenant)
+        with use_tenant(tenant), app.app_context():
+            datagen.seed(cities=10, venues=args.venues, artists=args.artists, shows=args.shows,
+                         seed=i, reset=False)
+    provision_seconds = time.perf_counter() - t0
+
+    results = {
+        'multi_tenant': run(args, os.environ.copy(), tenants),
+        'single_tenant': run(args, os.environ.copy(), tenants[:1]),
+    }
+    multi, single = results['multi_tenant']['rss_kb'], results['single_tenant']['rss_kb']
+    results['memory'] = {
+        'shared_kb': multi['after_warm'],
+        # One copy of the app per promoter, as before multi-tenancy
+        'separate_deployments_kb': single['after_warm'] * args.tenants,
+        'per_extra_tenant_kb': round((multi['after_warm'] - single['after_warm'])
+                                     / max(args.tenants - 1, 1), 2),
+    }
+
+    report.write({'meta': report.metadata(tenants=args.tenants, workers=args.workers,
+                                          concurrency=args.concurrency, requests=args.requests,
+                                          provision_seconds=round(provision_seconds, 3),
+                                          database=app.config['SQLALCHEMY_DATABASE_URI'].split(':')[0]),
+                  'results': results}, args.out)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,122 @@
+"""
+Thousands of buyers racing for the tickets of one show
+
+Opens a new show with --seats tickets, then lets --buyers buyers loose on
+it, --concurrency at a time, all released together. Each buyer holds one
+to --max-quantity tickets and purchases them, except for a share of
+--abandon who walk away and leave their hold to expire. Runs once with the
+tickets in TICKET_SHARDS counter rows and once in a single row, and
+checks afterwards that no ticket was sold or held twice.
+
+Usage:
+    python -m benchmarks.tickets_bench --database-url postgresql://localhost/fyyur_bench --out tickets.json
+"""
+
+import argparse
+import collections
+import os
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+
+
+def _buyer(client, show_id, rng, max_quantity, abandon, start, statuses, latencies):
+    start.wait()
+    quantity = rng.randint(1, max_quantity)
+    t0 = time.perf_counter()
+    response = client.post(f'/shows/{show_id}/holds', json={'quantity': quantity})
+    latencies['hold'].append(time.perf_counter() - t0)
+    statuses['hold', response.status_code] += 1
+    if response.status_code != 201 or rng.random() < abandon:
+        return
+    t0 = time.perf_counter()
+    response = client.post(f'/holds/{response.get_json()["hold"]}/purchase')
+    latencies['purchase'].append(time.perf_counter() - t0)
+    statuses['purchase', response.status_code] += 1
+
+
+def run(app, show_id, args, seed):
+    rng = random.Random(seed)
+    statuses = collections.Counter()
+    latencies = {'hold': [], 'purchase': []}
+    start = threading.Event()
+    with ThreadPoolExecutor(args.concurrency) as pool:
+        futures = [pool.submit(_buyer, app.test_client(), show_id, random.Random(rng.random()),
+                               args.max_quantity, args.abandon, start, statuses, latencies)
+                   for _ in range(args.buyers)]
+        t0 = time.perf_counter()
+        start.set()
+        for future in futures:
+            future.result()
+        elapsed = time.perf_counter() - t0
+    return statuses, latencies, elapsed
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--database-url')
+    parser.add_argument('--seats', type=int, default=500)
+    parser.add_argument('--buyers', type=int, default=5000)
+    parser.add_argument('--concurrency', type=int, default=500)
+    parser.add_argument('--max-quantity', type=int, default=4)
+    parser.add_argument('--abandon', type=float, default=0.2)
+    parser.add_argument('--out', default='-')
+    args = parser.parse_args(argv)
+    if args.database_url:
+        os.environ['DATABASE_URL'] = args.database_url
+    os.environ['RATELIMIT_ENABLED'] = '0'
+    os.environ.setdefault('SUGGEST_PRELOAD', '0')
+
+    from sqlalchemy import func, select
+
+    from app import app
+    from benchmarks import report
+    from models import db, Artist, Show, TicketHold, TicketShard, Venue
+    import tickets
+
+    results = {}
+    for label, shards in (('sharded', app.config['TICKET_SHARDS']), ('single_row', 1)):
+        with app.app_context():
+            db.create_all()
+            show = Show(venue_id=db.session.query(Venue.id).first()[0],
+                        artist_id=db.session.query(Artist.id).first()[0],
+                        start_time=datetime.now() + timedelta(days=30))
+            db.session.add(show)
+            db.session.flush()
+            tickets.open_sales(show.id, args.seats, shards)
+            db.session.commit()
+            show_id = show.id
+
+        statuses, latencies, elapsed = run(app, show_id, args, seed=len(results))
+
+        with app.app_context():
+            remaining = db.session.execute(
+                select(func.sum(TicketShard.remaining)).where(TicketShard.show_id == show_id)).scalar()
+            taken = dict(db.session.execute(
+                select(TicketHold.status, func.sum(TicketHold.quantity))
+                .where(TicketHold.show_id == show_id).group_by(TicketHold.status)).all())
+            db.session.remove()
+        held, sold = taken.get('held', 0), taken.get('purchased', 0)
+        requests = sum(statuses.values())
+        results[label] = {
+            'shards': shards,
+            'elapsed_seconds': round(elapsed, 3),
+            'throughput_rps': round(requests / elapsed, 2),
+            'statuses': {f'{kind} {status}': count for (kind, status), count in sorted(statuses.items())},
+            'hold_latency': report.summarize(latencies['hold']),
+            'purchase_latency': report.summarize(latencies['purchase']),
+            'tickets': {'capacity': args.seats, 'sold': sold, 'held': held, 'remaining': remaining},
+            # Every ticket is either still for sale, held or sold, once
+            'oversold': sold + held > args.seats or sold + held + remaining != args.seats,
+        }
+
+    report.write({'meta': report.metadata(seats=args.seats, buyers=args.buyers,
+                                          concurrency=args.concurrency,
+                                          database=app.config['SQLALCHEMY_DATABASE_URI'].split(':')[0]),
+                  'results': results}, args.out)
+
+
+if __name__ == '__main__':
+    main()
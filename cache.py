@@ -0,0 +1,336 @@
+#----------------------------------------------------------------------------#
+# Imports
+#----------------------------------------------------------------------------#
+
+import os
+import threading
+import time
+from collections import OrderedDict
+
+from jinja2 import FileSystemBytecodeCache, nodes
+from jinja2.ext import Extension
+from markupsafe import Markup
+
+import events
+from request_log import note_cache_lookup
+from tenants import current_tenant, tenant_local
+
+#----------------------------------------------------------------------------#
+# Cache backends.
+#----------------------------------------------------------------------------#
+
+class SimpleCache:
+    """
+    Thread-safe in-process cache with per-entry expiry and LRU eviction
+
+    Args:
+        max_entries: entries kept before the least recently used are evicted
+        default_timeout: seconds an entry lives when set() is given no timeout
+
+    Returns:
+        None
+    """
+
+    def __init__(self, max_entries=10000, default_timeout=300):
+        self.max_entries = max_entries
+        self.default_timeout = default_timeout
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or (entry[0] is not None and entry[0] < time.monotonic()):
+                if entry is not None:
+                    del self._entries[key]
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def set(self, key, value, timeout=None):
+        """
+        Stores a value
+
+        Args:
+            key: cache key
+            value: any object, stored by reference
+            timeout: seconds to live, 0 for no expiry, None for the default
+
+        Returns:
+            None
+        """
+        if timeout is None:
+            timeout = self.default_timeout
+        expires = time.monotonic() + timeout if timeout else None
+        with self._lock:
+            self._entries[key] = (expires, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def incr(self, key):
+        with self._lock:
+            expires, value = self._entries.get(key, (None, 0))
+            self._entries[key] = (expires, value + 1)
+            return value + 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+class NullCache:
+    """
+    Cache backend that stores nothing, for disabling caching
+
+    Args:
+        None
+
+    Returns:
+        None
+    """
+    hits = 0
+    misses = 0
+
+    def get(self, key):
+        return None
+
+    def set(self, key, value, timeout=None):
+        pass
+
+    def delete(self, key):
+        pass
+
+    def incr(self, key):
+        return 1
+
+    def clear(self):
+        pass
+
+
+BACKENDS = {
+    'simple': SimpleCache,
+    'null': NullCache,
+}
+
+#----------------------------------------------------------------------------#
+# App cache.
+#----------------------------------------------------------------------------#
+
+class Cache:
+    """
+    The app's cache, backed by the backend named in CACHE_TYPE
+
+    Entity versions let cached fragments be keyed by the version of the
+    venue or artist they render, so an edit invalidates every fragment of
+    that entity at once without tracking the individual keys. Versions
+    live in each process's own cache, so the writes of other processes are
+    read from the change log every CACHE_SYNC_INTERVAL seconds and bump
+    them here too.
+
+    Args:
+        None
+
+    Returns:
+        None
+    """
+    # Change log id whose venue and artist writes the versions include
+    _cursor = tenant_local()
+
+    def __init__(self):
+        self.backend = NullCache()
+        self._follower = None
+
+    def init_app(self, app):
+        """
+        Configures the backend, fragment caching and template bytecode caching
+
+        Args:
+            app: Flask app
+
+        Returns:
+            None
+        """
+        backend = BACKENDS[app.config.get('CACHE_TYPE', 'simple')]
+        if backend is SimpleCache:
+            self.backend = SimpleCache(
+                max_entries=app.config.get('CACHE_MAX_ENTRIES', 10000),
+                default_timeout=app.config.get('CACHE_DEFAULT_TIMEOUT', 300))
+        else:
+            self.backend = backend()
+        app.extensions['cache'] = self
+        if backend is SimpleCache:
+            self._follower = events.Follower(app, 'cache-versions', self.sync_versions,
+                                             app.config.get('CACHE_SYNC_INTERVAL', 1.0))
+            app.before_request(self.before_request)
+
+        app.jinja_env.add_extension(FragmentCacheExtension)
+        app.jinja_env.extend(
+            fragment_cache=self,
+            fragment_cache_timeout=app.config.get('FRAGMENT_CACHE_TIMEOUT', 300))
+        app.jinja_env.globals['fragment_version'] = self.entity_version
+
+        bytecode_dir = app.config.get('TEMPLATE_BYTECODE_CACHE_DIR')
+        if bytecode_dir:
+            app.jinja_env.bytecode_cache = FileSystemBytecodeCache(_ensure_dir(bytecode_dir))
+
+    @staticmethod
+    def _key(key):
+        # Every tenant has its own keys, so one's pages and results never
+        # show up on another's
+        tenant = current_tenant()
+        return key if tenant is None else f'{tenant}/{key}'
+
+    def get(self, key):
+        value = self.backend.get(self._key(key))
+        note_cache_lookup(value is not None)
+        return value
+
+    def set(self, key, value, timeout=None):
+        self.backend.set(self._key(key), value, timeout)
+
+    def delete(self, key):
+        self.backend.delete(self._key(key))
+
+    def clear(self):
+        self.backend.clear()
+
+    def entity_version(self, kind, entity_id):
+        """
+        Current cache version of an entity, used in fragment keys
+
+        Args:
+            kind: 'venue' or 'artist'
+            entity_id: id of the entity
+
+        Returns:
+            version number, 0 until the entity is first changed
+        """
+        return self.backend.get(self._key(f'version:{kind}:{entity_id}')) or 0
+
+    def bump_version(self, kind, entity_id):
+        """
+        Invalidates every cached fragment of an entity
+
+        Args:
+            kind: 'venue' or 'artist'
+            entity_id: id of the entity
+
+        Returns:
+            the new version number
+        """
+        return self.backend.incr(self._key(f'version:{kind}:{entity_id}'))
+
+    def before_request(self):
+        if self._cursor is None:
+            # Before the tenant's first fragment is cached, so no write
+            # made after it was rendered is missed
+            self._cursor = events.latest_id()
+        self._follower.start()
+
+    def sync_versions(self):
+        """
+        Bumps the versions of the venues and artists written since the cursor
+
+        Writes made by this process are bumped a second time, which only
+        costs their fragments one more render.
+
+        Must be called inside an application context.
+
+        Args:
+            None
+
+        Returns:
+            number of change log entries applied
+        """
+        latest = events.latest_id()
+        applied = 0
+        while self._cursor != latest:
+            entries = events.fetch_since(self._cursor, 1000, ('venue', 'artist'), latest)
+            for entry in entries:
+                self.bump_version(entry['entity'], entry['entity_id'])
+            applied += len(entries)
+            self._cursor = entries[-1]['id'] if len(entries) == 1000 else latest
+        return applied
+
+
+def _ensure_dir(path):
+    os.makedirs(path, exist_ok=True)
+    return path
+
+
+def precompile_templates(app):
+    """
+    Compiles every template up front, filling the bytecode cache
+
+    Workers started afterwards load bytecode from disk instead of parsing
+    and compiling each template on its first request. Call it once every
+    filter the templates use is registered.
+
+    Args:
+        app: Flask app
+
+    Returns:
+        number of compiled templates
+    """
+    compiled = 0
+    for name in app.jinja_env.list_templates(filter_func=lambda name: name.endswith('.html')):
+        app.jinja_env.get_template(name)
+        compiled += 1
+    return compiled
+
+#----------------------------------------------------------------------------#
+# Fragment caching.
+#----------------------------------------------------------------------------#
+
+class FragmentCacheExtension(Extension):
+    """
+    Adds the {% cache key, ttl %}...{% endcache %} block tag
+
+    The key is any expression (a list of parts is joined), the optional ttl
+    defaults to FRAGMENT_CACHE_TIMEOUT. The rendered body is stored in the
+    app cache and reused for every later render with the same key.
+
+    Args:
+        environment: Jinja environment
+
+    Returns:
+        None
+    """
+    tags = {'cache'}
+
+    def parse(self, parser):
+        lineno = next(parser.stream).lineno
+        args = [parser.parse_expression()]
+        if parser.stream.skip_if('comma'):
+            args.append(parser.parse_expression())
+        else:
+            args.append(nodes.Const(None))
+        body = parser.parse_statements(['name:endcache'], drop_needle=True)
+        return nodes.CallBlock(
+            self.call_method('_render_cached', args), [], [], body).set_lineno(lineno)
+
+    def _render_cached(self, key, timeout, caller):
+        cache = getattr(self.environment, 'fragment_cache', None)
+        if cache is None:
+            return caller()
+        if isinstance(key, (list, tuple)):
+            key = ':'.join(str(part) for part in key)
+        key = f'fragment:{key}'
+        rendered = cache.get(key)
+        if rendered is None:
+            rendered = caller()
+            cache.set(key, rendered, self.environment.fragment_cache_timeout
+                      if timeout is None else timeout)
+        return Markup(rendered)
+
+
+cache = Cache()
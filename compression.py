@@ -0,0 +1,210 @@
+#----------------------------------------------------------------------------#
+# Imports
+#----------------------------------------------------------------------------#
+
+import gzip
+import hashlib
+import zlib
+
+from flask import request
+
+try:
+    import brotli
+except ImportError:  # optional, see requirements.txt
+    brotli = None
+
+try:
+    import zstandard
+except ImportError:  # optional
+    zstandard = None
+
+#----------------------------------------------------------------------------#
+# Codecs.
+#----------------------------------------------------------------------------#
+
+class GzipCodec:
+    """
+    gzip, always available
+
+    Args:
+        level: zlib compression level
+
+    Returns:
+        None
+    """
+    name = 'gzip'
+
+    def __init__(self, level=6):
+        self.level = level
+
+    def compress(self, data):
+        return gzip.compress(data, compresslevel=self.level, mtime=0)
+
+    def stream(self, chunks):
+        compressor = zlib.compressobj(self.level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        for chunk in chunks:
+            # a sync flush per chunk lets the client render it right away
+            yield compressor.compress(chunk) + compressor.flush(zlib.Z_SYNC_FLUSH)
+        yield compressor.flush()
+
+
+class BrotliCodec:
+    """
+    Brotli, when the brotli package is installed
+
+    Args:
+        quality: 0-11, dynamic responses want something around 4-5
+
+    Returns:
+        None
+    """
+    name = 'br'
+
+    def __init__(self, quality=5):
+        self.quality = quality
+
+    def compress(self, data):
+        return brotli.compress(data, quality=self.quality)
+
+    def stream(self, chunks):
+        compressor = brotli.Compressor(quality=self.quality)
+        for chunk in chunks:
+            yield compressor.process(chunk) + compressor.flush()
+        yield compressor.finish()
+
+
+class ZstdCodec:
+    """
+    Zstandard, when the zstandard package is installed
+
+    Args:
+        level: zstd compression level
+
+    Returns:
+        None
+    """
+    name = 'zstd'
+
+    def __init__(self, level=3):
+        self.level = level
+
+    def compress(self, data):
+        return zstandard.ZstdCompressor(level=self.level).compress(data)
+
+    def stream(self, chunks):
+        compressor = zstandard.ZstdCompressor(level=self.level).compressobj()
+        for chunk in chunks:
+            yield compressor.compress(chunk) + compressor.flush(zstandard.COMPRESSOBJ_FLUSH_BLOCK)
+        yield compressor.flush()
+
+
+def available_codecs(config):
+    """
+    Codecs usable in this environment, in server preference order
+
+    Args:
+        config: app config
+
+    Returns:
+        dict of encoding name -> codec
+    """
+    codecs = {
+        'br': BrotliCodec(config.get('COMPRESS_BR_QUALITY', 5)) if brotli else None,
+        'zstd': ZstdCodec(config.get('COMPRESS_ZSTD_LEVEL', 3)) if zstandard else None,
+        'gzip': GzipCodec(config.get('COMPRESS_GZIP_LEVEL', 6)),
+    }
+    return {name: codecs[name] for name in config.get('COMPRESS_ALGORITHMS', ['br', 'zstd', 'gzip'])
+            if codecs.get(name)}
+
+#----------------------------------------------------------------------------#
+# Response compression.
+#----------------------------------------------------------------------------#
+
+class Compressor:
+    """
+    Compresses responses with the best encoding the client accepts
+
+    Buffered responses over COMPRESS_MIN_SIZE are compressed whole; their
+    compressed bytes are kept in the app cache keyed by a digest of the
+    body, so a page served again with identical content (e.g. assembled
+    from cached fragments) is compressed once rather than per request.
+    Streamed responses are compressed chunk by chunk as they are sent.
+
+    Args:
+        None
+
+    Returns:
+        None
+    """
+
+    def __init__(self):
+        self.app = None
+        self.codecs = {}
+        self.cache = None
+        self.stats = {'compressed': 0, 'cache_hits': 0, 'streamed': 0}
+
+    def init_app(self, app):
+        self.app = app
+        if not app.config.get('COMPRESS_ENABLED', True):
+            return
+        self.codecs = available_codecs(app.config)
+        self.mimetypes = set(app.config.get('COMPRESS_MIMETYPES', ()))
+        self.min_size = app.config.get('COMPRESS_MIN_SIZE', 500)
+        self.cache_timeout = app.config.get('COMPRESS_CACHE_TIMEOUT', 300)
+        self.cache = app.extensions.get('cache')
+        app.extensions['compressor'] = self
+        app.after_request(self.after_request)
+
+    def negotiate(self):
+        """
+        Picks the encoding for the current request
+
+        Args:
+            None
+
+        Returns:
+            encoding name, or None to send the response uncompressed
+        """
+        return request.accept_encodings.best_match(list(self.codecs)) or None
+
+    def after_request(self, response):
+        if (response.mimetype not in self.mimetypes
+                or response.status_code < 200 or response.status_code in (204, 206, 304)
+                or 'Content-Encoding' in response.headers
+                or response.direct_passthrough):
+            return response
+        response.vary.add('Accept-Encoding')
+        encoding = self.negotiate()
+        if encoding is None or request.method == 'HEAD':
+            return response
+        codec = self.codecs[encoding]
+
+        if response.is_streamed:
+            response.response = codec.stream(chunk.encode() if isinstance(chunk, str) else chunk
+                                             for chunk in response.response)
+            response.headers.pop('Content-Length', None)
+            self.stats['streamed'] += 1
+        else:
+            body = response.get_data()
+            if len(body) < self.min_size:
+                return response
+            response.set_data(self._compress(codec, body))
+        response.headers['Content-Encoding'] = encoding
+        return response
+
+    def _compress(self, codec, body):
+        if self.cache is None:
+            self.stats['compressed'] += 1
+            return codec.compress(body)
+        key = f'compressed:{codec.name}:{hashlib.blake2b(body, digest_size=16).hexdigest()}'
+        compressed = self.cache.get(key)
+        if compressed is None:
+            compressed = codec.compress(body)
+            self.cache.set(key, compressed, self.cache_timeout)
+            self.stats['compressed'] += 1
+        else:
+            self.stats['cache_hits'] += 1
+        return compressed
+
+
+compressor = Compressor()
@@ -1,13 +1,247 @@
 import os
-SECRET_KEY = os.urandom(32)
+# Must be shared by every worker, or sessions and CSRF tokens only work in
+# the worker that issued them; the random fallback is for development
+SECRET_KEY = os.environ.get('SECRET_KEY') or os.urandom(32)
 # Grabs the folder where the script runs.
 basedir = os.path.abspath(os.path.dirname(__file__))
 
-# Enable debug mode.
-DEBUG = True
+# Enable debug mode; serve.py turns it off unless DEBUG=1 is set.
+DEBUG = os.environ.get('DEBUG', '1') == '1'
+
+# Caching: 'simple' (in-process) or 'null' (disabled). Each process bumps
+# the fragment versions of venues and artists other processes wrote,
+# reading the change log every CACHE_SYNC_INTERVAL s
+CACHE_TYPE = os.environ.get('CACHE_TYPE', 'simple')
+CACHE_DEFAULT_TIMEOUT = 300
+CACHE_MAX_ENTRIES = 50000
+CACHE_SYNC_INTERVAL = 1.0
+# Default lifetime of {% cache %} template fragments, in seconds
+FRAGMENT_CACHE_TIMEOUT = 300
+# Compiled templates are shared between workers through this directory
+TEMPLATE_BYTECODE_CACHE_DIR = os.path.join(basedir, '.jinja_cache')
+TEMPLATE_PRECOMPILE = True
+
+# Hard deletes of venues/artists with more shows than this are purged in the
+# background, in batches of DELETE_PURGE_BATCH_SIZE shows per transaction.
+# Purges are recorded in purge_job; every DELETE_PURGE_CLAIM_TIMEOUT s each
+# process picks up those whose purge hasn't made progress for that long
+DELETE_PURGE_THRESHOLD = 1000
+DELETE_PURGE_BATCH_SIZE = 5000
+DELETE_PURGE_CLAIM_TIMEOUT = 300
+
+# Venue proximity search: 'auto' uses earthdistance on PostgreSQL and an
+# in-process grid index (cells of GEO_INDEX_CELL_DEG degrees) elsewhere.
+# Queries ask for at most GEO_MAX_RESULTS venues within GEO_MAX_RADIUS_KM.
+# Each process applies other processes' venue writes to its grid index
+# from the change log every GEO_SYNC_INTERVAL s
+GEO_BACKEND = 'auto'
+GEO_INDEX_CELL_DEG = 0.1
+GEO_SYNC_INTERVAL = 1.0
+GEO_MAX_RESULTS = 200
+GEO_MAX_RADIUS_KM = 500
+
+# On PostgreSQL the show table is partitioned by month; partitions are
+# created this many months ahead, checked every SHOW_PARTITION_CHECK_INTERVAL s
+SHOW_PARTITION_MAINTENANCE = True
+SHOW_PARTITION_MONTHS_AHEAD = 12
+SHOW_PARTITION_CHECK_INTERVAL = 24 * 3600
+# Longest date range /shows/calendar serves at once
+CALENDAR_MAX_DAYS = 366
+
+# Serve the bundles built by `flask assets build` (static/dist/manifest.json)
+# instead of the individual CSS/JS files
+ASSETS_ENABLED = True
+
+# Compress responses the client accepts (br and zstd when the brotli and
+# zstandard packages are installed, gzip always); bodies under
+# COMPRESS_MIN_SIZE bytes aren't worth it. Compressed bodies are cached by
+# content for COMPRESS_CACHE_TIMEOUT seconds
+COMPRESS_ENABLED = True
+COMPRESS_ALGORITHMS = ['br', 'zstd', 'gzip']
+COMPRESS_MIMETYPES = ['text/html', 'text/css', 'text/plain', 'text/csv', 'text/xml',
+                      'application/json', 'application/javascript', 'image/svg+xml']
+COMPRESS_MIN_SIZE = 500
+COMPRESS_GZIP_LEVEL = 6
+COMPRESS_BR_QUALITY = 5
+COMPRESS_ZSTD_LEVEL = 3
+COMPRESS_CACHE_TIMEOUT = 300
+
+# Venues and artists per page of the filtered /venues and /artists listings
+LISTING_PAGE_SIZE = 50
+
+# Tickets of a show are split over TICKET_SHARDS counter rows so concurrent
+# buyers lock different rows. Holds last TICKET_HOLD_SECONDS before their
+# tickets go back on sale; expired holds are swept every
+# TICKET_SWEEP_INTERVAL s, TICKET_SWEEP_BATCH_SIZE holds per transaction
+TICKET_SHARDS = 16
+TICKET_HOLD_SECONDS = 600
+TICKET_MAX_PER_HOLD = 10
+TICKET_SWEEP_INTERVAL = 5
+TICKET_SWEEP_BATCH_SIZE = 1000
+
+# /reports aggregate shows in SQL, or stream them REPORT_CHUNK_SIZE rows at a
+# time for the heavier ones. Results are cached per report and window and
+# brought up to date with the shows created since, up to
+# REPORT_MAX_INCREMENTAL change log entries at a time; every
+# REPORT_CACHE_TIMEOUT s they are recomputed from scratch
+REPORT_CHUNK_SIZE = 50000
+REPORT_CACHE_TIMEOUT = 3600
+REPORT_MAX_INCREMENTAL = 5000
+REPORT_DEFAULT_DAYS = 365
+REPORT_MAX_DAYS = 5 * 366
+REPORT_ROWS = 50
+
+# /suggest answers from an in-memory prefix index of venue and artist names
+# and cities, built in the background at startup (serve.py builds it in the
+# master before forking instead). Each process applies the venue and artist
+# writes of other processes from the change log in a background thread,
+# every SUGGEST_SYNC_INTERVAL s; more than SUGGEST_MAX_CHANGES at once rebuild it
+SUGGEST_PRELOAD = os.environ.get('SUGGEST_PRELOAD', '1') == '1'
+SUGGEST_MAX_RESULTS = 20
+SUGGEST_SYNC_INTERVAL = 1.0
+SUGGEST_MAX_CHANGES = 1000
+
+# Rate limits as (tokens per second, burst): per client and endpoint, and
+# per endpoint across all clients. 'memory://' keeps buckets per worker,
+# a redis:// URL shares them between workers and hosts
+RATELIMIT_ENABLED = os.environ.get('RATELIMIT_ENABLED', '1') != '0'
+RATELIMIT_STORAGE_URL = os.environ.get('RATELIMIT_STORAGE_URL', 'memory://')
+RATELIMIT_MAX_BUCKETS = 100000
+RATELIMIT_CLIENT_LIMITS = {
+    'search_venues': (1, 10),
+    'search_artists': (1, 10),
+    'create_venue_submission': (0.2, 5),
+    'create_artist_submission': (0.2, 5),
+    'create_show_submission': (0.2, 5),
+    'edit_venue_submission': (0.5, 10),
+    'edit_artist_submission': (0.5, 10),
+    'delete_venue': (0.2, 5),
+    'delete_artist': (0.2, 5),
+    'upload_image': (0.2, 5),
+    'nearby_venues': (1, 10),
+}
+RATELIMIT_ROUTE_LIMITS = {
+    'search_venues': (50, 100),
+    'search_artists': (50, 100),
+    'nearby_venues': (50, 100),
+}
+# Expensive endpoints share RATELIMIT_MAX_CONCURRENT slots per worker, kept
+# below the database pool size (5 + 10 overflow by default); a request
+# waits RATELIMIT_ADMISSION_TIMEOUT s for a slot before getting 503
+RATELIMIT_CONCURRENCY_ROUTES = [
+    'search_venues', 'search_artists', 'venues', 'artists', 'shows', 'shows_calendar',
+]
+RATELIMIT_MAX_CONCURRENT = 8
+RATELIMIT_ADMISSION_TIMEOUT = 0.25
+METRICS_ENABLED = True
+
+# /events streams the change log as server-sent events. `python serve.py
+# events` serves it asynchronously; set EVENTS_URL to where that server is
+# reachable and the app redirects /events there, adding ?tenant=<name> for
+# a tenant's feed; otherwise the app streams it itself, one thread per
+# subscriber (fine for the development server).
+# Subscribers more than EVENTS_QUEUE_SIZE events behind are disconnected
+# and resume from their last event id
+EVENTS_URL = os.environ.get('EVENTS_URL', '')
+EVENTS_POLL_INTERVAL = 1.0
+EVENTS_HEARTBEAT = 15
+EVENTS_RETRY_MS = 3000
+EVENTS_REPLAY_LIMIT = 1000
+EVENTS_QUEUE_SIZE = 100
+EVENTS_ALLOW_ORIGIN = os.environ.get('EVENTS_ALLOW_ORIGIN', '*')
+
+# Sessions and flashes are kept server-side; the cookie only holds a random
+# session id. memory:// is per worker; with several workers or hosts use
+# sql:// (the app's database) or redis://host:port/db so every worker sees
+# the same sessions. redis+local:// is an in-process stand-in for tests.
+# Sessions that aren't permanent expire SESSION_LIFETIME s after their last
+# change; expired sql:// rows are deleted every SESSION_CLEANUP_INTERVAL s,
+# SESSION_CLEANUP_BATCH_SIZE rows per transaction
+SESSION_STORAGE_URL = os.environ.get('SESSION_STORAGE_URL', 'memory://')
+SESSION_LIFETIME = 86400
+SESSION_MAX_ENTRIES = 100000
+SESSION_CLEANUP_INTERVAL = 300
+SESSION_CLEANUP_BATCH_SIZE = 1000
+
+# Multi-tenancy: one app serving many promoters. Requests are routed to a
+# tenant by hostname (<tenant>.TENANT_DOMAIN, or a custom domain in
+# TENANT_HOSTS) or, with TENANT_ROUTING = 'path', by a /t/<tenant> prefix;
+# anything else gets a 404 except TENANT_EXEMPT_PATHS. Each tenant has a
+# schema (TENANT_SCHEMA_PREFIX + name) on PostgreSQL, sharing the one
+# connection pool, or a database file in TENANT_SQLITE_DIR on SQLite.
+# Unknown names are looked up in the database at most every
+# TENANT_DISCOVERY_INTERVAL s. Provision tenants with
+# `flask tenants create <name>`
+TENANCY_ENABLED = os.environ.get('TENANCY_ENABLED', '0') == '1'
+TENANT_ROUTING = os.environ.get('TENANT_ROUTING', 'host')
+TENANT_DOMAIN = os.environ.get('TENANT_DOMAIN', '')
+TENANT_HOSTS = {}
+TENANT_PATH_PREFIX = '/t'
+TENANT_EXEMPT_PATHS = ['/healthz', '/readyz', '/metrics', '/static/']
+TENANT_SCHEMA_PREFIX = 'tenant_'
+TENANT_SQLITE_DIR = os.environ.get('TENANT_SQLITE_DIR', os.path.join(basedir, 'tenants'))
+TENANT_DISCOVERY_INTERVAL = 30
+
+# Snapshot mode: /venues, /artists and /shows are answered from in-memory
+# snapshots of the listings, rebuilt in the background after writes (seen
+# in the change log, checked every SNAPSHOT_CHECK_INTERVAL s) and when an
+# upcoming show starts. Responses say in an X-Snapshot-Staleness header how
+# many seconds ago their snapshot was last known current; past
+# SNAPSHOT_MAX_STALENESS the request rebuilds it first. More than
+# SNAPSHOT_MAX_CHANGES change log entries at once rebuild every listing
+SNAPSHOT_ENABLED = os.environ.get('SNAPSHOT_ENABLED', '0') == '1'
+SNAPSHOT_CHECK_INTERVAL = 1.0
+SNAPSHOT_MAX_STALENESS = 30
+SNAPSHOT_MAX_CHANGES = 1000
+
+# Venue and artist images are proxied: pages link to thumbnails at the
+# IMAGE_SIZES (width, height) cut by IMAGE_WORKERS background threads from
+# images fetched once into IMAGE_STORE_DIR, and served with a Cache-Control
+# max-age of IMAGE_MAX_AGE s (a year, immutable, for uploads, whose URLs
+# change with their content). Proxy URLs are signed with SECRET_KEY, so set
+# it when several processes serve the app. A request waits IMAGE_WAIT s for
+# an image the store doesn't have yet, then is redirected to the original;
+# images that fail to fetch are retried after IMAGE_RETRY_AFTER s. Images
+# on private networks are refused unless IMAGE_ALLOW_PRIVATE is set.
+# Thumbnails need Pillow; without it the originals are served. Fetch
+# every listed image ahead of time with `flask images import`
+IMAGE_PROXY_ENABLED = os.environ.get('IMAGE_PROXY_ENABLED', '1') == '1'
+IMAGE_STORE_DIR = os.environ.get('IMAGE_STORE_DIR', os.path.join(basedir, 'media'))
+IMAGE_SIZES = {'tile': (300, 200), 'detail': (750, 500)}
+IMAGE_WORKERS = 4
+IMAGE_MAX_BYTES = 10 * 1024 * 1024
+IMAGE_MAX_PIXELS = 40000000
+IMAGE_QUALITY = 82
+IMAGE_FETCH_TIMEOUT = 10
+IMAGE_WAIT = 1.0
+IMAGE_RETRY_AFTER = 600
+IMAGE_ALLOW_PRIVATE = os.environ.get('IMAGE_ALLOW_PRIVATE', '0') == '1'
+IMAGE_MAX_AGE = 30 * 86400
+
+# Logging: app.logger (outside debug mode) and one record per request go
+# as JSON lines to LOG_FILE ('-' for stderr; '{pid}' in it is replaced with
+# the process id, which every worker needs when several share a directory,
+# as each rotates its own file). Records are queued, up to LOG_QUEUE_SIZE,
+# and written by a background thread. The file is rotated at LOG_MAX_BYTES
+# and every LOG_ROTATE_INTERVAL s, keeping LOG_BACKUP_COUNT old ones.
+# Successful requests are logged with probability LOG_SAMPLE_RATE; errors
+# and requests slower than LOG_SLOW_REQUEST s always are. The request id
+# is taken from, and sent back in, the LOG_REQUEST_ID_HEADER header
+LOG_REQUESTS = os.environ.get('LOG_REQUESTS', '1') == '1'
+LOG_FILE = os.environ.get('LOG_FILE', os.path.join(basedir, 'logs', 'app.log'))
+LOG_MAX_BYTES = 100 * 1024 * 1024
+LOG_BACKUP_COUNT = 7
+LOG_ROTATE_INTERVAL = 86400
+LOG_QUEUE_SIZE = 10000
+LOG_SAMPLE_RATE = float(os.environ.get('LOG_SAMPLE_RATE', '1.0'))
+LOG_SLOW_REQUEST = 1.0
+LOG_REQUEST_ID_HEADER = 'X-Request-ID'
 
 # Connect to the database
 
 
 # [DONE] TODO IMPLEMENT DATABASE URL
-SQLALCHEMY_DATABASE_URI = 'postgres://rayanalkhelaiwi@localhost:5432/fyyur'
\ No newline at end of file
+# DATABASE_URL overrides the default, e.g. sqlite:///bench.db for benchmarks
+SQLALCHEMY_DATABASE_URI = os.environ.get(
+    'DATABASE_URL', 'postgresql://rayanalkhelaiwi@localhost:5432/fyyur')
+SQLALCHEMY_TRACK_MODIFICATIONS = False
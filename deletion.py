@@ -0,0 +1,286 @@
+#----------------------------------------------------------------------------#
+# Imports
+#----------------------------------------------------------------------------#
+
+import os
+import queue
+import threading
+import time
+from datetime import datetime, timedelta
+
+from sqlalchemy import delete, func, select, update
+
+from models import db, Venue, Artist, Show, PurgeJob
+from genres import adjust_facets, unlink
+from tenants import current_tenant, tenancy, use_tenant
+import tickets
+
+#----------------------------------------------------------------------------#
+# Deletion.
+#----------------------------------------------------------------------------#
+
+# Show column pointing at each deletable model
+SHOW_FOREIGN_KEYS = {
+    Venue: Show.venue_id,
+    Artist: Show.artist_id,
+}
+
+MODELS = {model.__tablename__: model for model in SHOW_FOREIGN_KEYS}
+
+
+def soft_delete(model, entity_id):
+    """
+    Marks a venue or artist as deleted without touching its shows
+
+    Bumps the row version, so edits started before the delete conflict,
+    and takes the row out of the genre facet counts.
+
+    Args:
+        model: Venue or Artist
+        entity_id: id of the row
+
+    Returns:
+        True if a live row was marked deleted
+    """
+    result = db.session.execute(
+        update(model)
+        .where(model.id == entity_id, model.deleted_at.is_(None))
+        .values(deleted_at=datetime.now(), version_id=model.version_id + 1))
+    if result.rowcount:
+        adjust_facets(model, entity_id, -1)
+    return result.rowcount > 0
+
+
+def restore(model, entity_id):
+    """
+    Undoes a soft delete
+
+    Args:
+        model: Venue or Artist
+        entity_id: id of the row
+
+    Returns:
+        True if a soft-deleted row was restored
+    """
+    result = db.session.execute(
+        update(model)
+        .where(model.id == entity_id, model.deleted_at.isnot(None))
+        .values(deleted_at=None, version_id=model.version_id + 1))
+    if result.rowcount:
+        adjust_facets(model, entity_id, 1)
+    return result.rowcount > 0
+
+
+def count_shows(model, entity_id):
+    return db.session.execute(
+        select(func.count()).where(SHOW_FOREIGN_KEYS[model] == entity_id)).scalar()
+
+
+def hard_delete(model, entity_id):
+    """
+    Deletes a venue or artist together with its shows and genre links
+
+    Shows go in one bulk DELETE rather than being loaded and deleted one
+    by one through the ORM, and explicitly rather than through ON DELETE
+    CASCADE, which SQLite only honours with foreign keys enabled. Their
+    tickets go off sale with them.
+
+    Args:
+        model: Venue or Artist
+        entity_id: id of the row
+
+    Returns:
+        (rows deleted, shows deleted)
+    """
+    tickets.close_sales(db.session.execute(
+        select(Show.id).where(SHOW_FOREIGN_KEYS[model] == entity_id)).scalars().all())
+    shows = db.session.execute(
+        delete(Show).where(SHOW_FOREIGN_KEYS[model] == entity_id)).rowcount
+    # Soft-deleted rows were taken out of the facet counts already
+    if db.session.execute(select(model.id).where(model.id == entity_id,
+                                                 model.deleted_at.is_(None))).first():
+        adjust_facets(model, entity_id, -1)
+    unlink(model, entity_id)
+    rows = db.session.execute(delete(model).where(model.id == entity_id)).rowcount
+    return rows, shows
+
+
+def purge_shows(model, entity_id, batch_size, on_batch=None):
+    """
+    Deletes the shows of a row in batches, committing after each batch
+
+    Short transactions keep a venue with thousands of shows from holding
+    locks on the show table for the whole purge. Each batch's tickets go
+    off sale with it.
+
+    Args:
+        model: Venue or Artist
+        entity_id: id of the row
+        batch_size: shows deleted per transaction
+        on_batch: optional function called in each batch's transaction
+
+    Returns:
+        number of deleted shows
+    """
+    foreign_key = SHOW_FOREIGN_KEYS[model]
+    total = 0
+    while True:
+        batch = db.session.execute(
+            select(Show.id).where(foreign_key == entity_id).limit(batch_size)).scalars().all()
+        tickets.close_sales(batch)
+        deleted = db.session.execute(
+            delete(Show).where(Show.id.in_(batch)).execution_options(synchronize_session=False)
+        ).rowcount
+        if on_batch is not None:
+            on_batch()
+        db.session.commit()
+        total += deleted
+        if deleted < batch_size:
+            return total
+
+#----------------------------------------------------------------------------#
+# Background purge.
+#----------------------------------------------------------------------------#
+
+class Purger:
+    """
+    Background worker that hard-deletes large venues and artists
+
+    Rows are soft-deleted right away by the request, so they vanish from
+    every page, and their shows are purged here in batches. Each queued
+    delete is recorded in purge_job in the same transaction. Started by
+    the first request a process serves, the worker picks up the ones whose
+    purge hasn't made progress for DELETE_PURGE_CLAIM_TIMEOUT seconds, then
+    looks again every DELETE_PURGE_CLAIM_TIMEOUT seconds, so a crash or
+    restart doesn't leave rows soft-deleted with their shows in place.
+
+    Args:
+        None
+
+    Returns:
+        None
+    """
+
+    def __init__(self):
+        self.app = None
+        self.jobs = queue.Queue()
+        self.threshold = 1000
+        self.batch_size = 5000
+        self.claim_timeout = 300
+        self._thread = None
+        self._started_pid = None
+        self._lock = threading.Lock()
+
+    def init_app(self, app):
+        self.app = app
+        self.threshold = app.config.get('DELETE_PURGE_THRESHOLD', self.threshold)
+        self.batch_size = app.config.get('DELETE_PURGE_BATCH_SIZE', self.batch_size)
+        self.claim_timeout = app.config.get('DELETE_PURGE_CLAIM_TIMEOUT', self.claim_timeout)
+        app.extensions['purger'] = self
+        app.before_request(self.before_request)
+
+    def delete(self, model, entity_id):
+        """
+        Hard-deletes a row, in the background if it has many shows
+
+        Must be called inside an application context; commits the session.
+
+        Args:
+            model: Venue or Artist
+            entity_id: id of the row
+
+        Returns:
+            'deleted', 'queued' or None when the row doesn't exist
+        """
+        if count_shows(model, entity_id) <= self.threshold:
+            rows, _ = hard_delete(model, entity_id)
+            db.session.commit()
+            return 'deleted' if rows else None
+        if not (soft_delete(model, entity_id) or db.session.get(model, entity_id)):
+            return None
+        db.session.merge(PurgeJob(entity=model.__tablename__, entity_id=entity_id,
+                                  requested_at=datetime.now(), claimed_at=datetime.now()))
+        db.session.commit()
+        self.jobs.put((current_tenant(), model, entity_id))
+        self._start()
+        return 'queued'
+
+    def before_request(self):
+        # Threads don't survive forking, so each process starts its own
+        if self._started_pid != os.getpid():
+            self._started_pid = os.getpid()
+            self._start()
+
+    def resume(self):
+        """
+        Queues the purges of every tenant that no process is working on
+
+        Returns:
+            number of purges queued
+        """
+        queued = 0
+        for tenant in tenancy.names():
+            try:
+                with use_tenant(tenant), self.app.app_context():
+                    queued += self._claim()
+            except Exception:
+                self.app.logger.exception('Resuming the purges of tenant %s failed', tenant)
+        return queued
+
+    def _claim(self):
+        now = datetime.now()
+        stale = now - timedelta(seconds=self.claim_timeout)
+        claimed = 0
+        # Databases made before purges were recorded don't have the table
+        PurgeJob.__table__.create(db.session.connection(), checkfirst=True)
+        for job in db.session.execute(select(PurgeJob)).scalars().all():
+            # Only the process whose UPDATE matched takes it
+            taken = db.session.execute(
+                update(PurgeJob)
+                .where(PurgeJob.entity == job.entity, PurgeJob.entity_id == job.entity_id,
+                       (PurgeJob.claimed_at.is_(None)) | (PurgeJob.claimed_at < stale))
+                .values(claimed_at=now)).rowcount
+            db.session.commit()
+            if taken:
+                self.jobs.put((current_tenant(), MODELS[job.entity], job.entity_id))
+                claimed += 1
+        return claimed
+
+    def _start(self):
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name='purger', daemon=True)
+                self._thread.start()
+
+    def _run(self):
+        resumed_at = None
+        while True:
+            # Claims go stale claim_timeout after their last batch, so
+            # looking that often finds every purge a crashed process left
+            if resumed_at is None or time.monotonic() - resumed_at >= self.claim_timeout:
+                resumed_at = time.monotonic()
+                self.resume()
+            try:
+                job = self.jobs.get(timeout=max(resumed_at + self.claim_timeout - time.monotonic(), 0))
+            except queue.Empty:
+                continue
+            try:
+                tenant, model, entity_id = job
+                key = (PurgeJob.entity == model.__tablename__, PurgeJob.entity_id == entity_id)
+
+                def renew_claim():
+                    # So no other process takes over a purge still running
+                    db.session.execute(update(PurgeJob).where(*key).values(claimed_at=datetime.now()))
+
+                with use_tenant(tenant), self.app.app_context():
+                    purge_shows(model, entity_id, self.batch_size, on_batch=renew_claim)
+                    hard_delete(model, entity_id)
+                    db.session.execute(delete(PurgeJob).where(*key))
+                    db.session.commit()
+            except Exception:
+                self.app.logger.exception('Purging %s %s failed', model.__tablename__, entity_id)
+            finally:
+                self.jobs.task_done()
+
+
+purger = Purger()
@@ -0,0 +1,549 @@
+#----------------------------------------------------------------------------#
+# Imports
+#----------------------------------------------------------------------------#
+
+import asyncio
+import json
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import parse_qs, urlsplit
+
+from sqlalchemy import func, select, text
+
+from metrics import registry as metrics
+from models import db, ChangeLog
+from tenants import current_tenant, tenancy, use_tenant
+
+# NOTIFY channel, and the advisory lock writers hold shared until they
+# commit; its second key is the schema's hash, so each tenant has its own
+CHANNEL = 'change_log'
+LOCK_KEY = 0x63686e67
+LOCK_ARGS = '(:key, hashtext(current_schema()))'
+
+# Highest id known to have nothing uncommitted below it, per tenant
+_bounds = {}
+
+#----------------------------------------------------------------------------#
+# Change log.
+#----------------------------------------------------------------------------#
+
+def record(entity, entity_id, action, data=None):
+    """
+    Appends a write to the change log, in the caller's transaction
+
+    The entry becomes visible, and subscribers are notified, when the
+    caller commits. On PostgreSQL the writer holds the change log lock
+    shared until then, which doesn't hold up other writers but tells
+    readers an id may still be uncommitted (see latest_id). The
+    notification names the tenant, so only its feed is read.
+
+    Args:
+        entity: 'show', 'venue' or 'artist'
+        entity_id
+        action: 'created', 'updated' or 'deleted'
+        data: JSON-serializable details, e.g. the changed columns
+
+    Returns:
+        None
+    """
+    if db.session.get_bind().dialect.name == 'postgresql':
+        db.session.execute(text('SELECT pg_advisory_xact_lock_shared' + LOCK_ARGS), {'key': LOCK_KEY})
+        db.session.execute(text('SELECT pg_notify(:channel, :payload)'),
+                           {'channel': CHANNEL, 'payload': f'{current_tenant() or ""}:{entity}'})
+    db.session.add(ChangeLog(entity=entity, entity_id=entity_id, action=action, data=data))
+
+
+def latest_id():
+    """
+    Highest change log id with no smaller id still uncommitted
+
+    Readers go no further, so one that has seen id N can't miss a smaller
+    id committed later. On PostgreSQL ids are drawn from a sequence when
+    the entry is inserted rather than when it commits, so this takes the
+    change log lock exclusively for a moment, on its own connection: with
+    no writer holding it, every id up to the largest has committed. While
+    a writer holds it the last bound is returned instead of waiting.
+    SQLite serializes writers, so its ids commit in order.
+
+    Must be called inside an application context.
+
+    Args:
+        None
+
+    Returns:
+        change log id, 0 when empty
+    """
+    engine = db.session.get_bind()
+    if engine.dialect.name != 'postgresql':
+        return db.session.execute(select(func.max(ChangeLog.id))).scalar() or 0
+    tenant = current_tenant()
+    with engine.begin() as connection:
+        locked = connection.execute(text('SELECT pg_try_advisory_xact_lock' + LOCK_ARGS),
+                                    {'key': LOCK_KEY}).scalar()
+        if not locked and tenant in _bounds:
+            return _bounds[tenant]
+        if not locked:
+            # No bound to fall back on yet
+            connection.execute(text("SET LOCAL lock_timeout = '5s'"))
+            connection.execute(text('SELECT pg_advisory_xact_lock' + LOCK_ARGS), {'key': LOCK_KEY})
+        bound = connection.execute(select(func.max(ChangeLog.id))).scalar() or 0
+    _bounds[tenant] = max(bound, _bounds.get(tenant, 0))
+    return _bounds[tenant]
+
+
+def fetch_since(cursor, limit=1000, entities=None, until=None):
+    """
+    Change log entries after a cursor, oldest first
+
+    Must be called inside an application context.
+
+    Args:
+        cursor: last id the reader has seen
+        limit: most entries returned
+        entities: only these entity kinds, all when empty
+        until: latest_id() when the caller has just read it
+
+    Returns:
+        list of dicts with id, entity, entity_id, action, data and created_at
+    """
+    if until is None:
+        until = latest_id()
+    query = (select(ChangeLog).where(ChangeLog.id > cursor, ChangeLog.id <= until)
+             .order_by(ChangeLog.id).limit(limit))
+    if entities:
+        query = query.where(ChangeLog.entity.in_(entities))
+    return [{'id': entry.id,
+             'entity': entry.entity,
+             'entity_id': entry.entity_id,
+             'action': entry.action,
+             'data': entry.data,
+             'created_at': entry.created_at.isoformat()}
+            for entry in db.session.execute(query).scalars()]
+
+
+def prune(before):
+    """
+    Deletes change log entries older than a date
+
+    Clients with a cursor older than that start over from the oldest entry
+    left.
+
+    Args:
+        before: datetime
+
+    Returns:
+        number of deleted entries
+    """
+    result = db.session.execute(ChangeLog.__table__.delete().where(ChangeLog.created_at < before))
+    db.session.commit()
+    return result.rowcount
+
+
+class Follower:
+    """
+    Background thread keeping in-process state current with the change log
+
+    Every `interval` seconds calls `check` inside an application context,
+    once for each tenant it was started for; `check` reads the entries
+    past its own cursor and applies them. Threads don't survive forking,
+    so it is started by a request rather than at import.
+
+    Args:
+        app: Flask app
+        name: thread name
+        check: function of no arguments
+        interval: seconds between checks
+
+    Returns:
+        None
+    """
+
+    def __init__(self, app, name, check, interval=1.0):
+        self.app = app
+        self.name = name
+        self.check = check
+        self.interval = interval
+        self._tenants = set()
+        self._thread = None
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+
+    def start(self):
+        tenant = current_tenant()
+        if tenant in self._tenants and self._thread is not None and self._thread.is_alive():
+            return
+        with self._lock:
+            self._tenants.add(tenant)
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name=self.name, daemon=True)
+                self._thread.start()
+
+    def run_once(self):
+        with self._lock:
+            tenants = list(self._tenants)
+        for tenant in tenants:
+            with use_tenant(tenant), self.app.app_context():
+                try:
+                    self.check()
+                except Exception:
+                    db.session.rollback()
+                    self.app.logger.exception('Applying the change log (%s) failed', self.name)
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self.run_once()
+
+    def stop(self):
+        self._stop.set()
+
+
+def format_event(event):
+    """
+    Server-sent event for a change log entry
+
+    Args:
+        event: dict from fetch_since
+
+    Returns:
+        bytes, e.g. id: 7 / event: show.created / data: {...}
+    """
+    return (f"id: {event['id']}\nevent: {event['entity']}.{event['action']}\n"
+            f"data: {json.dumps(event, separators=(',', ':'))}\n\n").encode()
+
+
+HEARTBEAT = b': keepalive\n\n'
+
+
+def parse_cursor(value):
+    try:
+        return max(int(value), 0)
+    except (TypeError, ValueError):
+        return None
+
+
+def stream(app, cursor, entities=None):
+    """
+    Server-sent events from the change log, polling the database
+
+    Holds a thread for as long as the client stays connected; it backs
+    the /events route under the development server. Production serves
+    /events from EventServer instead.
+
+    Args:
+        app: Flask app
+        cursor: last id the client has seen, None for new entries only
+        entities: only these entity kinds, all when empty
+
+    Returns:
+        generator of bytes
+    """
+    interval = app.config['EVENTS_POLL_INTERVAL']
+    heartbeat = app.config['EVENTS_HEARTBEAT']
+    limit = app.config['EVENTS_REPLAY_LIMIT']
+    with app.app_context():
+        if cursor is None:
+            cursor = latest_id()
+        db.session.remove()
+    yield f"retry: {app.config['EVENTS_RETRY_MS']}\n\n".encode()
+    quiet = 0.0
+    while True:
+        with app.app_context():
+            batch = fetch_since(cursor, limit, entities)
+            db.session.remove()
+        for event in batch:
+            cursor = event['id']
+            yield format_event(event)
+        if len(batch) == limit:
+            continue
+        if batch:
+            quiet = 0.0
+        elif quiet >= heartbeat:
+            quiet = 0.0
+            yield HEARTBEAT
+        time.sleep(interval)
+        quiet += interval
+
+#----------------------------------------------------------------------------#
+# Asynchronous server.
+#----------------------------------------------------------------------------#
+
+class Subscriber:
+    """
+    One connected client: its filter and a bounded queue of pending events
+
+    Args:
+        entities: only these entity kinds, all when empty
+        size: events queued before the client counts as too slow
+
+    Returns:
+        None
+    """
+    __slots__ = ('entities', 'queue', 'dropped')
+
+    def __init__(self, entities, size):
+        self.entities = frozenset(entities)
+        self.queue = asyncio.Queue(size)
+        self.dropped = False
+
+    def offer(self, event, payload):
+        if self.dropped or (self.entities and event['entity'] not in self.entities):
+            return
+        try:
+            self.queue.put_nowait((event['id'], payload))
+        except asyncio.QueueFull:
+            # Its connection is closed; the client reconnects with the
+            # last id it got and catches up from the change log
+            self.dropped = True
+
+
+class EventServer:
+    """
+    Serves /events as server-sent events on asyncio
+
+    An idle subscriber is a socket and a small coroutine rather than a
+    thread, so one process holds thousands of them. One pump per tenant
+    reads new change log entries and fans them out: woken by LISTEN/NOTIFY
+    on PostgreSQL (psycopg2), polling every EVENTS_POLL_INTERVAL seconds
+    otherwise. Database calls run on a small thread pool.
+
+    Clients resume from the Last-Event-ID header, which EventSource sends
+    on reconnect, or from ?cursor=<id>; ?entity=show (repeatable) filters.
+    With multi-tenancy the tenant is found as the app finds it, by hostname
+    or /t/<tenant>/events, or else from ?tenant=<name>, which the app adds
+    when it redirects to EVENTS_URL.
+
+    Args:
+        app: Flask app, for its config and database
+
+    Returns:
+        None
+    """
+
+    def __init__(self, app):
+        self.app = app
+        self.config = app.config
+        # Per tenant, None for the default database
+        self.subscribers = {}
+        self.last_id = {}
+        self._wakeups = {}
+        self._pumps = {}
+        self._starting = None
+        self._executor = ThreadPoolExecutor(max_workers=4, thread_name_prefix='events-db')
+        self._listener = None
+        self.delivered = metrics.counter('events_delivered_total', 'Events written to subscribers')
+        self.dropped = metrics.counter('events_dropped_subscribers_total',
+                                       'Subscribers disconnected for falling behind')
+        metrics.callback_gauge('events_subscribers', 'Connected /events subscribers',
+                               lambda: sum(len(s) for s in self.subscribers.values()))
+
+    def _db(self, tenant, function, *args):
+        def call():
+            with use_tenant(tenant), self.app.app_context():
+                try:
+                    return function(*args)
+                finally:
+                    db.session.remove()
+        return asyncio.get_running_loop().run_in_executor(self._executor, call)
+
+    async def serve(self, host, port):
+        """
+        Runs the server until cancelled
+
+        Args:
+            host, port: address to listen on
+
+        Returns:
+            None
+        """
+        self._starting = asyncio.Lock()
+        self._listen()
+        server = await asyncio.start_server(self._handle, host, port, backlog=1024)
+        self.app.logger.info('Serving /events on %s:%s', host, port)
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            for pump in self._pumps.values():
+                pump.cancel()
+            if self._listener is not None:
+                asyncio.get_running_loop().remove_reader(self._listener.fileno())
+                self._listener.close()
+            self._executor.shutdown(wait=False)
+
+    def _listen(self):
+        """
+        LISTENs on a dedicated connection when the database is PostgreSQL
+        """
+        with self.app.app_context():
+            if db.engine.dialect.name != 'postgresql':
+                return
+            try:
+                connection = db.engine.raw_connection().driver_connection
+                connection.autocommit = True
+                connection.cursor().execute(f'LISTEN {CHANNEL}')
+            except Exception:
+                self.app.logger.exception('LISTEN failed, polling the change log instead')
+                return
+        self._listener = connection
+        asyncio.get_running_loop().add_reader(connection.fileno(), self._notified)
+
+    def _notified(self):
+        self._listener.poll()
+        for notify in self._listener.notifies:
+            # '<tenant>:<entity>', the tenant empty for the default database
+            wakeup = self._wakeups.get(notify.payload.partition(':')[0] or None)
+            if wakeup is not None:
+                wakeup.set()
+        self._listener.notifies.clear()
+
+    async def _start(self, tenant):
+        """
+        Starts a tenant's pump for its first subscriber
+        """
+        if tenant in self._pumps:
+            return
+        async with self._starting:
+            if tenant in self._pumps:
+                return
+            self.last_id[tenant] = await self._db(tenant, latest_id)
+            self.subscribers[tenant] = set()
+            self._wakeups[tenant] = asyncio.Event()
+            self._pumps[tenant] = asyncio.create_task(self._pump(tenant))
+
+    async def _pump(self, tenant):
+        # With LISTEN the poll is only a safety net for lost connections
+        interval = self.config['EVENTS_POLL_INTERVAL'] * (30 if self._listener else 1)
+        limit = self.config['EVENTS_REPLAY_LIMIT']
+        wakeup = self._wakeups[tenant]
+        while True:
+            try:
+                await asyncio.wait_for(wakeup.wait(), interval)
+            except asyncio.TimeoutError:
+                pass
+            wakeup.clear()
+            try:
+                batch = await self._db(tenant, fetch_since, self.last_id[tenant], limit)
+            except Exception:
+                self.app.logger.exception('Reading the change log failed')
+                continue
+            for event in batch:
+                self._publish(tenant, event)
+            if len(batch) == limit:
+                wakeup.set()
+
+    def _publish(self, tenant, event):
+        self.last_id[tenant] = event['id']
+        payload = format_event(event)
+        for subscriber in self.subscribers[tenant]:
+            subscriber.offer(event, payload)
+
+    def _route(self, path, host, requested):
+        """
+        Tenant of an /events request and its path below the tenant prefix
+
+        Routed as by TenantMiddleware, or by ?tenant= when that finds none.
+
+        Returns:
+            (tenant, path), None for no known tenant
+        """
+        tenant, prefix = tenancy.resolve({'PATH_INFO': path, 'HTTP_HOST': host})
+        if tenant is None and requested and tenancy.exists(requested):
+            tenant = requested
+        if tenant is None and not path.startswith(tenancy.exempt_paths):
+            return None
+        return tenant, path[len(prefix):] or '/'
+
+    async def _handle(self, reader, writer):
+        try:
+            head = await asyncio.wait_for(reader.readuntil(b'\r\n\r\n'), 10)
+        except (asyncio.TimeoutError, asyncio.IncompleteReadError, asyncio.LimitOverrunError,
+                ConnectionError):
+            writer.close()
+            return
+        lines = head.decode('latin-1').split('\r\n')
+        method, target = (lines[0].split(' ') + ['', ''])[:2]
+        headers = {}
+        for line in lines[1:]:
+            name, _, value = line.partition(':')
+            headers[name.strip().lower()] = value.strip()
+        url = urlsplit(target)
+        query = parse_qs(url.query)
+        try:
+            if method != 'GET':
+                await self._respond(writer, '405 Method Not Allowed')
+            elif url.path == '/metrics':
+                await self._respond(writer, '200 OK', metrics.render().encode(),
+                                    'text/plain; version=0.0.4; charset=utf-8')
+            elif url.path == '/healthz':
+                await self._respond(writer, '200 OK', b'{"status":"ok"}', 'application/json')
+            else:
+                route = (None, url.path)
+                if tenancy.enabled:
+                    route = await self._db(None, self._route, url.path, headers.get('host', ''),
+                                           (query.get('tenant') or [None])[0])
+                if route is None or route[1] != '/events':
+                    await self._respond(writer, '404 Not Found')
+                else:
+                    await self._subscribe(writer, route[0], query, headers)
+        except (ConnectionError, asyncio.CancelledError):
+            pass
+        finally:
+            writer.close()
+
+    async def _respond(self, writer, status, body=b'', content_type='text/plain'):
+        writer.write(f'HTTP/1.1 {status}\r\nContent-Type: {content_type}\r\n'
+                     f'Content-Length: {len(body)}\r\nConnection: close\r\n\r\n'.encode() + body)
+        await writer.drain()
+
+    async def _subscribe(self, writer, tenant, query, headers):
+        entities = query.get('entity', [])
+        cursor = parse_cursor(headers.get('last-event-id') or (query.get('cursor') or [None])[0])
+        await self._start(tenant)
+        # Subscribe before replaying, so nothing committed in between is
+        # missed; replayed ids are skipped when they come round again
+        subscriber = Subscriber(entities, self.config['EVENTS_QUEUE_SIZE'])
+        subscribers = self.subscribers[tenant]
+        subscribers.add(subscriber)
+        try:
+            writer.write(b'HTTP/1.1 200 OK\r\nContent-Type: text/event-stream\r\n'
+                         b'Cache-Control: no-cache\r\nConnection: keep-alive\r\n'
+                         b'X-Accel-Buffering: no\r\n'
+                         + f"Access-Control-Allow-Origin: {self.config['EVENTS_ALLOW_ORIGIN']}\r\n\r\n"
+                           f"retry: {self.config['EVENTS_RETRY_MS']}\n\n".encode())
+            await writer.drain()
+            last_id = self.last_id[tenant]
+            seen = last_id if cursor is None else cursor
+            limit = self.config['EVENTS_REPLAY_LIMIT']
+            while seen < last_id and not subscriber.dropped:
+                batch = await self._db(tenant, fetch_since, seen, limit, entities, last_id)
+                for event in batch:
+                    writer.write(format_event(event))
+                    seen = event['id']
+                await writer.drain()
+                if len(batch) < limit:
+                    break
+            await self._stream(writer, subscriber, seen)
+        finally:
+            subscribers.discard(subscriber)
+            if subscriber.dropped:
+                self.dropped.inc()
+
+    async def _stream(self, writer, subscriber, seen):
+        heartbeat = self.config['EVENTS_HEARTBEAT']
+        while True:
+            try:
+                item = await asyncio.wait_for(subscriber.queue.get(), heartbeat)
+            except asyncio.TimeoutError:
+                # Also how a client that went away is noticed
+                writer.write(HEARTBEAT)
+                await writer.drain()
+                continue
+            if subscriber.dropped:
+                return
+            event_id, payload = item
+            if event_id <= seen:
+                continue
+            writer.write(payload)
+            await writer.drain()
+            self.delivered.inc()
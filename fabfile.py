@@ -5,14 +5,27 @@ from fabric.contrib.console import confirm
 
 
 def test():
+    # every route once against a small seeded database, failing on
+    # server errors and on routes the benchmarks don't cover
     with settings(warn_only=True):
         result = local(
-            "python test_tasks.py -v && python test_users.py -v", capture=True
+            "python -m compileall -q . && "
+            "python -m benchmarks seed --database-url sqlite:///smoke.db "
+            "--venues 50 --artists 200 --shows 1000 && "
+            "python -m benchmarks run --database-url sqlite:///smoke.db --iterations 1 "
+            "--no-memory --skip-http --check --out smoke_results.json",
+            capture=True
         )
     if result.failed and not confirm("Tests failed. Continue?"):
         abort("Aborted at user request.")
 
 
+def bench(baseline=None):
+    local("python -m benchmarks run --out bench_results.json")
+    if baseline:
+        local("python -m benchmarks compare {} bench_results.json".format(baseline))
+
+
 def commit():
     message = raw_input("Enter a git commit message: ")
     local("git add . && git commit -am '{}'".format(message))
@@ -39,8 +52,10 @@ def heroku():
 
 
 def heroku_test():
+    # the deployed app imports and reaches its database
     local(
-        "heroku run python test_tasks.py -v && heroku run python test_users.py -v"
+        "heroku run python -c \"import sys; from app import app, check_database, db; "
+        "app.app_context().push(); sys.exit(0 if check_database(db.engine)[0] else 1)\""
     )
 
 
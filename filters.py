@@ -0,0 +1,335 @@
+#----------------------------------------------------------------------------#
+# Imports
+#----------------------------------------------------------------------------#
+
+import math
+from collections import namedtuple
+from datetime import datetime
+
+from flask import request, url_for
+from sqlalchemy import String, cast, exists, func, literal, or_, select, tuple_, union_all
+
+from genres import GENRE_LINKS, genre_facets, tagged_with
+from models import db, Genre, Show, Venue, Artist
+
+# Boolean flag each listing can be filtered on, and the show column
+# pointing at its rows
+SEEKING = {Venue: 'seeking_talent', Artist: 'seeking_venue'}
+SHOW_KEYS = {Venue: Show.venue_id, Artist: Show.artist_id}
+# Listing order; venues are shown grouped by area
+ORDER = {Venue: (Venue.state, Venue.city, Venue.name, Venue.id), Artist: (Artist.name, Artist.id)}
+FLAGS = ('seeking', 'upcoming')
+# Options shown per dimension, the most frequent first
+MAX_OPTIONS = 20
+# Venues of one city, state on a /venues page
+Area = namedtuple('Area', 'city state venues')
+
+#----------------------------------------------------------------------------#
+# Filters.
+#----------------------------------------------------------------------------#
+
+def parse_flag(value):
+    """
+    Reads a yes/no query string value
+
+    Args:
+        value: lower-cased value, e.g. '1', 'true', 'no'
+
+    Returns:
+        True, False, or None when it is neither
+    """
+    if value in ('1', 'true', 'yes', 'y'):
+        return True
+    if value in ('0', 'false', 'no', 'n'):
+        return False
+    return None
+
+
+def parse_filters(model, args):
+    """
+    Filters in a listing query string
+
+    Args:
+        model: Venue or Artist
+        args: request.args
+
+    Returns:
+        dict with any of state, city, genre (strings) and seeking, upcoming
+        (booleans); absent or invalid parameters are left out
+    """
+    active = {key: args[key] for key in ('state', 'city', 'genre') if args.get(key)}
+    for key, param in (('seeking', SEEKING[model]), ('upcoming', 'upcoming')):
+        value = parse_flag(args.get(param, '').lower())
+        if value is not None:
+            active[key] = value
+    return active
+
+
+def _upcoming(model, now):
+    key = SHOW_KEYS[model]
+    return exists().where(key == model.id, Show.start_time > now)
+
+
+def compile_filters(model, active, now):
+    """
+    WHERE conditions for a set of filters, live rows only
+
+    Every condition is served by an index: the (state, city) partial
+    indexes, the genre association index and the show (venue/artist,
+    start_time) indexes for upcoming shows.
+
+    Args:
+        model: Venue or Artist
+        active: dict from parse_filters
+        now: cut-off between past and upcoming shows
+
+    Returns:
+        list of SQL conditions
+    """
+    conditions = [model.deleted_at.is_(None)]
+    if 'state' in active:
+        conditions.append(model.state == active['state'])
+    if 'city' in active:
+        conditions.append(model.city == active['city'])
+    if 'genre' in active:
+        conditions.append(tagged_with(model, active['genre']))
+    if 'seeking' in active:
+        seeking = getattr(model, SEEKING[model])
+        conditions.append(seeking.is_(True) if active['seeking']
+                          else or_(seeking.is_(False), seeking.is_(None)))
+    if 'upcoming' in active:
+        upcoming = _upcoming(model, now)
+        conditions.append(upcoming if active['upcoming'] else ~upcoming)
+    return conditions
+
+#----------------------------------------------------------------------------#
+# Facet counts.
+#----------------------------------------------------------------------------#
+
+def _filtered(model, conditions, now):
+    return select(
+        model.id.label('id'),
+        model.state.label('state'),
+        model.city.label('city'),
+        func.coalesce(getattr(model, SEEKING[model]), False).label('seeking'),
+        _upcoming(model, now).label('upcoming'),
+    ).where(*conditions).cte('filtered')
+
+
+def _grouping_sets_query(model, filtered, with_genres):
+    """
+    One GROUP BY GROUPING SETS over the filtered rows (PostgreSQL)
+
+    Joining the genres repeats a row per genre, so rows are counted with
+    COUNT(DISTINCT id).
+    """
+    table, foreign_key = GENRE_LINKS[model]
+    columns = {'state': filtered.c.state, 'city': filtered.c.city,
+               'seeking': filtered.c.seeking, 'upcoming': filtered.c.upcoming}
+    sets = {'state': ('state',), 'city': ('state', 'city'), 'seeking': ('seeking',),
+            'upcoming': ('upcoming',), 'total': ()}
+    source = filtered
+    if with_genres:
+        columns['genre'] = Genre.name
+        sets['genre'] = ('genre',)
+        source = filtered.outerjoin(table, foreign_key == filtered.c.id) \
+                         .outerjoin(Genre, Genre.id == table.c.genre_id)
+    names = list(columns)
+    query = select(*columns.values(),
+                   func.grouping(*columns.values()).label('grouping_mask'),
+                   func.count(filtered.c.id.distinct()).label('count')) \
+        .select_from(source) \
+        .group_by(func.grouping_sets(*(tuple_(*(columns[name] for name in grouped))
+                                       for grouped in sets.values())))
+    # GROUPING() sets a bit, most significant first, for every column left
+    # out of the row's grouping set
+    masks = {sum(1 << (len(names) - 1 - i) for i, name in enumerate(names) if name not in grouped):
+             dimension for dimension, grouped in sets.items()}
+    for row in db.session.execute(query):
+        values = dict(zip(names, row))
+        dimension = masks.get(row.grouping_mask)
+        if dimension == 'city':
+            yield dimension, (values['city'], values['state']), row.count
+        else:
+            yield dimension, values.get(dimension), row.count
+
+
+def _union_query(model, filtered, with_genres):
+    """
+    The same counts as one UNION ALL of GROUP BYs, for other databases
+    """
+    table, foreign_key = GENRE_LINKS[model]
+    count = func.count(filtered.c.id.distinct())
+
+    def part(dimension, value, extra, *group_by, source=filtered):
+        return select(literal(dimension).label('dimension'), cast(value, String).label('value'),
+                      cast(extra, String).label('extra'), count.label('count')) \
+            .select_from(source).group_by(*group_by)
+
+    none = literal(None, String)
+    parts = [
+        part('state', filtered.c.state, none, filtered.c.state),
+        part('city', filtered.c.city, filtered.c.state, filtered.c.state, filtered.c.city),
+        part('seeking', filtered.c.seeking, none, filtered.c.seeking),
+        part('upcoming', filtered.c.upcoming, none, filtered.c.upcoming),
+        part('total', none, none),
+    ]
+    if with_genres:
+        parts.append(part('genre', Genre.name, none, Genre.name,
+                          source=filtered.join(table, foreign_key == filtered.c.id)
+                                         .join(Genre, Genre.id == table.c.genre_id)))
+    for dimension, value, extra, count in db.session.execute(union_all(*parts)):
+        if dimension == 'city':
+            value = (value, extra)
+        elif dimension in FLAGS:
+            value = value in ('1', 'true')
+        yield dimension, value, count
+
+
+def facet_counts(model, conditions, now, with_genres=True):
+    """
+    Counts of the filtered rows per value of every dimension, in one query
+
+    Counts are for the current result set: a dimension that is filtered
+    on only counts the selected value.
+
+    Args:
+        model: Venue or Artist
+        conditions: from compile_filters
+        now: cut-off between past and upcoming shows
+        with_genres: count genres too; without filters the precomputed
+            genre_facet table has those counts already
+
+    Returns:
+        dict of dimension -> {value: count}, plus 'total'
+    """
+    filtered = _filtered(model, conditions, now)
+    query = _grouping_sets_query if db.engine.dialect.name == 'postgresql' else _union_query
+    counts = {'state': {}, 'city': {}, 'genre': {}, 'seeking': {}, 'upcoming': {}, 'total': 0}
+    for dimension, value, count in query(model, filtered, with_genres):
+        if dimension == 'total':
+            counts['total'] = count
+        elif dimension and value is not None and value != (None, None):
+            counts[dimension][value] = count
+    return counts
+
+#----------------------------------------------------------------------------#
+# Listings.
+#----------------------------------------------------------------------------#
+
+def group_by_area(venues):
+    """
+    Venues grouped by city, state
+
+    Venues are listed sorted by state and city, so areas are runs of them.
+
+    Args:
+        venues: sorted venues
+
+    Returns:
+        list of Area
+    """
+    areas = []
+    for venue in venues:
+        if not areas or (areas[-1].city, areas[-1].state) != (venue.city, venue.state):
+            areas.append(Area(venue.city, venue.state, []))
+        areas[-1].venues.append(venue)
+    return areas
+
+
+class Listing:
+    """
+    One page of a filtered venue or artist listing with its facets
+
+    Args:
+        model: Venue or Artist
+        args: request.args
+        per_page: rows per page
+
+    Returns:
+        None
+    """
+
+    TITLES = {'state': 'State', 'city': 'City', 'genre': 'Genre', 'upcoming': 'Upcoming shows'}
+
+    def __init__(self, model, args, per_page):
+        now = datetime.now()
+        self.model = model
+        self.active = parse_filters(model, args)
+        self.endpoint = request.endpoint
+        conditions = compile_filters(model, self.active, now)
+        self.counts = facet_counts(model, conditions, now, with_genres=bool(self.active))
+        if not self.active:
+            self.counts['genre'] = dict(genre_facets(model))
+        self.paginate(args, per_page)
+        self.items = db.session.execute(
+            select(model).where(*conditions).order_by(*ORDER[model])
+            .limit(per_page).offset((self.page - 1) * per_page)).scalars().all()
+
+    def paginate(self, args, per_page):
+        """
+        Sets the page requested in `args`, from the total in the counts
+        """
+        self.total = self.counts['total']
+        self.per_page = per_page
+        self.pages = max(math.ceil(self.total / per_page), 1)
+        self.page = min(max(args.get('page', 1, type=int), 1), self.pages)
+
+    def areas(self):
+        """
+        The venues of the page grouped by city, state
+        """
+        return group_by_area(self.items)
+
+    def params(self, **changes):
+        params = dict(self.active)
+        params.update(changes)
+        query = {}
+        for key, value in params.items():
+            if value is None:
+                continue
+            if key in FLAGS:
+                query[SEEKING[self.model] if key == 'seeking' else key] = int(value)
+            else:
+                query[key] = value
+        return query
+
+    def url(self, **changes):
+        """
+        This listing with some filters changed, None removes one
+        """
+        changes.setdefault('page', None)
+        return url_for(self.endpoint, **self.params(**changes))
+
+    def dimensions(self):
+        """
+        Facet options to render: per dimension a title and a list of
+        (label, count, url, active) tuples
+        """
+        seeking = 'Seeking talent' if self.model is Venue else 'Seeking venues'
+        dimensions = []
+        for key in ('state', 'city', 'genre', 'seeking', 'upcoming'):
+            counts = self.counts[key]
+            if key in FLAGS:
+                options = [('Yes' if value else 'No', count, value)
+                           for value, count in sorted(counts.items(), reverse=True)]
+            elif key == 'city':
+                options = [(f'{city}, {state}', count, (city, state))
+                           for (city, state), count in counts.items()]
+            else:
+                options = [(value, count, value) for value, count in counts.items()]
+            if key not in FLAGS:
+                options = sorted(options, key=lambda option: (-option[1], option[0]))[:MAX_OPTIONS]
+                options.sort()
+            rendered = []
+            for label, count, value in options:
+                if key == 'city':
+                    active = self.active.get('city') == value[0]
+                    url = self.url(city=None) if active else self.url(city=value[0], state=value[1])
+                else:
+                    active = key in self.active and self.active[key] == value
+                    url = self.url(**{key: None if active else value})
+                rendered.append((label, count, url, active))
+            if rendered:
+                dimensions.append((seeking if key == 'seeking' else self.TITLES[key], rendered))
+        return dimensions
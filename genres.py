@@ -0,0 +1,222 @@
+#----------------------------------------------------------------------------#
+# Imports
+#----------------------------------------------------------------------------#
+
+import json
+from collections import Counter
+
+from sqlalchemy import and_, delete, event, func, insert, inspect, literal, select, text, update
+
+from models import db, Genre, GenreFacet, Venue, Artist, venue_genre, artist_genre
+
+# The genres the forms offer
+GENRES = (
+    'Alternative', 'Blues', 'Classical', 'Country', 'Electronic', 'Folk',
+    'Funk', 'Heavy Metal', 'Hip-Hop', 'Instrumental', 'Jazz',
+    'Musical Theatre', 'Other', 'Pop', 'Punk', 'R&B', 'Reggae', 'Rock n Roll',
+    'Soul',
+)
+
+# Association table and its column pointing at each model
+GENRE_LINKS = {
+    Venue: (venue_genre, venue_genre.c.venue_id),
+    Artist: (artist_genre, artist_genre.c.artist_id),
+}
+KINDS = {Venue: 'venue', Artist: 'artist'}
+
+#----------------------------------------------------------------------------#
+# Facet counts.
+#----------------------------------------------------------------------------#
+
+def genre_facets(model):
+    """
+    Live venues or artists per genre, from the facet table
+
+    Args:
+        model: Venue or Artist
+
+    Returns:
+        list of (genre name, count) for genres with any, by name
+    """
+    return db.session.execute(
+        select(Genre.name, GenreFacet.count)
+        .join(GenreFacet, GenreFacet.genre_id == Genre.id)
+        .where(GenreFacet.kind == KINDS[model], GenreFacet.count > 0)
+        .order_by(Genre.name)).all()
+
+
+def tagged_with(model, genre):
+    """
+    Condition matching the venues or artists tagged with a genre
+
+    Args:
+        model: Venue or Artist
+        genre: genre name
+
+    Returns:
+        SQL condition
+    """
+    table, foreign_key = GENRE_LINKS[model]
+    return model.id.in_(
+        select(foreign_key).join(Genre, Genre.id == table.c.genre_id).where(Genre.name == genre))
+
+
+def adjust_facets(model, entity_id, delta):
+    """
+    Adds delta to the facet count of every genre of one venue or artist
+
+    Called when a row stops or starts counting: soft delete, restore and
+    hard delete of a live row. Runs in the caller's transaction.
+
+    Args:
+        model: Venue or Artist
+        entity_id
+        delta: -1 or 1
+
+    Returns:
+        None
+    """
+    table, foreign_key = GENRE_LINKS[model]
+    db.session.execute(
+        update(GenreFacet)
+        .where(GenreFacet.kind == KINDS[model],
+               GenreFacet.genre_id.in_(select(table.c.genre_id).where(foreign_key == entity_id)))
+        .values(count=GenreFacet.count + delta)
+        .execution_options(synchronize_session=False))
+
+
+def unlink(model, entity_id):
+    table, foreign_key = GENRE_LINKS[model]
+    db.session.execute(delete(table).where(foreign_key == entity_id))
+
+
+def rebuild_facets():
+    """
+    Recounts every facet from the association tables
+
+    Must be called inside an application context; commits the session.
+
+    Args:
+        None
+
+    Returns:
+        None
+    """
+    db.session.execute(delete(GenreFacet))
+    for model, (table, foreign_key) in GENRE_LINKS.items():
+        counts = (
+            select(literal(KINDS[model]), Genre.id, func.count(model.id))
+            .select_from(Genre)
+            .outerjoin(table, table.c.genre_id == Genre.id)
+            .outerjoin(model, and_(model.id == foreign_key, model.deleted_at.is_(None)))
+            .group_by(Genre.id))
+        db.session.execute(insert(GenreFacet).from_select(['kind', 'genre_id', 'count'], counts))
+    db.session.commit()
+
+
+def ensure_genres(names=GENRES):
+    """
+    Creates the genres that don't exist yet
+
+    Args:
+        names: genre names
+
+    Returns:
+        dict of genre name -> id, for all genres
+    """
+    existing = dict(db.session.execute(select(Genre.name, Genre.id)).all())
+    for name in names:
+        if name not in existing:
+            genre = Genre(name=name)
+            db.session.add(genre)
+            db.session.flush()
+            existing[name] = genre.id
+    return existing
+
+# Links made or dropped through the ORM (creating and editing venues and
+# artists) are counted as they happen and applied to the facet table when
+# the session flushes, in the same transaction
+
+@event.listens_for(Genre, 'after_insert')
+def _create_facets(mapper, connection, genre):
+    connection.execute(insert(GenreFacet), [
+        {'kind': kind, 'genre_id': genre.id, 'count': 0} for kind in KINDS.values()])
+
+
+def _track(delta):
+    def listener(entity, genre, initiator):
+        entity.__dict__.setdefault('_genre_changes', Counter())[genre] += delta
+    return listener
+
+
+for _model in GENRE_LINKS:
+    event.listen(_model.genre_rows, 'append', _track(1))
+    event.listen(_model.genre_rows, 'remove', _track(-1))
+
+
+@event.listens_for(db.session, 'after_flush')
+def _apply_genre_changes(session, flush_context):
+    deltas = Counter()
+    for entity in list(session.new) + list(session.dirty):
+        for genre, delta in entity.__dict__.pop('_genre_changes', {}).items():
+            deltas[(KINDS[type(entity)], genre.id)] += delta
+    for (kind, genre_id), delta in deltas.items():
+        if delta:
+            session.connection().execute(
+                update(GenreFacet)
+                .where(GenreFacet.kind == kind, GenreFacet.genre_id == genre_id)
+                .values(count=GenreFacet.count + delta))
+
+
+@event.listens_for(db.session, 'after_soft_rollback')
+def _discard_genre_changes(session, previous_transaction):
+    for entity in list(session.new) + list(session.dirty):
+        entity.__dict__.pop('_genre_changes', None)
+
+#----------------------------------------------------------------------------#
+# Migration.
+#----------------------------------------------------------------------------#
+
+def migrate_arrays(drop_columns=False):
+    """
+    Moves the genres of the old venue.genres and artist.genres array
+    columns into the genre and association tables, then recounts facets
+
+    Venues and artists that already have linked genres are skipped, so it
+    can be run again after a partial run.
+
+    Must be called inside an application context; commits the session.
+
+    Args:
+        drop_columns: drop the array columns afterwards
+
+    Returns:
+        dict of kind -> number of rows migrated
+    """
+    db.create_all()
+    migrated = {}
+    for model, (table, foreign_key) in GENRE_LINKS.items():
+        name = model.__tablename__
+        if 'genres' not in {column['name'] for column in inspect(db.engine).get_columns(name)}:
+            continue
+        linked = set(db.session.execute(select(foreign_key).distinct()).scalars())
+        rows, links = 0, []
+        for entity_id, values in db.session.execute(
+                text(f'SELECT id, genres FROM {name} WHERE genres IS NOT NULL')):
+            if entity_id in linked:
+                continue
+            if isinstance(values, str):  # JSON on SQLite
+                values = json.loads(values)
+            rows += 1
+            links.extend((entity_id, value) for value in dict.fromkeys(values or ()))
+        ids = ensure_genres(sorted({value for _, value in links}))
+        if links:
+            db.session.execute(insert(table), [
+                {foreign_key.name: entity_id, 'genre_id': ids[value]} for entity_id, value in links])
+        if drop_columns:
+            db.session.execute(text(f'ALTER TABLE {name} DROP COLUMN genres'))
+        migrated[name] = rows
+    ensure_genres()
+    db.session.commit()
+    rebuild_facets()
+    return migrated
@@ -0,0 +1,433 @@
+#----------------------------------------------------------------------------#
+# Imports
+#----------------------------------------------------------------------------#
+
+import csv
+import heapq
+import math
+import os
+import threading
+from array import array
+
+from sqlalchemy import DDL, event, select, text
+
+import events
+from models import db, Venue
+from tenants import tenant_local
+
+EARTH_RADIUS_KM = 6371.0088
+KM_PER_DEGREE = math.pi * EARTH_RADIUS_KM / 180.0
+
+CENTROIDS_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data', 'geo_centroids.csv')
+
+#----------------------------------------------------------------------------#
+# PostgreSQL spatial index.
+#----------------------------------------------------------------------------#
+
+# earthdistance's GiST index answers both radius (earth_box) and
+# k-nearest (<->) queries; other databases use the in-process GridIndex
+for statement in (
+        'CREATE EXTENSION IF NOT EXISTS cube',
+        'CREATE EXTENSION IF NOT EXISTS earthdistance',
+        'CREATE INDEX IF NOT EXISTS ix_venue_earth ON venue '
+        'USING gist (ll_to_earth(latitude, longitude)) WHERE deleted_at IS NULL'):
+    event.listen(Venue.__table__, 'after_create', DDL(statement).execute_if(dialect='postgresql'))
+
+#----------------------------------------------------------------------------#
+# Geocoding.
+#----------------------------------------------------------------------------#
+
+def haversine_km(lat1, lng1, lat2, lng2):
+    """
+    Great-circle distance between two points
+
+    Args:
+        lat1, lng1: first point in degrees
+        lat2, lng2: second point in degrees
+
+    Returns:
+        distance in kilometres
+    """
+    phi1, phi2 = math.radians(lat1), math.radians(lat2)
+    a = (math.sin((phi2 - phi1) / 2) ** 2
+         + math.cos(phi1) * math.cos(phi2) * math.sin(math.radians(lng2 - lng1) / 2) ** 2)
+    return 2 * EARTH_RADIUS_KM * math.asin(min(1.0, math.sqrt(a)))
+
+
+def _normalize(value):
+    return ' '.join((value or '').lower().replace('.', '').split())
+
+
+class Geocoder:
+    """
+    Offline geocoder over the bundled city and state centroid table
+
+    Cities not in the table fall back to the centroid of their state, so
+    every venue with a valid state gets coordinates without network access.
+
+    Args:
+        path: CSV with city,state,latitude,longitude rows; state-level rows
+              leave city empty
+
+    Returns:
+        None
+    """
+
+    def __init__(self, path=CENTROIDS_PATH):
+        self.path = path
+        self._cities = None
+        self._states = None
+
+    def _load(self):
+        cities, states = {}, {}
+        with open(self.path, newline='') as f:
+            for row in csv.DictReader(f):
+                point = (float(row['latitude']), float(row['longitude']))
+                state = row['state'].upper()
+                if row['city']:
+                    cities[(_normalize(row['city']), state)] = point
+                else:
+                    states[state] = point
+        self._cities, self._states = cities, states
+
+    def geocode(self, city, state):
+        """
+        Looks up coordinates for a city and state
+
+        Args:
+            city: city name, matched case-insensitively
+            state: two-letter state code
+
+        Returns:
+            (latitude, longitude), or None if the state is unknown
+        """
+        if self._cities is None:
+            self._load()
+        state = (state or '').strip().upper()
+        return self._cities.get((_normalize(city), state)) or self._states.get(state)
+
+
+geocoder = Geocoder()
+
+#----------------------------------------------------------------------------#
+# In-process spatial index.
+#----------------------------------------------------------------------------#
+
+class GridIndex:
+    """
+    Geohash-style grid of points for radius and k-nearest queries
+
+    Points are bucketed into cells of `cell_deg` degrees, stored as compact
+    arrays. A query only looks at the cells its search area overlaps.
+
+    Args:
+        cell_deg: cell size in degrees (0.1 is about 11 km of latitude)
+
+    Returns:
+        None
+    """
+
+    def __init__(self, cell_deg=0.1):
+        self.cell_deg = cell_deg
+        self._cells = {}
+        self._cell_of = {}
+        self._bounds = None
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._cell_of)
+
+    def _cell(self, lat, lng):
+        return int(math.floor(lat / self.cell_deg)), int(math.floor(lng / self.cell_deg))
+
+    def add(self, point_id, lat, lng):
+        key = self._cell(lat, lng)
+        with self._lock:
+            if point_id in self._cell_of:
+                self._remove(point_id)
+            cell = self._cells.get(key)
+            if cell is None:
+                cell = self._cells[key] = (array('q'), array('d'), array('d'))
+            cell[0].append(point_id)
+            cell[1].append(lat)
+            cell[2].append(lng)
+            self._cell_of[point_id] = key
+            if self._bounds is None:
+                self._bounds = [key[0], key[0], key[1], key[1]]
+            else:
+                bounds = self._bounds
+                bounds[:] = (min(bounds[0], key[0]), max(bounds[1], key[0]),
+                             min(bounds[2], key[1]), max(bounds[3], key[1]))
+
+    def remove(self, point_id):
+        with self._lock:
+            self._remove(point_id)
+
+    def _remove(self, point_id):
+        key = self._cell_of.pop(point_id, None)
+        if key is None:
+            return
+        ids, lats, lngs = self._cells[key]
+        i = ids.index(point_id)
+        for column in (ids, lats, lngs):
+            column.pop(i)
+        if not ids:
+            del self._cells[key]
+
+    def _scan(self, rows, cols, lat, lng, radius_km, out):
+        for i in rows:
+            for j in cols:
+                cell = self._cells.get((i, j))
+                if cell is None:
+                    continue
+                for point_id, plat, plng in zip(*cell):
+                    distance = haversine_km(lat, lng, plat, plng)
+                    if radius_km is None or distance <= radius_km:
+                        out.append((distance, point_id))
+
+    def within(self, lat, lng, radius_km, limit=None):
+        """
+        Points within a radius, nearest first
+
+        Args:
+            lat, lng: search centre in degrees
+            radius_km: search radius
+            limit: maximum number of results
+
+        Returns:
+            list of (point_id, distance_km)
+        """
+        if not self._cells:
+            return []
+        dlat = radius_km / KM_PER_DEGREE
+        dlng = dlat / max(math.cos(math.radians(min(abs(lat) + dlat, 89.0))), 0.01)
+        i0, j0 = self._cell(lat - dlat, lng - dlng)
+        i1, j1 = self._cell(lat + dlat, lng + dlng)
+        # No further than the cells holding points, however large the radius
+        min_row, max_row, min_col, max_col = self._bounds
+        i0, i1 = max(i0, min_row), min(i1, max_row)
+        j0, j1 = max(j0, min_col), min(j1, max_col)
+        found = []
+        self._scan(range(i0, i1 + 1), range(j0, j1 + 1), lat, lng, radius_km, found)
+        found = heapq.nsmallest(limit, found) if limit else sorted(found)
+        return [(point_id, distance) for distance, point_id in found]
+
+    def nearest(self, lat, lng, k, radius_km=None):
+        """
+        The k nearest points, searching rings of cells outwards
+
+        Stops once the k-th best distance is closer than anything the next
+        ring of cells could hold. Rings only cover cells that hold points
+        and, with a radius, cells that overlap it, so a query far from
+        every point costs no more than `within` over the same radius.
+
+        Args:
+            lat, lng: search centre in degrees
+            k: number of results
+            radius_km: optional cap on the distance
+
+        Returns:
+            list of (point_id, distance_km)
+        """
+        if not self._cells or k < 1:
+            return []
+        ci, cj = self._cell(lat, lng)
+        i0, i1, j0, j1 = self._bounds
+        if radius_km is not None:
+            dlat = radius_km / KM_PER_DEGREE
+            dlng = dlat / max(math.cos(math.radians(min(abs(lat) + dlat, 89.0))), 0.01)
+            lo_i, lo_j = self._cell(lat - dlat, lng - dlng)
+            hi_i, hi_j = self._cell(lat + dlat, lng + dlng)
+            i0, i1 = max(i0, lo_i), min(i1, hi_i)
+            j0, j1 = max(j0, lo_j), min(j1, hi_j)
+            if i0 > i1 or j0 > j1:
+                return []
+        max_ring = max(abs(ci - i0), abs(ci - i1), abs(cj - j0), abs(cj - j1))
+        best = []
+        for ring in range(max_ring + 1):
+            found = []
+            # the ring's top and bottom rows, then its left and right columns
+            cols = range(max(cj - ring, j0), min(cj + ring, j1) + 1)
+            rows = [i for i in {ci - ring, ci + ring} if i0 <= i <= i1]
+            self._scan(rows, cols, lat, lng, radius_km, found)
+            if ring:
+                rows = range(max(ci - ring + 1, i0), min(ci + ring - 1, i1) + 1)
+                cols = [j for j in (cj - ring, cj + ring) if j0 <= j <= j1]
+                self._scan(rows, cols, lat, lng, radius_km, found)
+            best = heapq.nsmallest(k, best + found)
+            # anything in the next ring is at least `ring` whole cells away
+            reach = ring * self.cell_deg * KM_PER_DEGREE * math.cos(
+                math.radians(min(abs(lat) + (ring + 1) * self.cell_deg, 89.0)))
+            if len(best) == k and best[-1][0] <= reach:
+                break
+        return [(point_id, distance) for distance, point_id in best]
+
+#----------------------------------------------------------------------------#
+# Venue locator.
+#----------------------------------------------------------------------------#
+
+class VenueLocator:
+    """
+    Answers "venues near me" queries with the best index available
+
+    PostgreSQL queries the earthdistance GiST index; other databases use a
+    GridIndex built from the venue table on first use and kept current by
+    the create, edit and delete handlers. Venues written by other
+    processes are read from the change log by a background thread every
+    GEO_SYNC_INTERVAL seconds. Each tenant has its own index.
+
+    Args:
+        None
+
+    Returns:
+        None
+    """
+    index = tenant_local()
+    # Change log id the index includes
+    _cursor = tenant_local()
+
+    def __init__(self):
+        self.backend = 'index'
+        self.cell_deg = 0.1
+        self.max_radius_km = 500
+        self._follower = None
+        self._lock = threading.Lock()
+
+    def init_app(self, app):
+        self.cell_deg = app.config.get('GEO_INDEX_CELL_DEG', self.cell_deg)
+        self.backend = app.config.get('GEO_BACKEND', 'auto')
+        self.max_radius_km = app.config.get('GEO_MAX_RADIUS_KM', self.max_radius_km)
+        self._follower = events.Follower(app, 'geo-sync', self.sync, app.config.get('GEO_SYNC_INTERVAL', 1.0))
+        app.extensions['venue_locator'] = self
+
+    def _use_sql(self):
+        if self.backend == 'auto':
+            return db.engine.dialect.name == 'postgresql'
+        return self.backend == 'sql'
+
+    def _get_index(self):
+        if self.index is None:
+            with self._lock:
+                if self.index is None:
+                    # Read first: venues written while the rows are read
+                    # are applied again by the next sync, which is harmless
+                    cursor = events.latest_id()
+                    index = GridIndex(self.cell_deg)
+                    rows = db.session.execute(
+                        select(Venue.id, Venue.latitude, Venue.longitude)
+                        .where(Venue.deleted_at.is_(None), Venue.latitude.isnot(None))
+                        .execution_options(yield_per=10000))
+                    for venue_id, lat, lng in rows:
+                        index.add(venue_id, lat, lng)
+                    self._cursor, self.index = cursor, index
+        self._follower.start()
+        return self.index
+
+    def sync(self):
+        """
+        Applies the venue writes logged since the index's cursor
+
+        Must be called inside an application context.
+
+        Args:
+            None
+
+        Returns:
+            number of venues re-read
+        """
+        if self.index is None:
+            return 0
+        latest = events.latest_id()
+        reread = 0
+        while self._cursor != latest:
+            entries = events.fetch_since(self._cursor, 1000, ('venue',), latest)
+            ids = {entry['entity_id'] for entry in entries}
+            reread += len(ids)
+            rows = db.session.execute(
+                select(Venue.id, Venue.latitude, Venue.longitude)
+                .where(Venue.id.in_(ids), Venue.deleted_at.is_(None)))
+            for venue_id, lat, lng in rows:
+                self.update(venue_id, lat, lng)
+                ids.discard(venue_id)
+            for venue_id in ids:
+                self.remove(venue_id)
+            self._cursor = entries[-1]['id'] if len(entries) == 1000 else latest
+        return reread
+
+    def nearby(self, lat, lng, radius_km=None, k=20):
+        """
+        Venues near a point, nearest first
+
+        Args:
+            lat, lng: search centre in degrees
+            radius_km: only venues within this distance; None searches out
+                to max_radius_km on the grid index and without limit in SQL
+            k: maximum number of venues
+
+        Returns:
+            list of (venue_id, distance_km)
+        """
+        if self._use_sql():
+            return self._nearby_sql(lat, lng, radius_km, k)
+        index = self._get_index()
+        if radius_km is not None:
+            return index.within(lat, lng, radius_km, limit=k)
+        return index.nearest(lat, lng, k, radius_km=self.max_radius_km)
+
+    def _nearby_sql(self, lat, lng, radius_km, k):
+        here = 'll_to_earth(:lat, :lng)'
+        there = 'll_to_earth(latitude, longitude)'
+        where = 'deleted_at IS NULL AND latitude IS NOT NULL'
+        if radius_km is not None:
+            where += f' AND earth_box({here}, :meters) @> {there} AND earth_distance({here}, {there}) <= :meters'
+            order = f'earth_distance({here}, {there})'
+        else:
+            order = f'{there} <-> {here}'
+        rows = db.session.execute(text(
+            f'SELECT id, earth_distance({here}, {there}) / 1000.0 FROM venue '
+            f'WHERE {where} ORDER BY {order} LIMIT :k'),
+            {'lat': lat, 'lng': lng, 'meters': (radius_km or 0) * 1000.0, 'k': k})
+        return [(venue_id, distance) for venue_id, distance in rows]
+
+    def update(self, venue_id, lat, lng):
+        if self.index is None:
+            return
+        if lat is None or lng is None:
+            self.index.remove(venue_id)
+        else:
+            self.index.add(venue_id, lat, lng)
+
+    def remove(self, venue_id):
+        if self.index is not None:
+            self.index.remove(venue_id)
+
+
+venue_locator = VenueLocator()
+
+
+def backfill_coordinates(batch_size=1000):
+    """
+    Geocodes every venue that has no coordinates yet
+
+    Must be called inside an application context.
+
+    Args:
+        batch_size: venues updated per commit
+
+    Returns:
+        number of geocoded venues
+    """
+    updated = 0
+    last_id = 0
+    while True:
+        venues = Venue.query.filter(Venue.latitude.is_(None)).filter(
+            Venue.id > last_id).order_by(Venue.id).limit(batch_size).all()
+        if not venues:
+            return updated
+        for venue in venues:
+            point = geocoder.geocode(venue.city, venue.state)
+            if point:
+                venue.latitude, venue.longitude = point
+                updated += 1
+        last_id = venues[-1].id
+        db.session.commit()
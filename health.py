@@ -0,0 +1,59 @@
+#----------------------------------------------------------------------------#
+# Imports
+#----------------------------------------------------------------------------#
+
+import time
+
+from sqlalchemy import text
+
+#----------------------------------------------------------------------------#
+# Health checks.
+#----------------------------------------------------------------------------#
+
+def pool_status(engine):
+    """
+    Connection pool usage of an engine
+
+    Args:
+        engine: SQLAlchemy engine
+
+    Returns:
+        dict with size, checked_out, overflow and max_overflow; pools that
+        don't track usage (e.g. in-memory SQLite) only report their class
+    """
+    pool = engine.pool
+    status = {'pool': type(pool).__name__}
+    if hasattr(pool, 'checkedout'):
+        status.update(size=pool.size(), checked_out=pool.checkedout(),
+                      overflow=pool.overflow(), max_overflow=getattr(pool, '_max_overflow', 0))
+    return status
+
+
+def check_database(engine):
+    """
+    Whether this worker can serve requests that need the database
+
+    An exhausted pool fails right away rather than waiting for a connection
+    to free up, so a saturated worker is taken out of rotation instead of
+    queueing more requests.
+
+    Args:
+        engine: SQLAlchemy engine
+
+    Returns:
+        (ready, details dict)
+    """
+    details = pool_status(engine)
+    if 'size' in details and details['max_overflow'] >= 0 and \
+            details['checked_out'] >= details['size'] + details['max_overflow']:
+        details['error'] = 'connection pool exhausted'
+        return False, details
+    t0 = time.perf_counter()
+    try:
+        with engine.connect() as connection:
+            connection.execute(text('SELECT 1'))
+    except Exception as error:
+        details['error'] = f'{type(error).__name__}: {error}'
+        return False, details
+    details['latency_ms'] = round((time.perf_counter() - t0) * 1000, 3)
+    return True, details
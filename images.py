@@ -0,0 +1,546 @@
+#----------------------------------------------------------------------------#
+# Imports
+#----------------------------------------------------------------------------#
+
+import functools
+import hashlib
+import hmac
+import http.client
+import io
+import ipaddress
+import os
+import re
+import socket
+import tempfile
+import threading
+import time
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeout
+from urllib.parse import urlsplit
+
+from flask import request, url_for
+
+from metrics import registry
+
+try:
+    from PIL import Image, ImageOps
+except ImportError:  # see requirements.txt; without it originals are served as they are
+    Image = ImageOps = None
+
+# What Pillow raises for images it can't decode, or that unpack to more
+# than twice its own pixel limit
+DECODE_ERRORS = (OSError, ValueError, EOFError, SyntaxError) \
+    + ((Image.DecompressionBombError,) if Image is not None else ())
+
+# Venue and artist pictures are arbitrary full-size remote images. Pages
+# link to /img/<size>/<signature>?src=<url> instead: the first request
+# fetches the image into a content-addressed store (files named by the
+# SHA-256 of their bytes, so every copy of an image is stored once) and a
+# worker pool cuts it to the fixed sizes in IMAGE_SIZES; later requests are
+# a file read, with long-lived cache headers. The signature keeps the proxy
+# from fetching anything the app didn't link to itself.
+
+DIGEST = re.compile(r'^[0-9a-f]{64}$')
+# First bytes of the formats accepted
+MAGIC = (
+    (b'\xff\xd8\xff', 'image/jpeg'),
+    (b'\x89PNG\r\n\x1a\n', 'image/png'),
+    (b'GIF87a', 'image/gif'),
+    (b'GIF89a', 'image/gif'),
+)
+
+fetched_counter = registry.counter('images_fetched_total', 'Remote images fetched', ['result'])
+thumbnails_counter = registry.counter('thumbnails_generated_total', 'Thumbnails generated', ['size'])
+requests_counter = registry.counter('image_requests_total', 'Proxied image requests', ['result'])
+
+
+def sniff(data):
+    """
+    Content type of image bytes, from their first bytes
+
+    Args:
+        data: bytes, at least the first 12
+
+    Returns:
+        content type, or None when it isn't an accepted image format
+    """
+    for magic, content_type in MAGIC:
+        if data.startswith(magic):
+            return content_type
+    if data[:4] == b'RIFF' and data[8:12] == b'WEBP':
+        return 'image/webp'
+    return None
+
+
+class ImageError(Exception):
+    """
+    An image that can't be fetched, stored or thumbnailed
+    """
+
+#----------------------------------------------------------------------------#
+# Fetching.
+#----------------------------------------------------------------------------#
+
+def _check_url(url):
+    parts = urlsplit(url)
+    if parts.scheme not in ('http', 'https') or not parts.hostname:
+        raise ImageError(f'not an http(s) URL: {url}')
+
+
+def _is_public(address):
+    ip = ipaddress.ip_address(address.split('%', 1)[0])
+    if ip.version == 6 and ip.ipv4_mapped is not None:
+        ip = ip.ipv4_mapped
+    return ip.is_global
+
+
+def _connect(address, timeout, source_address=None, allow_private=False):
+    """
+    socket.create_connection, refusing hosts with non-public addresses
+
+    The addresses checked are the ones connected to: resolving the host
+    again to connect would let it answer with a public address for the
+    check and a private one for the connection.
+    """
+    host, port = address
+    try:
+        infos = socket.getaddrinfo(host, port, type=socket.SOCK_STREAM)
+    except socket.gaierror as e:
+        raise ImageError(f'{host}: {e}')
+    if not allow_private:
+        for info in infos:
+            if not _is_public(info[4][0]):
+                raise ImageError(f'{host} resolves to non-public address {info[4][0]}')
+    error = None
+    for family, type_, proto, _, sockaddr in infos:
+        sock = socket.socket(family, type_, proto)
+        try:
+            sock.settimeout(timeout)
+            if source_address:
+                sock.bind(source_address)
+            sock.connect(sockaddr)
+            return sock
+        except OSError as e:
+            sock.close()
+            error = e
+    raise error
+
+
+class _CheckedHTTPConnection(http.client.HTTPConnection):
+
+    def __init__(self, *args, allow_private=False, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._create_connection = functools.partial(_connect, allow_private=allow_private)
+
+
+class _CheckedHTTPSConnection(http.client.HTTPSConnection):
+
+    def __init__(self, *args, allow_private=False, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._create_connection = functools.partial(_connect, allow_private=allow_private)
+
+
+class _CheckedHTTPHandler(urllib.request.HTTPHandler):
+
+    def __init__(self, allow_private):
+        super().__init__()
+        self.allow_private = allow_private
+
+    def http_open(self, req):
+        return self.do_open(_CheckedHTTPConnection, req, allow_private=self.allow_private)
+
+
+class _CheckedHTTPSHandler(urllib.request.HTTPSHandler):
+
+    def __init__(self, allow_private):
+        super().__init__()
+        self.allow_private = allow_private
+
+    def https_open(self, req):
+        return self.do_open(_CheckedHTTPSConnection, req, context=self._context,
+                            allow_private=self.allow_private)
+
+
+class _CheckedRedirects(urllib.request.HTTPRedirectHandler):
+    """
+    Follows redirects only to http(s) URLs; the connection checks the host
+    """
+
+    def redirect_request(self, req, fp, code, msg, headers, newurl):
+        _check_url(newurl)
+        return super().redirect_request(req, fp, code, msg, headers, newurl)
+
+
+def fetch(url, max_bytes, timeout=10, allow_private=False):
+    """
+    Downloads an image
+
+    Connects directly, never through the proxies in the environment, so
+    the address connected to is the one checked.
+
+    Args:
+        url: http(s) URL
+        max_bytes: larger images are refused
+        timeout: seconds for connecting and for each read
+        allow_private: allow loopback and private network addresses
+
+    Returns:
+        bytes
+
+    Raises:
+        ImageError: for anything but an image of at most max_bytes
+    """
+    opener = urllib.request.build_opener(
+        urllib.request.ProxyHandler({}), _CheckedHTTPHandler(allow_private),
+        _CheckedHTTPSHandler(allow_private), _CheckedRedirects())
+    try:
+        _check_url(url)
+        request_ = urllib.request.Request(url, headers={'User-Agent': 'fyyur-images/1.0'})
+        with opener.open(request_, timeout=timeout) as response:
+            data = response.read(max_bytes + 1)
+    # ValueError for a bad port or URL, HTTPException for a broken response
+    except (OSError, ValueError, http.client.HTTPException) as e:
+        raise ImageError(f'{url}: {e}')
+    if len(data) > max_bytes:
+        raise ImageError(f'{url}: larger than {max_bytes} bytes')
+    if sniff(data) is None:
+        raise ImageError(f'{url}: not an image')
+    return data
+
+#----------------------------------------------------------------------------#
+# Images.
+#----------------------------------------------------------------------------#
+
+class Images:
+    """
+    Content-addressed image store, thumbnail workers and the image proxy
+
+    Layout of IMAGE_STORE_DIR:
+        originals/ab/<digest>            image bytes, named by their SHA-256
+        thumbs/ab/<digest>-<w>x<h>       one per IMAGE_SIZES entry
+        sources/cd/<SHA-256 of the URL>  digest the URL was fetched as
+
+    Args:
+        None
+
+    Returns:
+        None
+    """
+
+    def __init__(self):
+        self.app = None
+        self.enabled = True
+        self.root = None
+        self.sizes = {}
+        self.max_bytes = 10 * 1024 * 1024
+        self.max_pixels = 40000000
+        self.quality = 82
+        self.fetch_timeout = 10
+        self.wait = 1.0
+        self.retry_after = 600
+        self.allow_private = False
+        self.max_age = 30 * 86400
+        self.key = b''
+        self._pool = None
+        self._pending = {}
+        self._failed = {}
+        self._lock = threading.Lock()
+
+    def init_app(self, app):
+        self.app = app
+        self.enabled = app.config.get('IMAGE_PROXY_ENABLED', self.enabled)
+        self.root = app.config.get('IMAGE_STORE_DIR', os.path.join(app.root_path, 'media'))
+        self.sizes = dict(app.config.get('IMAGE_SIZES', self.sizes))
+        self.max_bytes = app.config.get('IMAGE_MAX_BYTES', self.max_bytes)
+        self.max_pixels = app.config.get('IMAGE_MAX_PIXELS', self.max_pixels)
+        self.quality = app.config.get('IMAGE_QUALITY', self.quality)
+        self.fetch_timeout = app.config.get('IMAGE_FETCH_TIMEOUT', self.fetch_timeout)
+        self.wait = app.config.get('IMAGE_WAIT', self.wait)
+        self.retry_after = app.config.get('IMAGE_RETRY_AFTER', self.retry_after)
+        self.allow_private = app.config.get('IMAGE_ALLOW_PRIVATE', self.allow_private)
+        self.max_age = app.config.get('IMAGE_MAX_AGE', self.max_age)
+        secret = app.config['SECRET_KEY']
+        self.key = hashlib.sha256(b'images:' + (secret if isinstance(secret, bytes) else secret.encode())).digest()
+        self._pool = ThreadPoolExecutor(app.config.get('IMAGE_WORKERS', 4), thread_name_prefix='images')
+        app.extensions['images'] = self
+        app.jinja_env.filters['thumb'] = self.thumb_url
+        app.jinja_env.globals['image_sizes'] = self.sizes
+
+    # Store
+
+    def _path(self, kind, name):
+        return os.path.join(self.root, kind, name[:2], name)
+
+    def original_path(self, digest):
+        return self._path('originals', digest)
+
+    def thumb_path(self, digest, size):
+        if Image is None:
+            return self.original_path(digest)
+        width, height = self.sizes[size]
+        return self._path('thumbs', f'{digest}-{width}x{height}')
+
+    def _source_path(self, url):
+        return self._path('sources', hashlib.sha256(url.encode()).hexdigest())
+
+    def _write(self, path, data):
+        # Written under a temporary name and renamed, so readers never see
+        # a partial file
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path))
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+            os.replace(tmp, path)
+        except BaseException:
+            os.unlink(tmp)
+            raise
+
+    def store(self, data):
+        """
+        Stores image bytes, once however often they are stored
+
+        Args:
+            data: image bytes
+
+        Returns:
+            digest
+
+        Raises:
+            ImageError: when the bytes aren't an accepted image
+        """
+        if sniff(data) is None:
+            raise ImageError('not an image')
+        digest = hashlib.sha256(data).hexdigest()
+        path = self.original_path(digest)
+        if not os.path.exists(path):
+            self._write(path, data)
+        return digest
+
+    def source_digest(self, url):
+        """
+        Digest a URL was fetched as, None when it hasn't been yet
+        """
+        try:
+            with open(self._source_path(url)) as f:
+                return f.read().strip() or None
+        except FileNotFoundError:
+            return None
+
+    # Thumbnails
+
+    def _thumbnail(self, data, size):
+        width, height = self.sizes[size]
+        with Image.open(io.BytesIO(data)) as image:
+            if image.width * image.height > self.max_pixels:
+                raise ImageError(f'{image.width}x{image.height} is too many pixels')
+            # JPEGs decode at a fraction of their size when that is enough
+            image.draft('RGB', (width * 2, height * 2))
+            image = ImageOps.exif_transpose(image)
+            image = ImageOps.fit(image, (width, height), Image.LANCZOS)
+            out = io.BytesIO()
+            if image.mode in ('RGBA', 'LA') or image.mode == 'P' and 'transparency' in image.info:
+                image.save(out, 'PNG', optimize=True)
+            else:
+                image.convert('RGB').save(out, 'JPEG', quality=self.quality, optimize=True, progressive=True)
+        return out.getvalue()
+
+    def make_thumbnails(self, digest):
+        """
+        Cuts a stored image to every size in IMAGE_SIZES
+
+        Without Pillow there is nothing to do: the original is served for
+        every size, still from the store and cached by clients.
+
+        Args:
+            digest: a stored image
+
+        Returns:
+            digest
+        """
+        missing = [size for size in self.sizes if not os.path.exists(self.thumb_path(digest, size))]
+        if not missing:
+            return digest
+        with open(self.original_path(digest), 'rb') as f:
+            data = f.read()
+        for size in missing:
+            try:
+                self._write(self.thumb_path(digest, size), self._thumbnail(data, size))
+            except DECODE_ERRORS as e:
+                raise ImageError(f'{digest}: {e}')
+            thumbnails_counter.inc(size)
+        return digest
+
+    def _import(self, url):
+        try:
+            digest = self.store(fetch(url, self.max_bytes, self.fetch_timeout, self.allow_private))
+            self.make_thumbnails(digest)
+        except ImageError:
+            fetched_counter.inc('failed')
+            raise
+        self._write(self._source_path(url), digest.encode())
+        fetched_counter.inc('fetched')
+        return digest
+
+    def _submit(self, key, call, *args):
+        """
+        Runs a job in the worker pool, once while it is pending
+
+        Returns:
+            Future
+        """
+        with self._lock:
+            future = self._pending.get(key)
+            if future is not None:
+                return future
+            future = self._pending[key] = self._pool.submit(call, *args)
+        # Not under the lock: a job that is done already runs the callback,
+        # which takes the lock, right away
+        future.add_done_callback(lambda _: self._forget(key))
+        return future
+
+    def _forget(self, key):
+        with self._lock:
+            self._pending.pop(key, None)
+
+    def import_url(self, url):
+        """
+        Fetches a remote image and its thumbnails in the worker pool
+
+        Failures are remembered for IMAGE_RETRY_AFTER seconds and not
+        retried before.
+
+        Args:
+            url: http(s) URL
+
+        Returns:
+            Future of the digest, or None while a failure is remembered
+        """
+        return self._submit_once(('url', url), self._import, url)
+
+    def _submit_once(self, key, call, *args):
+        # Like _submit, but a job that failed isn't run again for
+        # IMAGE_RETRY_AFTER seconds
+        failed_until = self._failed.get(key)
+        if failed_until is not None and failed_until > time.monotonic():
+            return None
+        future = self._submit(key, call, *args)
+        future.add_done_callback(lambda f: f.exception() and self._remember_failure(key))
+        return future
+
+    def _remember_failure(self, key):
+        now = time.monotonic()
+        with self._lock:
+            if len(self._failed) >= 10000:
+                self._failed = {failed: until for failed, until in self._failed.items() if until > now}
+            self._failed[key] = now + self.retry_after
+
+    def thumbnails_of(self, digest):
+        """
+        Makes a stored image's thumbnails in the worker pool
+
+        Failures are remembered like those of import_url.
+
+        Returns:
+            Future of the digest, or None while a failure is remembered
+        """
+        return self._submit_once(('digest', digest), self.make_thumbnails, digest)
+
+    def stored_thumbnail(self, digest, size):
+        """
+        Thumbnail of a stored image, for /images/<digest>/<size>
+
+        Waits up to IMAGE_WAIT seconds when it hasn't been made yet.
+
+        Args:
+            digest: a stored image
+            size: a key of IMAGE_SIZES
+
+        Returns:
+            path, or None when the thumbnail isn't ready or can't be made
+        """
+        path = self.thumb_path(digest, size)
+        if os.path.exists(path):
+            return path
+        future = self.thumbnails_of(digest)
+        if future is None:
+            return None
+        try:
+            future.result(timeout=self.wait)
+        except (FutureTimeout, ImageError):
+            return None
+        return path
+
+    # URLs
+
+    def sign(self, url):
+        return hmac.new(self.key, url.encode(), hashlib.sha256).hexdigest()[:32]
+
+    def verify(self, url, signature):
+        return hmac.compare_digest(self.sign(url), signature)
+
+    def _local_digest(self, src):
+        # URLs of uploads are /images/<digest>, on this host
+        path = urlsplit(src).path
+        prefix = request.script_root + '/images/'
+        if path.startswith(prefix) and DIGEST.match(path[len(prefix):]):
+            return path[len(prefix):]
+        return None
+
+    def thumb_url(self, src, size):
+        """
+        Jinja filter: URL of an image's thumbnail
+
+        Args:
+            src: image URL, as entered for a venue or artist
+            size: a key of IMAGE_SIZES
+
+        Returns:
+            URL to link to; `src` itself when the proxy is disabled or
+            there is no image
+        """
+        if not src or not self.enabled:
+            return src or ''
+        digest = self._local_digest(src)
+        if digest:
+            return url_for('image_thumbnail', digest=digest, size=size)
+        return url_for('image_proxy', size=size, signature=self.sign(src), src=src)
+
+    def thumbnail(self, src, size):
+        """
+        Thumbnail of a remote image, for the proxy
+
+        Waits up to IMAGE_WAIT seconds for an image the store doesn't have
+        yet; the workers carry on after that.
+
+        Args:
+            src: signed image URL
+            size: a key of IMAGE_SIZES
+
+        Returns:
+            (path, digest), or None when the thumbnail isn't ready or the
+            image can't be fetched
+        """
+        digest = self.source_digest(src)
+        if digest is not None:
+            path = self.thumb_path(digest, size)
+            if os.path.exists(path):
+                requests_counter.inc('hit')
+                return path, digest
+        future = self.import_url(src)
+        if future is None:
+            requests_counter.inc('failed')
+            return None
+        try:
+            digest = future.result(timeout=self.wait)
+        except FutureTimeout:
+            requests_counter.inc('pending')
+            return None
+        except ImageError:
+            requests_counter.inc('failed')
+            return None
+        requests_counter.inc('miss')
+        return self.thumb_path(digest, size), digest
+
+
+images = Images()
@@ -0,0 +1,166 @@
+#----------------------------------------------------------------------------#
+# Imports
+#----------------------------------------------------------------------------#
+
+import threading
+
+from flask import Response
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+#----------------------------------------------------------------------------#
+# Metric types.
+#----------------------------------------------------------------------------#
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _format_labels(names, values):
+    if not names:
+        return ''
+    return '{%s}' % ','.join(f'{name}="{_escape(value)}"' for name, value in zip(names, values))
+
+
+class Metric:
+    """
+    A named family of samples, one per combination of label values
+
+    Args:
+        name: metric name, e.g. ratelimit_limited_total
+        help: one-line description
+        labels: label names
+
+    Returns:
+        None
+    """
+    kind = 'untyped'
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def samples(self):
+        with self._lock:
+            return list(self._values.items())
+
+    def value(self, *labels):
+        return self._values.get(labels, 0)
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def inc(self, *labels, amount=1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+
+class Gauge(Metric):
+    kind = 'gauge'
+
+    def set(self, value, *labels):
+        with self._lock:
+            self._values[labels] = value
+
+    def inc(self, *labels, amount=1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def dec(self, *labels, amount=1):
+        self.inc(*labels, amount=-amount)
+
+
+class CallbackGauge(Metric):
+    """
+    Gauge read from a function at scrape time
+
+    Args:
+        name, help, labels: as for Metric
+        callback: returns a number, or a dict of label-value tuple -> number
+
+    Returns:
+        None
+    """
+    kind = 'gauge'
+
+    def __init__(self, name, help, callback, labels=()):
+        super().__init__(name, help, labels)
+        self.callback = callback
+
+    def samples(self):
+        value = self.callback()
+        if isinstance(value, dict):
+            return list(value.items())
+        return [((), value)]
+
+#----------------------------------------------------------------------------#
+# Registry.
+#----------------------------------------------------------------------------#
+
+class Registry:
+    """
+    Process-wide metrics, served in the Prometheus text format at /metrics
+
+    Subsystems register their metrics once at import or init time and
+    update them in place; registering the same name twice returns the
+    existing metric.
+
+    Args:
+        None
+
+    Returns:
+        None
+    """
+
+    def __init__(self):
+        self._metrics = {}
+        self._lock = threading.Lock()
+
+    def _register(self, metric):
+        with self._lock:
+            return self._metrics.setdefault(metric.name, metric)
+
+    def counter(self, name, help, labels=()):
+        return self._register(Counter(name, help, labels))
+
+    def gauge(self, name, help, labels=()):
+        return self._register(Gauge(name, help, labels))
+
+    def callback_gauge(self, name, help, callback, labels=()):
+        return self._register(CallbackGauge(name, help, callback, labels))
+
+    def get(self, name):
+        return self._metrics.get(name)
+
+    def render(self):
+        """
+        Formats every metric in the Prometheus text exposition format
+
+        Args:
+            None
+
+        Returns:
+            str
+        """
+        lines = []
+        for metric in sorted(self._metrics.values(), key=lambda metric: metric.name):
+            lines.append(f'# HELP {metric.name} {metric.help}')
+            lines.append(f'# TYPE {metric.name} {metric.kind}')
+            for labels, value in sorted(metric.samples(), key=lambda sample: sample[0]):
+                lines.append(f'{metric.name}{_format_labels(metric.labels, labels)} {value}')
+        return '\n'.join(lines) + '\n'
+
+    def init_app(self, app):
+        app.extensions['metrics'] = self
+        if app.config.get('METRICS_ENABLED', True):
+            app.add_url_rule('/metrics', endpoint='metrics', view_func=self.view)
+
+    def view(self):
+        return Response(self.render(), content_type=CONTENT_TYPE)
+
+
+registry = Registry()
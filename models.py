@@ -1,8 +1,119 @@
-from app import db
-# from flask_sqlalchemy import SQLAlchemy
-# db = SQLAlchemy()
+from datetime import datetime
 
-class Show(db.Model):
+from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy.ext.associationproxy import association_proxy
+from sqlalchemy.orm import declared_attr
+
+from tenants import TenantSession
+# Bound to the app with db.init_app() in app.py, which avoids importing app
+# from here (and the circular import that came with it). Sessions bind to
+# the current tenant's database (see tenants.py)
+db = SQLAlchemy(session_options={'class_': TenantSession})
+
+# Rows with deleted_at set are soft-deleted; partial indexes on the live rows
+# keep the hot listing queries from wading through them
+LIVE_ROWS = db.text('deleted_at IS NULL')
+
+
+class SoftDeleteMixin:
+    """
+    Adds a deleted_at column and a query over the rows that aren't deleted
+
+    Args:
+        None
+
+    Returns:
+        None
+    """
+    deleted_at = db.Column(db.DateTime, nullable=True)
+
+    @classmethod
+    def live(cls):
+        return cls.query.filter(cls.deleted_at.is_(None))
+
+
+class VersionedMixin:
+    """
+    Adds a version_id column for optimistic concurrency control
+
+    The ORM adds `AND version_id = <loaded version>` to every UPDATE of the
+    row and bumps the version, raising StaleDataError when someone else
+    updated it first.
+
+    Args:
+        None
+
+    Returns:
+        None
+    """
+    version_id = db.Column(db.Integer, nullable=False, server_default='1')
+
+    @declared_attr.directive
+    def __mapper_args__(cls):
+        return {'version_id_col': cls.__table__.c.version_id}
+
+class Genre(db.Model):
+    """
+    Database Model for Genre Table
+
+    Venues and artists link to genres through venue_genre and artist_genre.
+
+    Args:
+        None
+
+    Returns:
+        None
+    """
+    __tablename__ = 'genre'
+
+    id = db.Column(db.Integer, primary_key=True)
+    name = db.Column(db.String(120), nullable=False, unique=True)
+
+    @classmethod
+    def named(cls, name):
+        """
+        The genre with this name, created if it doesn't exist yet
+        """
+        with db.session.no_autoflush:
+            genre = cls.query.filter_by(name=name).first()
+        return genre or cls(name=name)
+
+
+# Association tables; the (genre_id, ...) indexes serve the genre filters
+venue_genre = db.Table(
+    'venue_genre',
+    db.Column('venue_id', db.Integer, db.ForeignKey('venue.id', ondelete='CASCADE'), primary_key=True),
+    db.Column('genre_id', db.Integer, db.ForeignKey('genre.id', ondelete='CASCADE'), primary_key=True),
+    db.Index('ix_venue_genre_genre', 'genre_id', 'venue_id'),
+)
+artist_genre = db.Table(
+    'artist_genre',
+    db.Column('artist_id', db.Integer, db.ForeignKey('artist.id', ondelete='CASCADE'), primary_key=True),
+    db.Column('genre_id', db.Integer, db.ForeignKey('genre.id', ondelete='CASCADE'), primary_key=True),
+    db.Index('ix_artist_genre_genre', 'genre_id', 'artist_id'),
+)
+
+
+class GenreFacet(db.Model):
+    """
+    Database Model for the live venues and artists per genre
+
+    Kept up to date on every write by genres.py, so facet counts are a
+    lookup rather than a count over the association tables.
+
+    Args:
+        None
+
+    Returns:
+        None
+    """
+    __tablename__ = 'genre_facet'
+
+    kind = db.Column(db.String(20), primary_key=True)
+    genre_id = db.Column(db.Integer, db.ForeignKey('genre.id', ondelete='CASCADE'), primary_key=True)
+    count = db.Column(db.Integer, nullable=False, default=0)
+
+class Show(VersionedMixin, db.Model):
     """
     Database Model for Show Table
 
@@ -13,13 +124,24 @@ class Show(db.Model):
         None
     """
     __tablename__ = 'show'
+    # Upcoming/past lookups per venue or artist are range scans on these;
+    # on PostgreSQL the table is partitioned by month (see partitions.py)
+    __table_args__ = (
+        db.Index('ix_show_venue_start', 'venue_id', 'start_time'),
+        db.Index('ix_show_artist_start', 'artist_id', 'start_time'),
+        db.Index('ix_show_start', 'start_time'),
+        {'postgresql_partition_by': 'RANGE (start_time)',
+         'info': {'partition_key': 'start_time'}},
+    )
 
     id = db.Column(db.Integer, primary_key=True)
-    venue_id = db.Column(db.Integer, db.ForeignKey('venue.id'))
-    artist_id = db.Column(db.Integer, db.ForeignKey('artist.id'))
+    venue_id = db.Column(db.Integer, db.ForeignKey('venue.id', ondelete='CASCADE'))
+    artist_id = db.Column(db.Integer, db.ForeignKey('artist.id', ondelete='CASCADE'))
     start_time = db.Column(db.DateTime)
+    # When the show was booked; NULL for shows booked before it was recorded
+    created_at = db.Column(db.DateTime, default=datetime.now)
 
-class Venue(db.Model):
+class Venue(SoftDeleteMixin, VersionedMixin, db.Model):
     """
     Database Model for Venue Table
 
@@ -30,22 +152,40 @@ class Venue(db.Model):
         None
     """
     __tablename__ = 'venue'
+    __table_args__ = (
+        db.Index('ix_venue_live_city_state', 'city', 'state',
+                 postgresql_where=LIVE_ROWS, sqlite_where=LIVE_ROWS),
+        # Listing filters and their sort order (see filters.py)
+        db.Index('ix_venue_live_state_city', 'state', 'city', 'name',
+                 postgresql_where=LIVE_ROWS, sqlite_where=LIVE_ROWS),
+        # Show form venue picker
+        db.Index('ix_venue_live_name', 'name',
+                 postgresql_where=LIVE_ROWS, sqlite_where=LIVE_ROWS),
+    )
 
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String)
     city = db.Column(db.String(120))
     state = db.Column(db.String(120))
     address = db.Column(db.String(120))
+    # Geocoded from city/state by geo.geocoder
+    latitude = db.Column(db.Float)
+    longitude = db.Column(db.Float)
     phone = db.Column(db.String(120))
     image_link = db.Column(db.String(500))
     website = db.Column(db.String(120))
     facebook_link = db.Column(db.String(120))
-    genres = db.Column(db.ARRAY(db.String(500)))
+    genre_rows = db.relationship('Genre', secondary=venue_genre, order_by=Genre.name,
+                                 passive_deletes=True)
+    # Genre names, read and assigned as a list of strings
+    genres = association_proxy('genre_rows', 'name', creator=Genre.named)
     seeking_talent = db.Column(db.Boolean)
     seeking_description = db.Column(db.String(500))
-    shows = db.relationship('Show', backref='venues', lazy=True)
+    # Tickets put on sale for each new show, unless the show sets its own
+    capacity = db.Column(db.Integer)
+    shows = db.relationship('Show', backref='venue', lazy=True, passive_deletes=True)
 
-class Artist(db.Model):
+class Artist(SoftDeleteMixin, VersionedMixin, db.Model):
     """
     Database Model for Artist Table
 
@@ -56,16 +196,138 @@ class Artist(db.Model):
         None
     """
     __tablename__ = 'artist'
+    __table_args__ = (
+        db.Index('ix_artist_live_name', 'name',
+                 postgresql_where=LIVE_ROWS, sqlite_where=LIVE_ROWS),
+        db.Index('ix_artist_live_state_city', 'state', 'city',
+                 postgresql_where=LIVE_ROWS, sqlite_where=LIVE_ROWS),
+    )
 
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String)
     city = db.Column(db.String(120))
     state = db.Column(db.String(120))
     phone = db.Column(db.String(120))
-    genres = db.Column(db.ARRAY(db.String(120)))
+    genre_rows = db.relationship('Genre', secondary=artist_genre, order_by=Genre.name,
+                                 passive_deletes=True)
+    genres = association_proxy('genre_rows', 'name', creator=Genre.named)
     website = db.Column(db.String(120))
     image_link = db.Column(db.String(500))
     facebook_link = db.Column(db.String(120))
     seeking_venue = db.Column(db.Boolean)
     seeking_description = db.Column(db.String(500))
-    shows = db.relationship('Show', backref='artists', lazy=True)
+    shows = db.relationship('Show', backref='artist', lazy=True, passive_deletes=True)
+
+class ChangeLog(db.Model):
+    """
+    Database Model for the ordered log of writes behind the /events feed
+
+    Readers only go as far as events.latest_id(), below which every id has
+    committed, so a client that has seen id N resumes from everything
+    after N.
+
+    Args:
+        None
+
+    Returns:
+        None
+    """
+    __tablename__ = 'change_log'
+
+    id = db.Column(db.BigInteger().with_variant(db.Integer, 'sqlite'), primary_key=True)
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.now)
+    entity = db.Column(db.String(20), nullable=False)
+    entity_id = db.Column(db.Integer, nullable=False)
+    action = db.Column(db.String(20), nullable=False)
+    data = db.Column(db.JSON)
+
+class SessionRecord(db.Model):
+    """
+    Database Model for server-side sessions (see sessions.py)
+
+    Args:
+        None
+
+    Returns:
+        None
+    """
+    __tablename__ = 'http_session'
+
+    sid = db.Column(db.String(64), primary_key=True)
+    data = db.Column(db.Text, nullable=False)
+    expires_at = db.Column(db.DateTime, nullable=False, index=True)
+
+class TicketShard(db.Model):
+    """
+    Database Model for the unsold tickets of a show, split over shards
+
+    Buyers decrement a random shard, so concurrent purchases lock different
+    rows instead of queueing on one counter (see tickets.py). show_id has
+    no foreign key: on PostgreSQL show.id alone isn't unique across the
+    partitions of `show`.
+
+    Args:
+        None
+
+    Returns:
+        None
+    """
+    __tablename__ = 'ticket_shard'
+    __table_args__ = (
+        db.CheckConstraint('remaining >= 0', name='ck_ticket_shard_remaining'),
+    )
+
+    show_id = db.Column(db.Integer, primary_key=True)
+    shard = db.Column(db.Integer, primary_key=True)
+    capacity = db.Column(db.Integer, nullable=False)
+    remaining = db.Column(db.Integer, nullable=False)
+
+class TicketHold(db.Model):
+    """
+    Database Model for tickets held for a buyer until purchase or expiry
+
+    A hold taking tickets from several shards has one row per shard, all
+    with the same id. status goes from 'held' to 'purchased', 'released'
+    or 'expired'; the last two give the tickets back to their shard.
+
+    Args:
+        None
+
+    Returns:
+        None
+    """
+    __tablename__ = 'ticket_hold'
+    __table_args__ = (
+        # The sweeper's scan for expired holds
+        db.Index('ix_ticket_hold_held_expiry', 'expires_at',
+                 postgresql_where=db.text("status = 'held'"), sqlite_where=db.text("status = 'held'")),
+    )
+
+    id = db.Column(db.String(43), primary_key=True)
+    shard = db.Column(db.Integer, primary_key=True)
+    show_id = db.Column(db.Integer, nullable=False, index=True)
+    quantity = db.Column(db.Integer, nullable=False)
+    status = db.Column(db.String(20), nullable=False, default='held')
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.now)
+    expires_at = db.Column(db.DateTime, nullable=False)
+
+class PurgeJob(db.Model):
+    """
+    Database Model for hard deletes whose shows are still being purged
+
+    Written with the soft delete and removed once the row is gone, so
+    purges cut short by a restart are picked up again (see deletion.py).
+    claimed_at keeps several processes from purging the same row at once.
+
+    Args:
+        None
+
+    Returns:
+        None
+    """
+    __tablename__ = 'purge_job'
+
+    entity = db.Column(db.String(20), primary_key=True)
+    entity_id = db.Column(db.Integer, primary_key=True)
+    requested_at = db.Column(db.DateTime, nullable=False, default=datetime.now)
+    claimed_at = db.Column(db.DateTime, nullable=True)
@@ -0,0 +1,271 @@
+#----------------------------------------------------------------------------#
+# Imports
+#----------------------------------------------------------------------------#
+
+import re
+import threading
+from datetime import date
+
+from sqlalchemy import DDL, PrimaryKeyConstraint, event, text
+from sqlalchemy.ext.compiler import compiles
+from sqlalchemy.orm import contains_eager
+
+from models import db, Show, Venue, Artist
+from tenants import tenancy, use_tenant
+
+#----------------------------------------------------------------------------#
+# Partitioned show table.
+#----------------------------------------------------------------------------#
+
+# On PostgreSQL `show` is range-partitioned by month on start_time (see the
+# table options in models.py). Elsewhere it stays a single table and these
+# helpers do nothing; the (venue_id, start_time) and (artist_id, start_time)
+# indexes keep range queries cheap there.
+
+PARTITION_NAME = re.compile(r'^show_p(\d{4})_(\d{2})$')
+# Serializes partition maintenance across workers
+ADVISORY_LOCK_ID = 30001
+
+
+@compiles(PrimaryKeyConstraint, 'postgresql')
+def _partitioned_primary_key(constraint, compiler, **kw):
+    """
+    Adds the partition key to the primary key of partitioned tables
+
+    PostgreSQL requires every unique constraint of a partitioned table to
+    include its partition key; the ORM keeps treating id alone as the key.
+    """
+    partition_key = constraint.table.info.get('partition_key')
+    if not partition_key or partition_key in constraint.columns:
+        return compiler.visit_primary_key_constraint(constraint, **kw)
+    columns = [column.name for column in constraint.columns] + [partition_key]
+    prefix = f'CONSTRAINT {compiler.preparer.format_constraint(constraint)} ' if constraint.name else ''
+    return prefix + 'PRIMARY KEY (%s)' % ', '.join(compiler.preparer.quote(name) for name in columns)
+
+
+# Catches rows outside every monthly partition until they are moved out
+event.listen(Show.__table__, 'after_create', DDL(
+    'CREATE TABLE IF NOT EXISTS show_default PARTITION OF show DEFAULT'
+).execute_if(dialect='postgresql'))
+
+
+def is_partitioned():
+    return db.engine.dialect.name == 'postgresql'
+
+
+def month_start(day, offset=0):
+    """
+    First day of the month `offset` months after the month of `day`
+
+    Args:
+        day: date or datetime
+        offset: months to move, may be negative
+
+    Returns:
+        date
+    """
+    months = day.year * 12 + day.month - 1 + offset
+    return date(months // 12, months % 12 + 1, 1)
+
+
+def partition_name(month):
+    return f'show_p{month.year:04d}_{month.month:02d}'
+
+
+def list_partitions(schema=None):
+    """
+    Monthly partitions currently attached to `show`
+
+    Args:
+        schema: schema of the show table, defaults to the search_path
+
+    Returns:
+        sorted list of partition month start dates
+    """
+    if not is_partitioned():
+        return []
+    rows = db.session.execute(text(
+        'SELECT c.relname FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid '
+        'WHERE i.inhparent = CAST(:parent AS regclass)'), {'parent': f'{schema}.show' if schema else 'show'})
+    months = []
+    for (name,) in rows:
+        match = PARTITION_NAME.match(name)
+        if match:
+            months.append(date(int(match.group(1)), int(match.group(2)), 1))
+    return sorted(months)
+
+
+def create_partition(month):
+    """
+    Creates and attaches the partition of one month
+
+    Rows of that month already sitting in the default partition are moved
+    into the new partition before it is attached.
+
+    Args:
+        month: first day of the month
+
+    Returns:
+        None
+    """
+    name = partition_name(month)
+    bounds = {'lower': month, 'upper': month_start(month, 1)}
+    db.session.execute(text(
+        f'CREATE TABLE {name} (LIKE show INCLUDING DEFAULTS INCLUDING CONSTRAINTS)'))
+    db.session.execute(text(
+        f'WITH moved AS (DELETE FROM show_default WHERE start_time >= :lower AND start_time < :upper '
+        f'RETURNING *) INSERT INTO {name} SELECT * FROM moved'), bounds)
+    db.session.execute(text(
+        f"ALTER TABLE show ATTACH PARTITION {name} "
+        f"FOR VALUES FROM ('{bounds['lower']}') TO ('{bounds['upper']}')"))
+
+
+def ensure_partitions(months_ahead=12, since=None, today=None):
+    """
+    Makes sure monthly partitions exist from `since` to `months_ahead`
+
+    Safe to run from several workers at once; commits the session.
+
+    Args:
+        months_ahead: months after the current one to create
+        since: first month to create, defaults to the current month
+        today: reference date, defaults to today
+
+    Returns:
+        list of created partition names
+    """
+    if not is_partitioned():
+        return []
+    today = today or date.today()
+    db.session.execute(text('SELECT pg_advisory_xact_lock(:id)'), {'id': ADVISORY_LOCK_ID})
+    existing = set(list_partitions())
+    month = month_start(since or today)
+    last = month_start(today, months_ahead)
+    created = []
+    while month <= last:
+        if month not in existing:
+            create_partition(month)
+            created.append(partition_name(month))
+        month = month_start(month, 1)
+    db.session.commit()
+    return created
+
+
+def archive_partitions(before, schema='archive'):
+    """
+    Detaches partitions that end before a date and moves them to a schema
+
+    Archived shows disappear from every query on `show` but stay available
+    in `<schema>.show_pYYYY_MM` tables.
+
+    Args:
+        before: date; months ending on or before it are archived
+        schema: schema to move detached partitions into
+
+    Returns:
+        list of archived partition names
+    """
+    if not is_partitioned():
+        return []
+    db.session.execute(text('SELECT pg_advisory_xact_lock(:id)'), {'id': ADVISORY_LOCK_ID})
+    db.session.execute(text(f'CREATE SCHEMA IF NOT EXISTS {schema}'))
+    archived = []
+    for month in list_partitions():
+        if month_start(month, 1) > before:
+            break
+        name = partition_name(month)
+        db.session.execute(text(f'ALTER TABLE show DETACH PARTITION {name}'))
+        db.session.execute(text(f'ALTER TABLE {name} SET SCHEMA {schema}'))
+        archived.append(name)
+    db.session.commit()
+    return archived
+
+#----------------------------------------------------------------------------#
+# Maintenance.
+#----------------------------------------------------------------------------#
+
+class PartitionMaintainer:
+    """
+    Keeps future monthly partitions of `show` created
+
+    Started by the first request a worker serves, not on import, so the
+    CLI, the benchmarks and a pre-fork server master don't run one. Runs
+    right away and then every SHOW_PARTITION_CHECK_INTERVAL seconds in a
+    daemon thread, so bookings never land in the default partition. Does
+    nothing on databases without partitioning.
+
+    Args:
+        None
+
+    Returns:
+        None
+    """
+
+    def __init__(self):
+        self.app = None
+        self.months_ahead = 12
+        self.interval = 24 * 3600
+        self._thread = None
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+
+    def init_app(self, app):
+        self.app = app
+        self.months_ahead = app.config.get('SHOW_PARTITION_MONTHS_AHEAD', self.months_ahead)
+        self.interval = app.config.get('SHOW_PARTITION_CHECK_INTERVAL', self.interval)
+        app.extensions['partitions'] = self
+        if app.config.get('SHOW_PARTITION_MAINTENANCE'):
+            app.before_request(self.start)
+
+    def start(self):
+        # Threads don't survive a fork, so each worker starts its own
+        if self._thread is None or not self._thread.is_alive():
+            with self._lock:
+                if self._thread is None or not self._thread.is_alive():
+                    self._thread = threading.Thread(target=self._run, name='partitions', daemon=True)
+                    self._thread.start()
+
+    def run_once(self):
+        created = []
+        for tenant in tenancy.names():
+            with use_tenant(tenant), self.app.app_context():
+                try:
+                    created += ensure_partitions(self.months_ahead)
+                except Exception:
+                    db.session.rollback()
+                    self.app.logger.exception('Creating show partitions failed')
+        return created
+
+    def _run(self):
+        while not self._stop.is_set():
+            self.run_once()
+            self._stop.wait(self.interval)
+
+    def stop(self):
+        self._stop.set()
+
+
+maintainer = PartitionMaintainer()
+
+
+def shows_between(start, end):
+    """
+    Shows of live venues and artists with start_time in [start, end)
+
+    The plain range predicate on start_time lets PostgreSQL prune every
+    partition outside the window.
+
+    Args:
+        start: datetime, inclusive
+        end: datetime, exclusive
+
+    Returns:
+        list of Show rows ordered by start_time, venue and artist loaded
+    """
+    return (db.session.query(Show)
+            .join(Venue).join(Artist)
+            .filter(Show.start_time >= start, Show.start_time < end)
+            .filter(Venue.deleted_at.is_(None), Artist.deleted_at.is_(None))
+            .options(contains_eager(Show.venue), contains_eager(Show.artist))
+            .order_by(Show.start_time)
+            .all())
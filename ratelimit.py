@@ -0,0 +1,291 @@
+#----------------------------------------------------------------------------#
+# Imports
+#----------------------------------------------------------------------------#
+
+import math
+import threading
+import time
+from collections import OrderedDict
+
+from flask import g, request
+from werkzeug.exceptions import ServiceUnavailable, TooManyRequests
+
+from metrics import registry
+
+try:
+    import redis
+except ImportError:  # only needed for a shared redis:// store
+    redis = None
+
+#----------------------------------------------------------------------------#
+# Token bucket stores.
+#----------------------------------------------------------------------------#
+
+class MemoryStore:
+    """
+    Token buckets in process memory, for a single worker
+
+    Idle buckets are evicted least recently used first once there are
+    more than `max_entries`; an evicted bucket simply starts full again.
+
+    Args:
+        max_entries: maximum number of buckets kept
+
+    Returns:
+        None
+    """
+
+    def __init__(self, max_entries=100000):
+        self.max_entries = max_entries
+        self._buckets = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._buckets)
+
+    def take(self, key, rate, burst, cost=1):
+        """
+        Takes `cost` tokens from a bucket refilling at `rate` per second
+
+        Args:
+            key: bucket key
+            rate: tokens added per second
+            burst: bucket capacity
+            cost: tokens this request needs
+
+        Returns:
+            (allowed, remaining tokens, seconds until `cost` tokens are back)
+        """
+        now = time.monotonic()
+        with self._lock:
+            tokens, updated = self._buckets.pop(key, (burst, now))
+            tokens = min(burst, tokens + (now - updated) * rate)
+            allowed = tokens >= cost
+            if allowed:
+                tokens -= cost
+            self._buckets[key] = (tokens, now)
+            if len(self._buckets) > self.max_entries:
+                self._buckets.popitem(last=False)
+        return allowed, tokens, 0.0 if allowed else (cost - tokens) / rate
+
+
+# Same algorithm as MemoryStore.take, run atomically inside Redis on the
+# server clock so workers on different hosts share one bucket
+TAKE_SCRIPT = '''
+local time = redis.call('TIME')
+local now = tonumber(time[1]) + tonumber(time[2]) / 1000000
+local rate, burst, cost = tonumber(ARGV[1]), tonumber(ARGV[2]), tonumber(ARGV[3])
+local state = redis.call('HMGET', KEYS[1], 'tokens', 'updated')
+local tokens = tonumber(state[1]) or burst
+local updated = tonumber(state[2]) or now
+tokens = math.min(burst, tokens + math.max(0, now - updated) * rate)
+local allowed = 0
+if tokens >= cost then
+  tokens = tokens - cost
+  allowed = 1
+end
+redis.call('HSET', KEYS[1], 'tokens', tostring(tokens), 'updated', tostring(now))
+redis.call('EXPIRE', KEYS[1], math.ceil(burst / rate) + 1)
+return {allowed, tostring(tokens)}
+'''
+
+
+class RedisStore:
+    """
+    Token buckets shared by every worker through Redis
+
+    Args:
+        url: redis:// URL
+        prefix: key prefix
+
+    Returns:
+        None
+    """
+
+    def __init__(self, url, prefix='ratelimit:'):
+        if redis is None:
+            raise RuntimeError('RATELIMIT_STORAGE_URL is a redis:// URL but the redis package is not installed')
+        self.client = redis.Redis.from_url(url)
+        self.prefix = prefix
+        self._take = self.client.register_script(TAKE_SCRIPT)
+
+    def __len__(self):
+        return 0  # not tracked, buckets expire in Redis
+
+    def take(self, key, rate, burst, cost=1):
+        allowed, tokens = self._take(keys=[self.prefix + key], args=[rate, burst, cost])
+        tokens = float(tokens)
+        return bool(allowed), tokens, 0.0 if allowed else (cost - tokens) / rate
+
+
+def create_store(url, max_entries=100000):
+    """
+    Store for a RATELIMIT_STORAGE_URL
+
+    Args:
+        url: memory:// or redis://host:port/db
+        max_entries: bucket limit of the memory store
+
+    Returns:
+        MemoryStore or RedisStore
+    """
+    if url.startswith(('redis://', 'rediss://', 'unix://')):
+        return RedisStore(url)
+    if url.startswith('memory://'):
+        return MemoryStore(max_entries)
+    raise ValueError(f'unsupported RATELIMIT_STORAGE_URL: {url}')
+
+#----------------------------------------------------------------------------#
+# Admission control.
+#----------------------------------------------------------------------------#
+
+class ConcurrencyGate:
+    """
+    Caps the number of expensive requests a worker runs at once
+
+    A request over the cap waits up to `timeout` seconds for a slot and is
+    then turned away, so a burst never queues up behind a saturated
+    database pool.
+
+    Args:
+        limit: maximum concurrent requests
+        timeout: seconds to wait for a slot
+
+    Returns:
+        None
+    """
+
+    def __init__(self, limit, timeout):
+        self.limit = limit
+        self.timeout = timeout
+        self.in_flight = 0
+        self._slots = threading.BoundedSemaphore(limit)
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        if not self._slots.acquire(timeout=self.timeout):
+            return False
+        with self._lock:
+            self.in_flight += 1
+        return True
+
+    def release(self):
+        with self._lock:
+            self.in_flight -= 1
+        self._slots.release()
+
+#----------------------------------------------------------------------------#
+# Limiter.
+#----------------------------------------------------------------------------#
+
+class Limiter:
+    """
+    Rate limiting and admission control for the write and search routes
+
+    Each limited endpoint has a token bucket per client
+    (RATELIMIT_CLIENT_LIMITS) and optionally one shared by all clients
+    (RATELIMIT_ROUTE_LIMITS), both given as (tokens per second, burst).
+    Requests that run out of tokens get 429. Endpoints listed in
+    RATELIMIT_CONCURRENCY_ROUTES additionally go through a concurrency
+    gate and get 503 when it stays full. Both carry Retry-After and the
+    short default error body: rejecting has to stay far cheaper than
+    rendering a page, or a flood of rejected requests slows everyone down.
+
+    Args:
+        None
+
+    Returns:
+        None
+    """
+
+    def __init__(self):
+        self.app = None
+        self.enabled = False
+        self.store = None
+        self.gate = None
+        self.client_limits = {}
+        self.route_limits = {}
+        self.gated = frozenset()
+        self.allowed = registry.counter(
+            'ratelimit_allowed_total', 'Requests admitted by the rate limiter', ['endpoint'])
+        self.limited = registry.counter(
+            'ratelimit_limited_total', 'Requests rejected with 429', ['endpoint', 'scope'])
+        self.shed = registry.counter(
+            'admission_rejected_total', 'Requests rejected with 503 by the concurrency cap', ['endpoint'])
+        registry.callback_gauge(
+            'admission_in_flight', 'Requests holding a concurrency slot',
+            lambda: self.gate.in_flight if self.gate else 0)
+        registry.callback_gauge(
+            'admission_limit', 'Concurrency cap on expensive routes',
+            lambda: self.gate.limit if self.gate else 0)
+        registry.callback_gauge(
+            'ratelimit_buckets', 'Token buckets held in process memory',
+            lambda: len(self.store) if self.store is not None else 0)
+
+    def init_app(self, app):
+        self.app = app
+        app.extensions['limiter'] = self
+        self.enabled = app.config.get('RATELIMIT_ENABLED', True)
+        self.store = create_store(app.config.get('RATELIMIT_STORAGE_URL', 'memory://'),
+                                  app.config.get('RATELIMIT_MAX_BUCKETS', 100000))
+        self.client_limits = dict(app.config.get('RATELIMIT_CLIENT_LIMITS', {}))
+        self.route_limits = dict(app.config.get('RATELIMIT_ROUTE_LIMITS', {}))
+        self.gated = frozenset(app.config.get('RATELIMIT_CONCURRENCY_ROUTES', ()))
+        if self.gated:
+            self.gate = ConcurrencyGate(app.config.get('RATELIMIT_MAX_CONCURRENT', 8),
+                                        app.config.get('RATELIMIT_ADMISSION_TIMEOUT', 0.25))
+        app.before_request(self.before_request)
+        app.teardown_request(self.teardown_request)
+
+    def client_id(self):
+        """
+        Identifies the client; behind a proxy wrap the app in ProxyFix
+        """
+        return request.remote_addr or 'unknown'
+
+    def check(self, endpoint, client):
+        """
+        Takes a token from the client and route buckets of an endpoint
+
+        Args:
+            endpoint: Flask endpoint name
+            client: client identifier
+
+        Returns:
+            None if allowed, else (scope, seconds to wait)
+        """
+        limit = self.client_limits.get(endpoint)
+        if limit:
+            allowed, _, wait = self.store.take(f'client:{endpoint}:{client}', *limit)
+            if not allowed:
+                return 'client', wait
+        limit = self.route_limits.get(endpoint)
+        if limit:
+            allowed, _, wait = self.store.take(f'route:{endpoint}', *limit)
+            if not allowed:
+                return 'route', wait
+        return None
+
+    def before_request(self):
+        if not self.enabled:
+            return
+        endpoint = request.endpoint
+        if endpoint in self.client_limits or endpoint in self.route_limits:
+            rejected = self.check(endpoint, self.client_id())
+            if rejected:
+                scope, wait = rejected
+                self.limited.inc(endpoint, scope)
+                raise TooManyRequests(retry_after=max(1, math.ceil(wait)))
+            self.allowed.inc(endpoint)
+        if endpoint in self.gated:
+            if not self.gate.acquire():
+                self.shed.inc(endpoint)
+                raise ServiceUnavailable(retry_after=1)
+            g.admission_slot = True
+
+    def teardown_request(self, exc):
+        if g.pop('admission_slot', False):
+            self.gate.release()
+
+
+limiter = Limiter()
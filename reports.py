@@ -0,0 +1,408 @@
+#----------------------------------------------------------------------------#
+# Imports
+#----------------------------------------------------------------------------#
+
+import threading
+import time
+from collections import Counter
+from datetime import datetime, timezone
+
+from sqlalchemy import func, select
+
+import events
+from cache import cache
+from genres import GENRE_LINKS
+from metrics import registry
+from models import db, Artist, ChangeLog, Genre, Show, Venue
+
+try:
+    import numpy as np
+except ImportError:  # optional, the streamed reports fall back to plain Python
+    np = None
+
+# Lead times are bucketed by day; the last bucket holds everything longer
+LEAD_DAYS = 366
+DAY = 86400.0
+
+#----------------------------------------------------------------------------#
+# SQL helpers.
+#----------------------------------------------------------------------------#
+
+def _month(column):
+    """
+    YYYY-MM of a timestamp column, in SQL
+    """
+    if db.engine.dialect.name == 'postgresql':
+        return func.to_char(column, 'YYYY-MM')
+    return func.strftime('%Y-%m', column)
+
+
+def _epoch(column):
+    """
+    Seconds since 1970 of a naive timestamp column, in SQL
+    """
+    if db.engine.dialect.name == 'postgresql':
+        return func.extract('epoch', column)
+    # julianday() is a fraction of a day, off by microseconds
+    return func.round((func.julianday(column) - 2440587.5) * DAY)
+
+
+def _chunks(columns, conditions, chunk_size):
+    """
+    Streams show columns out of the database in chunks, by id
+
+    Args:
+        columns: SQL expressions, all numeric
+        conditions: WHERE conditions on show
+        chunk_size: rows per chunk
+
+    Returns:
+        generator of lists of columns: NumPy float64 arrays when NumPy is
+        installed, else tuples
+    """
+    last = None
+    while True:
+        query = select(Show.id, *columns).where(*conditions).order_by(Show.id).limit(chunk_size)
+        if last is not None:
+            query = query.where(Show.id > last)
+        rows = db.session.execute(query).all()
+        if not rows:
+            return
+        last = rows[-1][0]
+        if np is not None:
+            yield [np.fromiter((row[i] for row in rows), np.float64, len(rows))
+                   for i in range(1, len(columns) + 1)]
+        else:
+            yield list(zip(*rows))[1:]
+
+#----------------------------------------------------------------------------#
+# Reports.
+#----------------------------------------------------------------------------#
+
+class Report:
+    """
+    One report over the shows starting in a time window
+
+    Results only ever grow with new shows, so a cached result is brought
+    up to date by computing the report over the new shows alone and
+    merging that in.
+
+    Args:
+        None
+
+    Returns:
+        None
+    """
+    name = None
+    title = None
+
+    def invalidated_by(self, event):
+        """
+        Whether a change log entry changes results beyond adding shows;
+        hard deletes take their shows with them
+        """
+        return (event['entity'] in ('venue', 'artist') and event['action'] == 'deleted'
+                and bool((event['data'] or {}).get('hard')))
+
+    def compute(self, conditions, chunk_size):
+        """
+        Partial result over the shows matching the conditions
+        """
+        raise NotImplementedError
+
+    def merge(self, result, partial):
+        """
+        A result with a partial result added, without changing either
+        """
+        return result + partial
+
+    def render(self, result, limit):
+        """
+        Columns and rows to display, at most `limit` rows
+        """
+        raise NotImplementedError
+
+
+class ShowsPerVenueMonth(Report):
+    name = 'venue-months'
+    title = 'Shows per venue per month'
+
+    def compute(self, conditions, chunk_size):
+        month = _month(Show.start_time)
+        return Counter({(venue_id, month): count for venue_id, month, count in db.session.execute(
+            select(Show.venue_id, month, func.count()).where(*conditions).group_by(Show.venue_id, month))})
+
+    def render(self, result, limit):
+        months = sorted({month for _, month in result})
+        totals = Counter()
+        for (venue_id, _), count in result.items():
+            totals[venue_id] += count
+        top = [venue_id for venue_id, _ in totals.most_common(limit)]
+        names = dict(db.session.execute(select(Venue.id, Venue.name).where(Venue.id.in_(top))).all())
+        return {'columns': ['Venue'] + months + ['Total'],
+                'rows': [[names.get(venue_id, f'#{venue_id}')]
+                         + [result.get((venue_id, month), 0) for month in months]
+                         + [totals[venue_id]] for venue_id in top]}
+
+
+class BusiestArtists(Report):
+    name = 'busiest-artists'
+    title = 'Busiest artists'
+
+    def compute(self, conditions, chunk_size):
+        return Counter(dict(db.session.execute(
+            select(Show.artist_id, func.count()).where(*conditions).group_by(Show.artist_id)).all()))
+
+    def render(self, result, limit):
+        top = result.most_common(limit)
+        names = dict(db.session.execute(
+            select(Artist.id, Artist.name).where(Artist.id.in_([artist_id for artist_id, _ in top]))).all())
+        return {'columns': ['Artist', 'Shows'],
+                'rows': [[names.get(artist_id, f'#{artist_id}'), count] for artist_id, count in top]}
+
+
+class GenreTrends(Report):
+    name = 'genre-trends'
+    title = 'Shows per artist genre per month'
+
+    def invalidated_by(self, event):
+        # Shows count towards the artist's current genres
+        return super().invalidated_by(event) or (
+            event['entity'] == 'artist' and event['action'] == 'updated'
+            and 'genres' in (event['data'] or {}))
+
+    def compute(self, conditions, chunk_size):
+        table, foreign_key = GENRE_LINKS[Artist]
+        month = _month(Show.start_time)
+        return Counter({(genre, month): count for genre, month, count in db.session.execute(
+            select(Genre.name, month, func.count())
+            .select_from(Show)
+            .join(table, foreign_key == Show.artist_id)
+            .join(Genre, Genre.id == table.c.genre_id)
+            .where(*conditions).group_by(Genre.name, month))})
+
+    def render(self, result, limit):
+        months = sorted({month for _, month in result})
+        genres = sorted({genre for genre, _ in result})
+        return {'columns': ['Genre'] + months,
+                'rows': [[genre] + [result.get((genre, month), 0) for month in months]
+                         for genre in genres[:limit]]}
+
+
+class LeadTimes(Report):
+    name = 'lead-times'
+    title = 'Days between booking and show'
+
+    def compute(self, conditions, chunk_size):
+        # Shows from before created_at was recorded have no booking time
+        histogram, total, unknown = [0] * (LEAD_DAYS + 1), 0.0, 0
+        columns = [_epoch(Show.start_time), func.coalesce(_epoch(Show.created_at), -1.0)]
+        for starts, created in _chunks(columns, conditions, chunk_size):
+            if np is not None:
+                known = created >= 0
+                unknown += int(len(created) - known.sum())
+                leads = np.clip(starts[known] - created[known], 0, None)
+                total += float(leads.sum())
+                days = np.minimum(leads // DAY, LEAD_DAYS).astype(np.int64)
+                histogram = [a + b for a, b in zip(
+                    histogram, np.bincount(days, minlength=LEAD_DAYS + 1).tolist())]
+            else:
+                for start, booked in zip(starts, created):
+                    if booked < 0:
+                        unknown += 1
+                        continue
+                    lead = max(start - booked, 0.0)
+                    total += lead
+                    histogram[min(int(lead // DAY), LEAD_DAYS)] += 1
+        return {'histogram': histogram, 'seconds': total, 'unknown': unknown}
+
+    def merge(self, result, partial):
+        return {'histogram': [a + b for a, b in zip(result['histogram'], partial['histogram'])],
+                'seconds': result['seconds'] + partial['seconds'],
+                'unknown': result['unknown'] + partial['unknown']}
+
+    def render(self, result, limit):
+        histogram = result['histogram']
+        count = sum(histogram)
+
+        def percentile(pct):
+            seen = 0
+            for day, shows in enumerate(histogram):
+                seen += shows
+                if seen * 100 >= pct * count:
+                    return day
+            return None
+
+        rows = [['Shows with a booking time', count],
+                ['Shows booked before that was recorded', result['unknown']],
+                ['Average lead time (days)', round(result['seconds'] / DAY / count, 1) if count else None]]
+        rows += [[f'{pct}th percentile (days)', percentile(pct) if count else None] for pct in (50, 90, 99)]
+        weeks = [sum(histogram[week * 7:week * 7 + 7]) for week in range(LEAD_DAYS // 7)]
+        rows += [[f'Booked {week}-{week + 1} weeks ahead', shows]
+                 for week, shows in enumerate(weeks[:limit]) if shows]
+        return {'columns': ['', 'Value'], 'rows': rows}
+
+
+class BusyHours(Report):
+    name = 'busy-hours'
+    title = 'Shows by weekday and starting hour'
+
+    WEEKDAYS = ('Monday', 'Tuesday', 'Wednesday', 'Thursday', 'Friday', 'Saturday', 'Sunday')
+
+    def compute(self, conditions, chunk_size):
+        counts = [0] * (7 * 24)
+        for starts, in _chunks([_epoch(Show.start_time)], conditions, chunk_size):
+            if np is not None:
+                hours = (starts // 3600).astype(np.int64)
+                # 1970-01-01 was a Thursday
+                cells = (hours // 24 + 3) % 7 * 24 + hours % 24
+                counts = [a + b for a, b in zip(counts, np.bincount(cells, minlength=7 * 24).tolist())]
+            else:
+                for start in starts:
+                    hours = int(start // 3600)
+                    counts[(hours // 24 + 3) % 7 * 24 + hours % 24] += 1
+        return counts
+
+    def merge(self, result, partial):
+        return [a + b for a, b in zip(result, partial)]
+
+    def render(self, result, limit):
+        return {'columns': ['Weekday'] + [f'{hour:02d}' for hour in range(24)],
+                'rows': [[weekday] + result[day * 24:day * 24 + 24]
+                         for day, weekday in enumerate(self.WEEKDAYS)]}
+
+
+class Residencies(Report):
+    name = 'residencies'
+    title = 'Artists returning to the same venue'
+
+    def compute(self, conditions, chunk_size):
+        pairs = Counter()
+        for venues, artists in _chunks([Show.venue_id, Show.artist_id], conditions, chunk_size):
+            if np is not None:
+                keys, counts = np.unique(venues.astype(np.int64) << 32 | artists.astype(np.int64),
+                                         return_counts=True)
+                pairs.update(dict(zip(zip((keys >> 32).tolist(), (keys & 0xFFFFFFFF).tolist()),
+                                      counts.tolist())))
+            else:
+                pairs.update(zip(map(int, venues), map(int, artists)))
+        return pairs
+
+    def render(self, result, limit):
+        top = [(pair, count) for pair, count in result.most_common(limit) if count > 1]
+        venues = dict(db.session.execute(
+            select(Venue.id, Venue.name).where(Venue.id.in_({venue for (venue, _), _ in top}))).all())
+        artists = dict(db.session.execute(
+            select(Artist.id, Artist.name).where(Artist.id.in_({artist for (_, artist), _ in top}))).all())
+        return {'columns': ['Venue', 'Artist', 'Shows'],
+                'rows': [[venues.get(venue, f'#{venue}'), artists.get(artist, f'#{artist}'), count]
+                         for (venue, artist), count in top]}
+
+
+REPORTS = {report.name: report for report in (
+    ShowsPerVenueMonth(), BusiestArtists(), GenreTrends(), LeadTimes(), BusyHours(), Residencies())}
+
+#----------------------------------------------------------------------------#
+# Cached results.
+#----------------------------------------------------------------------------#
+
+class Reports:
+    """
+    Computes reports and keeps them cached per report and time window
+
+    A cached result remembers the last change log entry it has seen. Later
+    requests compute the report over the shows created since and merge
+    them in, unless a change log entry invalidates it (e.g. a hard delete)
+    or there are too many new entries; then, and REPORT_CACHE_TIMEOUT
+    seconds after it was last computed in full, the report is computed
+    from scratch.
+
+    Args:
+        None
+
+    Returns:
+        None
+    """
+
+    def __init__(self):
+        self.app = None
+        self.chunk_size = 50000
+        self.cache_timeout = 3600
+        self.max_incremental = 5000
+        self.refreshes = registry.counter('report_refreshes_total', 'Report requests by how they were served',
+                                          ['report', 'kind'])
+        self._locks = {}
+        self._lock = threading.Lock()
+
+    def init_app(self, app):
+        self.app = app
+        self.chunk_size = app.config.get('REPORT_CHUNK_SIZE', self.chunk_size)
+        self.cache_timeout = app.config.get('REPORT_CACHE_TIMEOUT', self.cache_timeout)
+        self.max_incremental = app.config.get('REPORT_MAX_INCREMENTAL', self.max_incremental)
+        app.extensions['reports'] = self
+
+    def _key_lock(self, key):
+        with self._lock:
+            return self._locks.setdefault(key, threading.Lock())
+
+    def _changes(self, report, cursor, latest):
+        """
+        Ids of the shows created after `cursor`, None when the report has
+        to be computed from scratch
+        """
+        # Entries committed since `latest` was read wait for the next refresh
+        entries = events.fetch_since(cursor, self.max_incremental + 1, until=latest)
+        if len(entries) > self.max_incremental:
+            return None
+        if any(report.invalidated_by(entry) for entry in entries):
+            return None
+        return [entry['entity_id'] for entry in entries
+                if entry['entity'] == 'show' and entry['action'] == 'created']
+
+    def result(self, name, start, end):
+        """
+        Up-to-date result of a report
+
+        Must be called inside an application context.
+
+        Args:
+            name: report name, a key of REPORTS
+            start: datetime, shows starting at or after it
+            end: datetime, shows starting before it
+
+        Returns:
+            (result, how it was served: 'cached', 'incremental' or 'full')
+        """
+        report = REPORTS[name]
+        key = f'report:{name}:{start.isoformat()}:{end.isoformat()}'
+        window = [Show.start_time >= start, Show.start_time < end]
+        # One refresh per report and window at a time; the others wait and
+        # find it cached
+        with self._key_lock(key):
+            latest = events.latest_id()
+            entry = cache.get(key)
+            kind = 'cached'
+            if entry is None or entry['fresh_until'] < time.monotonic():
+                kind = 'full'
+            elif entry['cursor'] != latest:
+                shows = self._changes(report, entry['cursor'], latest)
+                kind = 'full' if shows is None else 'incremental'
+
+            if kind == 'full':
+                # Shows committed after `latest` was read are left to the
+                # next incremental refresh, so none is counted twice
+                newer = select(ChangeLog.entity_id).where(ChangeLog.entity == 'show', ChangeLog.id > latest)
+                entry = {'cursor': latest, 'computed_at': datetime.now(timezone.utc).isoformat(),
+                         'fresh_until': time.monotonic() + self.cache_timeout,
+                         'result': report.compute(window + [Show.id.notin_(newer)], self.chunk_size)}
+                cache.set(key, entry, self.cache_timeout)
+            elif kind == 'incremental':
+                partial = report.compute(window + [Show.id.in_(shows)], self.chunk_size) if shows else None
+                entry = dict(entry, cursor=latest,
+                             result=report.merge(entry['result'], partial) if shows else entry['result'])
+                cache.set(key, entry, self.cache_timeout)
+        self.refreshes.inc(name, kind)
+        return entry, kind
+
+
+reports = Reports()
@@ -0,0 +1,389 @@
+#----------------------------------------------------------------------------#
+# Imports
+#----------------------------------------------------------------------------#
+
+import atexit
+import contextvars
+import json
+import logging
+import os
+import queue
+import random
+import re
+import sys
+import threading
+import time
+import uuid
+from datetime import datetime, timezone
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
+
+from flask import request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+from metrics import registry
+from tenants import current_tenant
+
+# Incoming request ids are passed on when they look like one
+REQUEST_ID = re.compile(r'^[A-Za-z0-9._:-]{1,128}$')
+
+dropped_counter = registry.counter('log_records_dropped_total',
+                                   'Log records dropped because the log queue was full')
+
+#----------------------------------------------------------------------------#
+# Per-request counters.
+#----------------------------------------------------------------------------#
+
+class RequestStats:
+    """
+    What one request has done so far, for its log record
+
+    Args:
+        request_id: id sent back in the response and logged with every record
+
+    Returns:
+        None
+    """
+    __slots__ = ('request_id', 'started', 'statements', 'cache_hits', 'cache_misses')
+
+    def __init__(self, request_id):
+        self.request_id = request_id
+        self.started = time.perf_counter()
+        self.statements = 0
+        self.cache_hits = 0
+        self.cache_misses = 0
+
+
+# Unset outside requests, so background work isn't counted
+_current = contextvars.ContextVar('request_stats', default=None)
+
+
+def current_request_id():
+    """
+    Id of the request being served
+
+    Args:
+        None
+
+    Returns:
+        str, or None outside a request
+    """
+    stats = _current.get()
+    return stats.request_id if stats is not None else None
+
+
+def note_cache_lookup(hit):
+    """
+    Counts an app cache lookup towards the current request
+
+    Args:
+        hit: whether the key was found
+
+    Returns:
+        None
+    """
+    stats = _current.get()
+    if stats is not None:
+        if hit:
+            stats.cache_hits += 1
+        else:
+            stats.cache_misses += 1
+
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def _count_statement(*args):
+    # Every engine, including the per-tenant SQLite ones
+    stats = _current.get()
+    if stats is not None:
+        stats.statements += 1
+
+#----------------------------------------------------------------------------#
+# Formatting and rotation.
+#----------------------------------------------------------------------------#
+
+class JSONFormatter(logging.Formatter):
+    """
+    Formats records as one JSON object per line
+
+    The time, level, logger and message come first, then the request id
+    when the record was logged during a request, then the record's
+    `fields` (see RequestLog.after_request) and any exception traceback.
+    """
+
+    def format(self, record):
+        entry = {
+            'time': datetime.fromtimestamp(record.created, timezone.utc)
+                            .isoformat(timespec='milliseconds').replace('+00:00', 'Z'),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+        }
+        request_id = getattr(record, 'request_id', None)
+        if request_id is not None:
+            entry['request_id'] = request_id
+        entry.update(getattr(record, 'fields', ()))
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+        elif record.exc_text:
+            entry['exception'] = record.exc_text
+        return json.dumps(entry, default=str)
+
+
+class SizeAndTimeRotatingFileHandler(RotatingFileHandler):
+    """
+    Rotates a log file when it reaches max_bytes or an interval ends
+
+    Intervals are aligned to the epoch, so a day ends at midnight UTC and
+    an hour on the hour. Old files are numbered as by RotatingFileHandler:
+    app.log.1 is the newest, app.log.<backup_count> the oldest kept.
+
+    Args:
+        filename: log file, its directory is created
+        max_bytes: size to rotate at, 0 for no limit
+        backup_count: rotated files kept
+        interval: seconds, 0 to rotate on size only
+
+    Returns:
+        None
+    """
+
+    def __init__(self, filename, max_bytes=0, backup_count=0, interval=0):
+        directory = os.path.dirname(os.path.abspath(filename))
+        os.makedirs(directory, exist_ok=True)
+        super().__init__(filename, maxBytes=max_bytes, backupCount=backup_count,
+                         encoding='utf-8', delay=True)
+        self.interval = interval
+        self.rollover_at = self._next_rollover()
+
+    def _next_rollover(self):
+        if not self.interval:
+            return None
+        return (time.time() // self.interval + 1) * self.interval
+
+    def shouldRollover(self, record):
+        if self.rollover_at is not None and time.time() >= self.rollover_at:
+            self.rollover_at = self._next_rollover()
+            # An interval nothing was logged in leaves no empty file behind
+            if os.path.exists(self.baseFilename) and os.path.getsize(self.baseFilename):
+                return True
+        return super().shouldRollover(record)
+
+
+def file_handler(path, max_bytes=0, backup_count=0, interval=0):
+    """
+    Handler writing JSON lines to a log file, or to stderr for '-'
+
+    Args:
+        path: log file; '{pid}' in it is replaced with the process id
+        max_bytes, backup_count, interval: as for SizeAndTimeRotatingFileHandler
+
+    Returns:
+        logging.Handler
+    """
+    if path == '-':
+        handler = logging.StreamHandler(sys.stderr)
+    else:
+        handler = SizeAndTimeRotatingFileHandler(path.format(pid=os.getpid()), max_bytes,
+                                                 backup_count, interval)
+    handler.setFormatter(JSONFormatter())
+    return handler
+
+#----------------------------------------------------------------------------#
+# Background writer.
+#----------------------------------------------------------------------------#
+
+class _Writer(QueueListener):
+
+    def enqueue_sentinel(self):
+        # Waits for room: records dropped for a full queue are fine, a lost
+        # stop signal is not
+        self.queue.put(self._sentinel)
+
+
+class BufferedHandler(QueueHandler):
+    """
+    Queues records for a writer thread instead of writing them in the caller
+
+    The logging thread only puts the record on a bounded queue; formatting
+    and the file write happen on the writer thread, so request threads no
+    longer take turns on the file handler's lock. When the queue is full
+    the record is dropped and counted in log_records_dropped_total rather
+    than making the request wait.
+
+    Each process starts its own writer on its first record, so the writer
+    (and the file) are not inherited by workers forked after logging.
+
+    Args:
+        factory: function returning the handler the writer hands records to
+        queue_size: records buffered before new ones are dropped
+
+    Returns:
+        None
+    """
+
+    def __init__(self, factory, queue_size=10000):
+        super().__init__(None)
+        self.factory = factory
+        self.queue_size = queue_size
+        self.target = None
+        self._listener = None
+        self._lock = threading.Lock()
+        self.addFilter(self._add_request_id)
+        os.register_at_fork(after_in_child=self._forget)
+        atexit.register(self.close)
+
+    @staticmethod
+    def _add_request_id(record):
+        # In the logging thread, where the request is known
+        record.request_id = current_request_id()
+        return True
+
+    def _forget(self):
+        # The parent's writer thread doesn't exist in the child
+        self._lock = threading.Lock()
+        self._listener = None
+        self.target = None
+
+    def _start(self):
+        with self._lock:
+            if self._listener is None:
+                self.queue = queue.Queue(self.queue_size)
+                self.target = self.factory()
+                self._listener = _Writer(self.queue, self.target, respect_handler_level=True)
+                self._listener.start()
+
+    def prepare(self, record):
+        # Formatted on the writer thread; only the message is fixed here,
+        # as its arguments may change once the logging call returns
+        record.msg = record.getMessage()
+        record.args = None
+        return record
+
+    def enqueue(self, record):
+        if self._listener is None:
+            self._start()
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            dropped_counter.inc()
+
+    def flush(self):
+        """
+        Waits until every queued record has been written
+        """
+        if self._listener is not None:
+            self.queue.join()
+            self.target.flush()
+
+    def close(self):
+        with self._lock:
+            if self._listener is not None:
+                self._listener.stop()
+                self.target.close()
+                self._listener = None
+        super().close()
+
+#----------------------------------------------------------------------------#
+# Request logging.
+#----------------------------------------------------------------------------#
+
+class RequestLog:
+    """
+    Logs one JSON record per request, and the app's own records, off-thread
+
+    Each record carries the request id (taken from the X-Request-ID header
+    when the client or proxy sent one, and sent back in the response), the
+    route, status, latency, and how many SQL statements and app cache
+    lookups the request made. Successful requests are logged with
+    probability LOG_SAMPLE_RATE (the record says which rate, to weigh it
+    by); errors and requests slower than LOG_SLOW_REQUEST seconds always
+    are.
+
+    Outside debug mode app.logger writes to the same file, so errors carry
+    the id of the request they happened in.
+
+    Args:
+        None
+
+    Returns:
+        None
+    """
+
+    def __init__(self):
+        self.app = None
+        self.enabled = True
+        self.sample_rate = 1.0
+        self.slow_request = 1.0
+        self.header = 'X-Request-ID'
+        self.handler = None
+        self.logger = logging.getLogger('fyyur.requests')
+        self.logger.propagate = False
+        self.logger.setLevel(logging.INFO)
+
+    def init_app(self, app):
+        self.app = app
+        self.enabled = app.config.get('LOG_REQUESTS', self.enabled)
+        self.sample_rate = app.config.get('LOG_SAMPLE_RATE', self.sample_rate)
+        self.slow_request = app.config.get('LOG_SLOW_REQUEST', self.slow_request)
+        self.header = app.config.get('LOG_REQUEST_ID_HEADER', self.header)
+        app.extensions['request_log'] = self
+
+        path = app.config.get('LOG_FILE', 'app.log')
+        self.handler = BufferedHandler(
+            lambda: file_handler(path, app.config.get('LOG_MAX_BYTES', 0),
+                                 app.config.get('LOG_BACKUP_COUNT', 0),
+                                 app.config.get('LOG_ROTATE_INTERVAL', 0)),
+            app.config.get('LOG_QUEUE_SIZE', 10000))
+        self.logger.addHandler(self.handler)
+        if not app.debug:
+            app.logger.setLevel(logging.INFO)
+            app.logger.addHandler(self.handler)
+        registry.callback_gauge('log_queue_records', 'Log records waiting to be written',
+                                lambda: self.handler.queue.qsize() if self.handler.queue else 0)
+
+        app.before_request(self.before_request)
+        app.after_request(self.after_request)
+        app.teardown_request(self.teardown_request)
+
+    def before_request(self):
+        if not self.enabled:
+            return
+        request_id = request.headers.get(self.header, '')
+        if not REQUEST_ID.match(request_id):
+            request_id = uuid.uuid4().hex
+        _current.set(RequestStats(request_id))
+
+    def after_request(self, response):
+        stats = _current.get()
+        if stats is None:
+            return response
+        response.headers[self.header] = stats.request_id
+        latency = time.perf_counter() - stats.started
+        status = response.status_code
+        sampled = status < 400 and latency < self.slow_request and self.sample_rate < 1
+        if sampled and random.random() >= self.sample_rate:
+            return response
+        fields = {
+            'method': request.method,
+            'path': request.path,
+            'route': request.url_rule.rule if request.url_rule else None,
+            'status': status,
+            'latency_ms': round(latency * 1000, 2),
+            'db_statements': stats.statements,
+            'cache_hits': stats.cache_hits,
+            'cache_misses': stats.cache_misses,
+            'bytes': response.content_length,
+        }
+        tenant = current_tenant()
+        if tenant is not None:
+            fields['tenant'] = tenant
+        if sampled:
+            fields['sample_rate'] = self.sample_rate
+        self.logger.info('%s %s %s', request.method, request.path, status, extra={'fields': fields})
+        return response
+
+    def teardown_request(self, exc):
+        _current.set(None)
+
+
+request_log = RequestLog()
@@ -0,0 +1,282 @@
+"""
+Production server: python serve.py {run,reload,stop,events}
+
+`run` serves the app with gunicorn. The app is imported and warmed up once
+in the master process (templates compiled, suggestion index built) and
+the workers are forked from it, so they share that memory copy-on-write.
+Every worker gets its own database connections.
+
+`reload` replaces the running server without dropping connections: a new
+master is started on the same sockets, and once it answers /readyz the
+old master finishes its in-flight requests and exits.
+
+`events` serves the /events change feed on asyncio in its own process,
+so thousands of idle subscribers don't tie up the gunicorn workers; route
+/events to it at the proxy, or set EVENTS_URL for the app to redirect
+there.
+
+With more than one worker SECRET_KEY must be set in the environment, or
+CSRF tokens would only be valid in the worker that issued them, and
+sessions are kept in the database (SESSION_STORAGE_URL=sql://) unless
+SESSION_STORAGE_URL points somewhere else.
+
+Usage:
+    SECRET_KEY=... DATABASE_URL=... python serve.py run --bind 0.0.0.0:8000
+    python serve.py reload
+    python serve.py stop
+    DATABASE_URL=... python serve.py events --bind 0.0.0.0:8001
+"""
+
+import argparse
+import asyncio
+import json
+import multiprocessing
+import os
+import signal
+import sys
+import time
+import urllib.request
+
+try:
+    from gunicorn.app.base import BaseApplication
+except ImportError:  # see requirements.txt
+    BaseApplication = object
+
+basedir = os.path.abspath(os.path.dirname(__file__))
+PIDFILE = os.path.join(basedir, 'serve.pid')
+
+
+def default_workers():
+    """
+    Worker processes for this machine, WEB_CONCURRENCY overrides it
+
+    Requests mostly wait on the database, so two workers per core keep the
+    CPUs busy.
+    """
+    return int(os.environ.get('WEB_CONCURRENCY', multiprocessing.cpu_count() * 2 + 1))
+
+#----------------------------------------------------------------------------#
+# Gunicorn application.
+#----------------------------------------------------------------------------#
+
+class Server(BaseApplication):
+    """
+    Gunicorn application serving the preloaded Flask app
+
+    Args:
+        app: Flask app, already imported and warmed up
+        options: gunicorn settings
+
+    Returns:
+        None
+    """
+
+    def __init__(self, app, options):
+        self.application = app
+        self.options = options
+        super().__init__()
+
+    def load_config(self):
+        for key, value in self.options.items():
+            self.cfg.set(key, value)
+
+    def load(self):
+        return self.application
+
+
+def post_fork(server, worker):
+    """
+    Gives each worker its own database connections
+
+    Connections the master opened while warming up must not be shared with
+    the children; dispose(close=False) drops them from the worker's pool
+    without closing the parent's sockets.
+    """
+    from app import app
+    from models import db
+    with app.app_context():
+        db.engine.dispose(close=False)
+
+
+def warm_up(app):
+    """
+    Does the per-process startup work once, in the master, before forking
+
+    Args:
+        app: Flask app
+
+    Returns:
+        None
+    """
+    from models import db
+    from suggest import suggestions
+    with app.app_context():
+        try:
+            suggestions.warm()
+        except Exception:
+            app.logger.exception('Building the suggestion index failed, workers will retry')
+        db.session.remove()
+        db.engine.dispose()
+
+#----------------------------------------------------------------------------#
+# Commands.
+#----------------------------------------------------------------------------#
+
+def cmd_run(args):
+    if BaseApplication is object:
+        sys.exit('gunicorn is not installed: pip install gunicorn')
+    if args.workers > 1 and not os.environ.get('SECRET_KEY'):
+        sys.exit('SECRET_KEY must be set when running more than one worker')
+    # config.py reads these at import time
+    os.environ.setdefault('DEBUG', '0')
+    os.environ.setdefault('SUGGEST_PRELOAD', '0')
+    # Workers don't share memory, so sessions go in the database unless
+    # SESSION_STORAGE_URL says otherwise
+    if args.workers > 1:
+        os.environ.setdefault('SESSION_STORAGE_URL', 'sql://')
+
+    from app import app
+    warm_up(app)
+    Server(app, {
+        'bind': args.bind,
+        'workers': args.workers,
+        'threads': args.threads,
+        'worker_class': 'gthread' if args.threads > 1 else 'sync',
+        'preload_app': True,
+        'pidfile': args.pidfile,
+        'timeout': args.timeout,
+        'graceful_timeout': args.graceful_timeout,
+        'keepalive': 5,
+        'max_requests': args.max_requests,
+        'max_requests_jitter': args.max_requests // 10,
+        'post_fork': post_fork,
+        'accesslog': args.access_log,
+    }).run()
+
+
+def _read_pid(path):
+    try:
+        with open(path) as f:
+            return int(f.read().strip())
+    except (OSError, ValueError):
+        return None
+
+
+def _alive(pid):
+    try:
+        os.kill(pid, 0)
+    except OSError:
+        return False
+    return True
+
+
+def _wait(condition, timeout, interval=0.2):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if condition():
+            return True
+        time.sleep(interval)
+    return False
+
+
+def _ready(url, master):
+    """
+    Whether a worker forked by `master` answered the readiness check
+
+    Old and new workers accept on the same sockets during a reload, so a
+    200 only counts when it comes from one of the new master's workers.
+    """
+    try:
+        with urllib.request.urlopen(url, timeout=2) as response:
+            return response.status == 200 and json.load(response).get('ppid') == master
+    except (OSError, ValueError):
+        return False
+
+
+def cmd_reload(args):
+    old = _read_pid(args.pidfile)
+    if not old or not _alive(old):
+        sys.exit(f'no running server in {args.pidfile}')
+    # gunicorn re-executes itself on USR2: the new master inherits the
+    # listening sockets and writes its pid to <pidfile>.2, renaming it to
+    # the pidfile once the old master is gone
+    os.kill(old, signal.SIGUSR2)
+    if not _wait(lambda: _read_pid(args.pidfile + '.2'), args.timeout):
+        sys.exit('the new master did not start, the old one keeps serving')
+    new = _read_pid(args.pidfile + '.2')
+    if args.ready_url and not _wait(lambda: _ready(args.ready_url, new), args.timeout, interval=0.1):
+        os.kill(new, signal.SIGTERM)
+        sys.exit(f'{args.ready_url} did not report ready, stopped the new master {new}')
+    # TERM is a graceful stop: in-flight requests finish first
+    os.kill(old, signal.SIGTERM)
+    _wait(lambda: _read_pid(args.pidfile) == new, args.timeout)
+    print(f'reloaded: master {old} -> {new}')
+
+
+def cmd_stop(args):
+    pid = _read_pid(args.pidfile)
+    if not pid or not _alive(pid):
+        sys.exit(f'no running server in {args.pidfile}')
+    os.kill(pid, signal.SIGTERM)
+    print(f'stopping master {pid}')
+
+
+def cmd_events(args):
+    os.environ.setdefault('DEBUG', '0')
+    os.environ.setdefault('SUGGEST_PRELOAD', '0')
+
+    from app import app
+    from events import EventServer
+    host, _, port = args.bind.rpartition(':')
+
+    async def serve():
+        task = asyncio.create_task(EventServer(app).serve(host or '0.0.0.0', int(port)))
+        loop = asyncio.get_running_loop()
+        for signum in (signal.SIGTERM, signal.SIGINT):
+            loop.add_signal_handler(signum, task.cancel)
+        try:
+            await task
+        except asyncio.CancelledError:
+            pass
+
+    asyncio.run(serve())
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python serve.py', description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    run = commands.add_parser('run', help='start the server')
+    run.add_argument('--bind', default=f"0.0.0.0:{os.environ.get('PORT', '8000')}")
+    run.add_argument('--workers', type=int, default=default_workers())
+    run.add_argument('--threads', type=int, default=1, help='threads per worker')
+    run.add_argument('--timeout', type=int, default=30, help='seconds before a stuck worker is restarted')
+    run.add_argument('--graceful-timeout', type=int, default=30,
+                     help='seconds workers get to finish requests on stop and reload')
+    run.add_argument('--max-requests', type=int, default=10000,
+                     help='recycle workers after this many requests, 0 to disable')
+    run.add_argument('--access-log', help="access log file, '-' for stdout")
+    run.set_defaults(func=cmd_run)
+
+    reload = commands.add_parser('reload', help='replace the running server without downtime')
+    reload.add_argument('--ready-url', default='http://127.0.0.1:8000/readyz',
+                        help='checked before the old master is stopped, empty to skip')
+    reload.add_argument('--timeout', type=float, default=60)
+    reload.set_defaults(func=cmd_reload)
+
+    stop = commands.add_parser('stop', help='stop the running server gracefully')
+    stop.set_defaults(func=cmd_stop)
+
+    events = commands.add_parser('events', help='serve /events asynchronously')
+    events.add_argument('--bind', default='0.0.0.0:8001')
+    events.set_defaults(func=cmd_events)
+
+    for command in (run, reload, stop):
+        command.add_argument('--pidfile', default=PIDFILE)
+    args = parser.parse_args(argv)
+    args.func(args)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,409 @@
+#----------------------------------------------------------------------------#
+# Imports
+#----------------------------------------------------------------------------#
+
+import re
+import secrets
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime, timedelta
+
+from flask.json.tag import TaggedJSONSerializer
+from flask.sessions import SessionInterface, SessionMixin
+from sqlalchemy import delete, insert, select, update
+
+from metrics import registry
+from models import db, SessionRecord
+
+try:
+    import redis
+except ImportError:  # only needed for a shared redis:// store
+    redis = None
+
+# Session ids are random, so they need no signature and don't depend on
+# SECRET_KEY being the same in every worker
+SID = re.compile(r'[A-Za-z0-9_-]{43}')
+
+#----------------------------------------------------------------------------#
+# Session stores.
+#----------------------------------------------------------------------------#
+
+class MemoryStore:
+    """
+    Sessions in process memory, for a single worker
+
+    The least recently used sessions are evicted first once there are more
+    than `max_entries`.
+
+    Args:
+        max_entries: maximum number of sessions kept
+
+    Returns:
+        None
+    """
+
+    def __init__(self, max_entries=100000):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, sid):
+        with self._lock:
+            entry = self._entries.get(sid)
+            if entry is None:
+                return None
+            if entry[0] < time.monotonic():
+                del self._entries[sid]
+                return None
+            self._entries.move_to_end(sid)
+            return entry[1]
+
+    def set(self, sid, data, ttl):
+        with self._lock:
+            self._entries[sid] = (time.monotonic() + ttl, data)
+            self._entries.move_to_end(sid)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def delete(self, sid):
+        with self._lock:
+            self._entries.pop(sid, None)
+
+
+class SQLStore:
+    """
+    Sessions in the http_session table, shared by every worker and host
+
+    Expired rows are ignored on read and deleted in the background, at
+    most every `cleanup_interval` seconds and `batch_size` rows per
+    transaction, so cleanup never holds long locks. With multi-tenancy the
+    table in the default database serves every tenant.
+
+    Args:
+        app: Flask app, for its database
+        cleanup_interval: seconds between cleanups
+        batch_size: rows deleted per transaction
+
+    Returns:
+        None
+    """
+
+    def __init__(self, app, cleanup_interval=300, batch_size=1000):
+        self.app = app
+        self.cleanup_interval = cleanup_interval
+        self.batch_size = batch_size
+        self._next_cleanup = time.monotonic() + cleanup_interval
+        self._cleaning = threading.Lock()
+
+    @property
+    def engine(self):
+        # Not routed to the current tenant's schema (see tenants.py)
+        return db.engine.execution_options(tenant_shared=True)
+
+    def __len__(self):
+        with self.engine.connect() as connection:
+            return connection.execute(select(db.func.count()).select_from(SessionRecord)).scalar()
+
+    def get(self, sid):
+        with self.engine.connect() as connection:
+            return connection.execute(
+                select(SessionRecord.data)
+                .where(SessionRecord.sid == sid, SessionRecord.expires_at > datetime.now())).scalar()
+
+    def set(self, sid, data, ttl):
+        expires_at = datetime.now() + timedelta(seconds=ttl)
+        with self.engine.begin() as connection:
+            updated = connection.execute(
+                update(SessionRecord).where(SessionRecord.sid == sid)
+                .values(data=data, expires_at=expires_at)).rowcount
+            if not updated:
+                connection.execute(insert(SessionRecord).values(sid=sid, data=data, expires_at=expires_at))
+        if time.monotonic() >= self._next_cleanup:
+            self._next_cleanup = time.monotonic() + self.cleanup_interval
+            threading.Thread(target=self._cleanup_in_background, name='session-cleanup', daemon=True).start()
+
+    def delete(self, sid):
+        with self.engine.begin() as connection:
+            connection.execute(delete(SessionRecord).where(SessionRecord.sid == sid))
+
+    def _cleanup_in_background(self):
+        with self.app.app_context():
+            try:
+                self.cleanup()
+            except Exception:
+                self.app.logger.exception('Deleting expired sessions failed')
+
+    def cleanup(self):
+        """
+        Deletes expired sessions in batches
+
+        Must be called inside an application context.
+
+        Args:
+            None
+
+        Returns:
+            number of deleted sessions
+        """
+        if not self._cleaning.acquire(blocking=False):
+            return 0
+        try:
+            total = 0
+            while True:
+                expired = select(SessionRecord.sid) \
+                    .where(SessionRecord.expires_at <= datetime.now()).limit(self.batch_size)
+                with self.engine.begin() as connection:
+                    deleted = connection.execute(
+                        delete(SessionRecord).where(SessionRecord.sid.in_(expired.scalar_subquery()))
+                    ).rowcount
+                total += deleted
+                if deleted < self.batch_size:
+                    return total
+        finally:
+            self._cleaning.release()
+
+
+class LocalRedis:
+    """
+    In-process stand-in for a Redis server, for tests and benchmarks
+
+    Implements the commands RedisStore uses with the redis client's
+    signatures and reply types.
+
+    Args:
+        None
+
+    Returns:
+        None
+    """
+
+    def __init__(self):
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def get(self, name):
+        with self._lock:
+            entry = self._values.get(name)
+            if entry is None or (entry[0] is not None and entry[0] < time.monotonic()):
+                self._values.pop(name, None)
+                return None
+            return entry[1]
+
+    def set(self, name, value, ex=None):
+        if isinstance(value, str):
+            value = value.encode()
+        with self._lock:
+            self._values[name] = (time.monotonic() + ex if ex else None, value)
+        return True
+
+    def delete(self, *names):
+        with self._lock:
+            return sum(self._values.pop(name, None) is not None for name in names)
+
+    def dbsize(self):
+        return len(self._values)
+
+
+class RedisStore:
+    """
+    Sessions in Redis, shared by every worker and host; Redis expires them
+
+    Args:
+        client: redis.Redis, or LocalRedis
+        prefix: key prefix
+
+    Returns:
+        None
+    """
+
+    def __init__(self, client, prefix='session:'):
+        self.client = client
+        self.prefix = prefix
+
+    def __len__(self):
+        return self.client.dbsize()
+
+    def get(self, sid):
+        data = self.client.get(self.prefix + sid)
+        return data.decode() if data is not None else None
+
+    def set(self, sid, data, ttl):
+        self.client.set(self.prefix + sid, data, ex=max(int(ttl), 1))
+
+    def delete(self, sid):
+        self.client.delete(self.prefix + sid)
+
+
+def create_store(url, app):
+    """
+    Store for a SESSION_STORAGE_URL
+
+    Args:
+        url: memory://, sql:// (the app's database), redis://host:port/db,
+            or redis+local:// for the in-process stand-in
+        app: Flask app
+
+    Returns:
+        MemoryStore, SQLStore or RedisStore
+    """
+    if url.startswith('memory://'):
+        return MemoryStore(app.config.get('SESSION_MAX_ENTRIES', 100000))
+    if url.startswith('sql://'):
+        return SQLStore(app, app.config.get('SESSION_CLEANUP_INTERVAL', 300),
+                        app.config.get('SESSION_CLEANUP_BATCH_SIZE', 1000))
+    if url.startswith('redis+local://'):
+        return RedisStore(LocalRedis())
+    if url.startswith(('redis://', 'rediss://', 'unix://')):
+        if redis is None:
+            raise RuntimeError('SESSION_STORAGE_URL is a redis:// URL but the redis package is not installed')
+        return RedisStore(redis.Redis.from_url(url))
+    raise ValueError(f'unsupported SESSION_STORAGE_URL: {url}')
+
+#----------------------------------------------------------------------------#
+# Session interface.
+#----------------------------------------------------------------------------#
+
+class ServerSession(SessionMixin):
+    """
+    Session whose data stays on the server, loaded on first use
+
+    Requests that never touch the session (static files, JSON endpoints,
+    health checks) don't read the store at all.
+
+    Args:
+        interface: ServerSessionInterface it is loaded through
+        sid: session id from the cookie, None for a new session
+
+    Returns:
+        None
+    """
+
+    def __init__(self, interface, sid):
+        self.interface = interface
+        self.sid = sid
+        self.new = sid is None
+        self.modified = False
+        self.accessed = False
+        self._data = None
+
+    @property
+    def loaded(self):
+        return self._data is not None
+
+    @property
+    def data(self):
+        if self._data is None:
+            self.accessed = True
+            self._data = self.interface.load(self.sid) if self.sid else {}
+        return self._data
+
+    def __getitem__(self, key):
+        return self.data[key]
+
+    def __setitem__(self, key, value):
+        self.data[key] = value
+        self.modified = True
+
+    def __delitem__(self, key):
+        del self.data[key]
+        self.modified = True
+
+    def __iter__(self):
+        return iter(self.data)
+
+    def __len__(self):
+        return len(self.data)
+
+
+class ServerSessionInterface(SessionInterface):
+    """
+    Keeps sessions in a server-side store; the cookie only holds the id
+
+    Args:
+        store: MemoryStore, SQLStore or RedisStore
+        lifetime: seconds a session that isn't permanent lives after its
+            last change
+
+    Returns:
+        None
+    """
+    serializer = TaggedJSONSerializer()
+
+    def __init__(self, store, lifetime):
+        self.store = store
+        self.lifetime = lifetime
+        self.loads = registry.counter('session_loads_total', 'Sessions read from the session store')
+        self.saves = registry.counter('session_saves_total', 'Sessions written to the session store')
+
+    def load(self, sid):
+        self.loads.inc()
+        data = self.store.get(sid)
+        return self.serializer.loads(data) if data else {}
+
+    def open_session(self, app, request):
+        sid = request.cookies.get(self.get_cookie_name(app))
+        return ServerSession(self, sid if sid and SID.fullmatch(sid) else None)
+
+    def save_session(self, app, session, response):
+        if not session.loaded:
+            return
+        name = self.get_cookie_name(app)
+        domain = self.get_cookie_domain(app)
+        path = self.get_cookie_path(app)
+        secure = self.get_cookie_secure(app)
+        samesite = self.get_cookie_samesite(app)
+        httponly = self.get_cookie_httponly(app)
+        response.vary.add('Cookie')
+
+        if not session:
+            if session.modified and session.sid:
+                self.store.delete(session.sid)
+                response.delete_cookie(name, domain=domain, path=path, secure=secure,
+                                       samesite=samesite, httponly=httponly)
+            return
+        # Only changed sessions are written, which also restarts their
+        # lifetime
+        if not session.modified:
+            return
+        if session.sid is None:
+            session.sid = secrets.token_urlsafe(32)
+        ttl = app.permanent_session_lifetime.total_seconds() if session.permanent else self.lifetime
+        self.store.set(session.sid, self.serializer.dumps(dict(session)), ttl)
+        self.saves.inc()
+        response.set_cookie(name, session.sid, expires=self.get_expiration_time(app, session),
+                            httponly=httponly, domain=domain, path=path, secure=secure,
+                            samesite=samesite)
+
+
+class ServerSessions:
+    """
+    Installs server-side sessions on an app from SESSION_STORAGE_URL
+
+    Args:
+        None
+
+    Returns:
+        None
+    """
+
+    def __init__(self):
+        self.interface = None
+
+    def init_app(self, app):
+        store = create_store(app.config.get('SESSION_STORAGE_URL', 'memory://'), app)
+        self.interface = ServerSessionInterface(store, app.config.get('SESSION_LIFETIME', 86400))
+        app.session_interface = self.interface
+        app.extensions['sessions'] = self
+        registry.callback_gauge('session_store_entries', 'Sessions held by a memory store',
+                                lambda: len(store) if isinstance(store, MemoryStore) else 0)
+
+    @property
+    def store(self):
+        return self.interface.store
+
+
+server_sessions = ServerSessions()
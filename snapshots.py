@@ -0,0 +1,450 @@
+#----------------------------------------------------------------------------#
+# Imports
+#----------------------------------------------------------------------------#
+
+import threading
+import time
+from collections import Counter, defaultdict, namedtuple
+from datetime import datetime
+from types import MappingProxyType
+
+from flask import g, request
+from sqlalchemy import event, func, select
+
+import events
+from cache import cache
+from filters import ORDER, SEEKING, SHOW_KEYS, Area, Listing, group_by_area, parse_filters
+from genres import GENRE_LINKS
+from metrics import registry
+from models import db, Artist, ChangeLog, Genre, Show, Venue
+from tenants import current_tenant, tenant_local, use_tenant
+
+# With SNAPSHOT_ENABLED, /venues, /artists and /shows are answered from
+# in-memory snapshots of every live row instead of querying per request.
+# A snapshot is never changed once built: the refresher builds a new one
+# and swaps it in, so readers take no lock. It is rebuilt when the change
+# log has entries it hasn't seen, or when the earliest upcoming show it
+# knows of starts (which changes whose shows are upcoming).
+
+MODELS = {Venue: 'venues', Artist: 'artists'}
+# Listings a change log entry of each entity makes out of date
+AFFECTS = {
+    'venue': ('venues', 'shows'),
+    'artist': ('artists', 'shows'),
+    'show': ('venues', 'artists', 'shows'),
+}
+STALENESS_HEADER = 'X-Snapshot-Staleness'
+
+# A venue or artist with what the listing filters on; next_show is the
+# start of its earliest upcoming show
+Row = namedtuple('Row', 'id name city state seeking genres next_show')
+ShowRow = namedtuple('ShowRow', 'venue_id venue_name artist_id artist_name artist_image_link start_time')
+# cursor: the last change log entry included; valid_until: when it stops
+# being current without any write, None for never; pages: /venues pages
+# grouped by area, for the listing without filters
+Snapshot = namedtuple('Snapshot', 'listing cursor built_at valid_until rows counts pages')
+
+#----------------------------------------------------------------------------#
+# Building.
+#----------------------------------------------------------------------------#
+
+def _freeze(counts):
+    return MappingProxyType({key: MappingProxyType(value) if isinstance(value, dict) else value
+                             for key, value in counts.items()})
+
+
+def _upcoming(row, now):
+    return row.next_show is not None and row.next_show > now
+
+
+def facet_counts(rows, now):
+    """
+    Counts of rows per value of every dimension, like filters.facet_counts
+
+    Args:
+        rows: Row
+        now: cut-off between past and upcoming shows
+
+    Returns:
+        dict of dimension -> {value: count}, plus 'total'
+    """
+    counts = {'state': Counter(), 'city': Counter(), 'genre': Counter(),
+              'seeking': Counter(), 'upcoming': Counter()}
+    total = 0
+    for row in rows:
+        total += 1
+        if row.state is not None:
+            counts['state'][row.state] += 1
+        if (row.city, row.state) != (None, None):
+            counts['city'][(row.city, row.state)] += 1
+        counts['genre'].update(row.genres)
+        counts['seeking'][row.seeking] += 1
+        counts['upcoming'][_upcoming(row, now)] += 1
+    counts = {dimension: dict(values) for dimension, values in counts.items()}
+    counts['total'] = total
+    return counts
+
+
+def _matches(row, active, now):
+    return (('state' not in active or row.state == active['state'])
+            and ('city' not in active or row.city == active['city'])
+            and ('genre' not in active or active['genre'] in row.genres)
+            and ('seeking' not in active or row.seeking == active['seeking'])
+            and ('upcoming' not in active or _upcoming(row, now) == active['upcoming']))
+
+
+def build_listing(model, cursor, per_page):
+    """
+    Snapshot of the live venues or artists, in listing order
+
+    Args:
+        model: Venue or Artist
+        cursor: latest change log id, read before the rows
+        per_page: rows per page of the listing
+
+    Returns:
+        Snapshot
+    """
+    now = datetime.now()
+    table, foreign_key = GENRE_LINKS[model]
+    genres = defaultdict(set)
+    for entity_id, name in db.session.execute(
+            select(foreign_key, Genre.name).join(Genre, Genre.id == table.c.genre_id)):
+        genres[entity_id].add(name)
+    show_key = SHOW_KEYS[model]
+    next_shows = dict(db.session.execute(
+        select(show_key, func.min(Show.start_time)).where(Show.start_time > now).group_by(show_key)).all())
+    rows = tuple(
+        Row(entity_id, name, city, state, bool(seeking), frozenset(genres.get(entity_id, ())),
+            next_shows.get(entity_id))
+        for entity_id, name, city, state, seeking in db.session.execute(
+            select(model.id, model.name, model.city, model.state, getattr(model, SEEKING[model]))
+            .where(model.deleted_at.is_(None)).order_by(*ORDER[model])))
+    pages = None
+    if model is Venue:
+        pages = tuple(tuple(Area(area.city, area.state, tuple(area.venues))
+                            for area in group_by_area(rows[start:start + per_page]))
+                      for start in range(0, len(rows), per_page)) or ((),)
+    upcoming = [row.next_show for row in rows if row.next_show is not None]
+    return Snapshot(MODELS[model], cursor, now, min(upcoming, default=None), rows,
+                    _freeze(facet_counts(rows, now)), pages)
+
+
+def build_shows(cursor):
+    """
+    Snapshot of the /shows listing
+
+    Args:
+        cursor: latest change log id, read before the rows
+
+    Returns:
+        Snapshot
+    """
+    rows = tuple(
+        ShowRow(venue_id, venue_name, artist_id, artist_name, image_link,
+                start_time.strftime("%m/%d/%Y, %H:%M"))
+        for venue_id, venue_name, artist_id, artist_name, image_link, start_time in db.session.execute(
+            select(Show.venue_id, Venue.name, Show.artist_id, Artist.name, Artist.image_link,
+                   Show.start_time)
+            .select_from(Show).join(Artist).join(Venue)
+            .where(Artist.deleted_at.is_(None), Venue.deleted_at.is_(None))))
+    return Snapshot('shows', cursor, datetime.now(), None, rows, None, None)
+
+#----------------------------------------------------------------------------#
+# Listings.
+#----------------------------------------------------------------------------#
+
+class SnapshotListing(Listing):
+    """
+    One page of a venue or artist listing with its facets, from a snapshot
+
+    Without filters the counts (and /venues areas) were computed when the
+    snapshot was built; filters are applied to its rows.
+
+    Args:
+        snapshot: Snapshot of the model's listing
+        model: Venue or Artist
+        args: request.args
+        per_page: rows per page
+
+    Returns:
+        None
+    """
+
+    def __init__(self, snapshot, model, args, per_page):
+        now = datetime.now()
+        self.model = model
+        self.active = parse_filters(model, args)
+        self.endpoint = request.endpoint
+        self.snapshot = snapshot
+        rows = snapshot.rows
+        if self.active:
+            rows = [row for row in rows if _matches(row, self.active, now)]
+            self.counts = facet_counts(rows, now)
+        else:
+            self.counts = snapshot.counts
+        self.paginate(args, per_page)
+        self.items = rows[(self.page - 1) * per_page:self.page * per_page]
+
+    def areas(self):
+        if self.active or self.snapshot.pages is None:
+            return group_by_area(self.items)
+        return self.snapshot.pages[self.page - 1]
+
+#----------------------------------------------------------------------------#
+# Snapshots.
+#----------------------------------------------------------------------------#
+
+class Snapshots:
+    """
+    Current snapshot of each listing, per tenant, and their refresher
+
+    Started by the first request for a listing, the refresher reads the
+    latest change log id every SNAPSHOT_CHECK_INTERVAL seconds, and right
+    after this process commits a write, and rebuilds the snapshots it
+    makes out of date. Responses carry how long ago their snapshot was
+    last known to be current; a request finding one unconfirmed for longer
+    than SNAPSHOT_MAX_STALENESS seconds rebuilds it first.
+
+    Args:
+        None
+
+    Returns:
+        None
+    """
+
+    # listing -> (Snapshot, monotonic time it was last known current);
+    # replaced, never changed, so readers see one or the other
+    _current = tenant_local(dict)
+
+    def __init__(self):
+        self.app = None
+        self.enabled = False
+        self.check_interval = 1.0
+        self.max_staleness = 30
+        self.max_changes = 1000
+        self.per_page = 50
+        self._tenants = set()
+        self._thread = None
+        self._lock = threading.Lock()
+        self._build_locks = {}
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self.builds = registry.counter('snapshot_builds_total', 'Listing snapshots built',
+                                       ['listing', 'reason'])
+        self.build_seconds = registry.counter('snapshot_build_seconds_total',
+                                              'Seconds spent building listing snapshots', ['listing'])
+
+    def init_app(self, app):
+        self.app = app
+        self.enabled = app.config.get('SNAPSHOT_ENABLED', self.enabled)
+        self.check_interval = app.config.get('SNAPSHOT_CHECK_INTERVAL', self.check_interval)
+        self.max_staleness = app.config.get('SNAPSHOT_MAX_STALENESS', self.max_staleness)
+        self.max_changes = app.config.get('SNAPSHOT_MAX_CHANGES', self.max_changes)
+        self.per_page = app.config.get('LISTING_PAGE_SIZE', self.per_page)
+        app.extensions['snapshots'] = self
+        if self.enabled:
+            app.after_request(self.after_request)
+            app.context_processor(self.context_processor)
+
+    # Reading
+
+    def get(self, listing):
+        """
+        Current snapshot of a listing
+
+        Must be called inside a request.
+
+        Args:
+            listing: 'venues', 'artists' or 'shows'
+
+        Returns:
+            Snapshot
+        """
+        self.start()
+        entry = self._current.get(listing)
+        if entry is None:
+            entry = self.refresh(listing, 'initial')
+        elif time.monotonic() - entry[1] > self.max_staleness:
+            # Unless it is being rebuilt already; then this one will do
+            entry = self.refresh(listing, 'stale', wait=False) or entry
+        g.snapshot_staleness = max(time.monotonic() - entry[1], g.get('snapshot_staleness', 0))
+        g.snapshot_cursor = max(entry[0].cursor, g.get('snapshot_cursor', 0))
+        return entry[0]
+
+    def listing(self, model, args):
+        """
+        One page of the venue or artist listing, from its snapshot
+
+        Args:
+            model: Venue or Artist
+            args: request.args
+
+        Returns:
+            SnapshotListing
+        """
+        return SnapshotListing(self.get(MODELS[model]), model, args, self.per_page)
+
+    def context_processor(self):
+        # A write bumps its entity's fragment version before the snapshot
+        # including it is built, so fragments rendered from a snapshot are
+        # keyed by it too, or one rendered from the old snapshot in between
+        # would be kept under the new version
+        cursor = g.get('snapshot_cursor')
+        if cursor is None:
+            return {}
+        return {'fragment_version': lambda kind, entity_id:
+                f'{cache.entity_version(kind, entity_id)}@{cursor}'}
+
+    def after_request(self, response):
+        staleness = g.pop('snapshot_staleness', None)
+        if staleness is not None:
+            response.headers[STALENESS_HEADER] = f'{staleness:.3f}'
+        return response
+
+    # Refreshing
+
+    def _swap(self, listing, entry, replacing=None):
+        # Writers copy the mapping under the lock, so none loses another's
+        # snapshot; readers just take whichever mapping is current
+        with self._lock:
+            current = self._current
+            if replacing is None or current.get(listing, (None,))[0] is replacing:
+                self._current = {**current, listing: entry}
+
+    def _build_lock(self, listing):
+        with self._lock:
+            return self._build_locks.setdefault((current_tenant(), listing), threading.Lock())
+
+    def refresh(self, listing, reason, wait=True):
+        """
+        Builds a listing's snapshot and swaps it in
+
+        Must be called inside an application context. When another thread
+        is building the same snapshot, waits for it and uses that instead.
+
+        Args:
+            listing: 'venues', 'artists' or 'shows'
+            reason: for the snapshot_builds_total metric
+            wait: False to return None rather than wait for another thread
+
+        Returns:
+            (Snapshot, monotonic time it was current)
+        """
+        previous = self._current.get(listing)
+        lock = self._build_lock(listing)
+        if not lock.acquire(blocking=wait):
+            return None
+        try:
+            entry = self._current.get(listing)
+            if entry is not previous:
+                return entry
+            started = time.monotonic()
+            cursor = events.latest_id()
+            if listing == 'shows':
+                snapshot = build_shows(cursor)
+            else:
+                snapshot = build_listing(Venue if listing == 'venues' else Artist, cursor, self.per_page)
+            entry = (snapshot, started)
+            self._swap(listing, entry)
+        finally:
+            lock.release()
+        self.builds.inc(listing, reason)
+        self.build_seconds.inc(listing, amount=time.monotonic() - started)
+        return entry
+
+    def check(self):
+        """
+        Rebuilds the current tenant's snapshots that are out of date
+
+        Must be called inside an application context.
+
+        Args:
+            None
+
+        Returns:
+            listings rebuilt
+        """
+        current = self._current
+        if not current:
+            return []
+        started = time.monotonic()
+        latest = events.latest_id()
+        now = datetime.now()
+        stale = {listing: 'expired' for listing, (snapshot, _) in current.items()
+                 if snapshot.valid_until is not None and snapshot.valid_until <= now}
+        cursor = min(snapshot.cursor for snapshot, _ in current.values())
+        if latest != cursor:
+            entries = events.fetch_since(cursor, self.max_changes + 1, until=latest)
+            for listing, (snapshot, _) in current.items():
+                if len(entries) > self.max_changes \
+                        or any(entry['id'] > snapshot.cursor and listing in AFFECTS.get(entry['entity'], ())
+                               for entry in entries):
+                    stale.setdefault(listing, 'changed')
+        # Those left are current as of `started`, unless rebuilt meanwhile
+        for listing, (snapshot, _) in current.items():
+            if listing not in stale:
+                self._swap(listing, (snapshot, started), replacing=snapshot)
+        for listing, reason in stale.items():
+            self.refresh(listing, reason)
+        return sorted(stale)
+
+    def run_once(self):
+        with self._lock:
+            tenants = list(self._tenants)
+        for tenant in tenants:
+            with use_tenant(tenant), self.app.app_context():
+                try:
+                    self.check()
+                except Exception:
+                    db.session.rollback()
+                    self.app.logger.exception('Refreshing listing snapshots failed')
+
+    def changed(self):
+        """
+        Wakes the refresher, after this process committed a write
+        """
+        self._wake.set()
+
+    def start(self):
+        # Threads don't survive forking, so it is started by a request
+        tenant = current_tenant()
+        if tenant in self._tenants and self._thread is not None and self._thread.is_alive():
+            return
+        with self._lock:
+            self._tenants.add(tenant)
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name='snapshots', daemon=True)
+                self._thread.start()
+
+    def _run(self):
+        while not self._stop.is_set():
+            self._wake.wait(self.check_interval)
+            self._wake.clear()
+            self.run_once()
+
+    def stop(self):
+        self._stop.set()
+        self._wake.set()
+
+
+snapshots = Snapshots()
+
+# Writes committed by this process wake the refresher straight away; the
+# other processes find them in the change log within a check interval
+
+@event.listens_for(db.session, 'after_flush')
+def _note_changes(session, flush_context):
+    if snapshots.enabled and any(isinstance(entity, ChangeLog) for entity in session.new):
+        session.info['snapshots_changed'] = True
+
+
+@event.listens_for(db.session, 'after_commit')
+def _wake_refresher(session):
+    if session.info.pop('snapshots_changed', False):
+        snapshots.changed()
+
+
+@event.listens_for(db.session, 'after_soft_rollback')
+def _discard_changes(session, previous_transaction):
+    session.info.pop('snapshots_changed', None)
@@ -2,3 +2,35 @@ window.parseISOString = function parseISOString(s) {
   var b = s.split(/\D+/);
   return new Date(Date.UTC(b[0], --b[1], b[2], b[3], b[4], b[5], b[6]));
 };
+
+// typeahead for inputs with data-suggest="venue|artist|city", filling the
+// <datalist> named by their list attribute from /suggest; inputs with
+// data-suggest-target also put the id of the suggestion picked into the
+// field of that id
+$(function() {
+  // /t/<tenant> when tenants are routed by path
+  var root = $('body').data('script-root') || '';
+  $('input[data-suggest]').each(function() {
+    var input = $(this), list = $('#' + input.attr('list')), timer = null, last = '';
+    var target = input.data('suggest-target') ? $('#' + input.data('suggest-target')) : $();
+    input.on('input change', function() {
+      var picked = list.find('option').filter(function() { return this.value === input.val(); });
+      target.val(picked.length === 1 ? picked.data('id') : '');
+    });
+    input.on('input', function() {
+      clearTimeout(timer);
+      timer = setTimeout(function() {
+        var q = $.trim(input.val());
+        if (!q || q === last) { return; }
+        last = q;
+        $.getJSON(root + '/suggest', {q: q, type: input.data('suggest'), limit: 8}, function(response) {
+          if (response.q !== $.trim(input.val())) { return; }
+          list.empty();
+          $.each(response.data, function(i, suggestion) {
+            list.append($('<option>').attr('value', suggestion.name).attr('data-id', suggestion.id));
+          });
+        });
+      }, 80);
+    });
+  });
+});
@@ -0,0 +1,384 @@
+#----------------------------------------------------------------------------#
+# Imports
+#----------------------------------------------------------------------------#
+
+import bisect
+import re
+import threading
+import time
+import unicodedata
+
+from sqlalchemy import select
+
+import events
+from models import db, Venue, Artist
+from tenants import tenant_local
+
+#----------------------------------------------------------------------------#
+# Prefix index.
+#----------------------------------------------------------------------------#
+
+# Separates the parts of an index key; sorts before every printable character
+# so 'rock' and all its entries sort before 'rock band'
+SEP = '\x00'
+KINDS = ('venue', 'artist', 'city')
+WORD = re.compile(r'[^\W_]+')
+
+
+def normalize(text):
+    """
+    Folds text for matching: no accents, lower case, words split on punctuation
+
+    Args:
+        text: any string
+
+    Returns:
+        normalized string, words separated by single spaces
+    """
+    text = text or ''
+    if not text.isascii():
+        text = ''.join(c for c in unicodedata.normalize('NFKD', text) if not unicodedata.combining(c))
+    return ' '.join(WORD.findall(text.lower()))
+
+
+def terms(text):
+    """
+    Keys a name is found under: the whole name and every word onwards
+
+    'The Dueling Pianos Bar' is found by 'the du', 'pianos' and 'bar'.
+
+    Args:
+        text: name to index
+
+    Returns:
+        list of normalized terms
+    """
+    words = normalize(text).split()
+    return [' '.join(words[i:]) for i in range(len(words))]
+
+
+class PrefixIndex:
+    """
+    Sorted array of name keys answering prefix queries with bisect
+
+    Every key is `term SEP kind SEP id`, so all entries for a prefix sit in
+    one contiguous run of the array. Labels for display are kept beside it,
+    so lookups never touch the database.
+
+    Args:
+        None
+
+    Returns:
+        None
+    """
+
+    def __init__(self):
+        self._keys = []
+        self._labels = {}
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._labels)
+
+    @staticmethod
+    def _keys_for(kind, entity_id, text):
+        suffix = f'{SEP}{kind}{SEP}{entity_id}'
+        return [term + suffix for term in terms(text)]
+
+    def load(self, entries):
+        """
+        Replaces the whole index, sorting once rather than inserting one by one
+
+        Args:
+            entries: iterable of (kind, id, text, label)
+
+        Returns:
+            None
+        """
+        keys, labels = [], {}
+        for kind, entity_id, text, label in entries:
+            keys.extend(self._keys_for(kind, entity_id, text))
+            labels[(kind, entity_id)] = (text, label)
+        keys.sort()
+        with self._lock:
+            self._keys, self._labels = keys, labels
+
+    def add(self, kind, entity_id, text, label=None):
+        with self._lock:
+            self._remove(kind, entity_id)
+            for key in self._keys_for(kind, entity_id, text):
+                bisect.insort(self._keys, key)
+            self._labels[(kind, entity_id)] = (text, label)
+
+    def remove(self, kind, entity_id):
+        with self._lock:
+            self._remove(kind, entity_id)
+
+    def _remove(self, kind, entity_id):
+        entry = self._labels.pop((kind, entity_id), None)
+        if entry is None:
+            return
+        for key in self._keys_for(kind, entity_id, entry[0]):
+            i = bisect.bisect_left(self._keys, key)
+            if i < len(self._keys) and self._keys[i] == key:
+                del self._keys[i]
+
+    def search(self, prefix, limit=10, kinds=KINDS):
+        """
+        Entries with a term starting with `prefix`, in term order
+
+        Args:
+            prefix: text typed so far
+            limit: maximum number of results
+            kinds: kinds of entries to return
+
+        Returns:
+            list of (kind, id, text, label)
+        """
+        prefix = normalize(prefix)
+        if not prefix:
+            return []
+        results, seen = [], set()
+        with self._lock:
+            keys = self._keys
+            i = bisect.bisect_left(keys, prefix)
+            while i < len(keys) and len(results) < limit:
+                key = keys[i]
+                if not key.startswith(prefix):
+                    break
+                i += 1
+                _, kind, entity_id = key.split(SEP)
+                if kind not in kinds:
+                    continue
+                ref = (kind, int(entity_id) if kind != 'city' else entity_id)
+                if ref in seen:
+                    continue
+                seen.add(ref)
+                text, label = self._labels[ref]
+                results.append((ref[0], ref[1], text, label))
+        return results
+
+#----------------------------------------------------------------------------#
+# Suggestions.
+#----------------------------------------------------------------------------#
+
+class Suggestions:
+    """
+    Typeahead over live venue and artist names and their cities
+
+    The index is built in a background thread at startup (or on first use)
+    and kept current by the create, edit and delete handlers. Writes made
+    by other processes (other gunicorn workers, whose index was forked from
+    the master's) are read from the change log by a background thread:
+    every SUGGEST_SYNC_INTERVAL seconds it checks for entries past the
+    index's cursor and re-reads the venues and artists they name, so
+    lookups only ever read the index. Cities
+    are reference-counted, so one disappears only with its last venue or
+    artist. Each tenant has its own index, built on its first suggestion.
+
+    Args:
+        None
+
+    Returns:
+        None
+    """
+    index = tenant_local()
+    _cities = tenant_local(dict)
+    _city_of = tenant_local(dict)
+    build_seconds = tenant_local()
+    # Change log id the index includes
+    _cursor = tenant_local()
+
+    def __init__(self):
+        self.app = None
+        self.sync_interval = 1.0
+        self.max_changes = 1000
+        self._follower = None
+        self._lock = threading.Lock()
+
+    def init_app(self, app):
+        self.app = app
+        self.sync_interval = app.config.get('SUGGEST_SYNC_INTERVAL', self.sync_interval)
+        self.max_changes = app.config.get('SUGGEST_MAX_CHANGES', self.max_changes)
+        self._follower = events.Follower(app, 'suggest-sync', self.sync, self.sync_interval)
+        app.extensions['suggestions'] = self
+        if app.config.get('SUGGEST_PRELOAD', True) and not app.config.get('TENANCY_ENABLED'):
+            threading.Thread(target=self._preload, name='suggest', daemon=True).start()
+
+    def _preload(self):
+        with self.app.app_context():
+            try:
+                self._get_index()
+            except Exception:
+                db.session.rollback()
+                self.app.logger.exception('Building the suggestion index failed')
+            finally:
+                db.session.remove()
+
+    def warm(self):
+        """
+        Builds the index now unless it is built already
+
+        Must be called inside an application context.
+        """
+        return self._get_index()
+
+    def _get_index(self):
+        if self.index is None:
+            with self._lock:
+                if self.index is None:
+                    self.rebuild()
+        return self.index
+
+    def sync(self):
+        """
+        Applies the venue and artist writes logged since the index's cursor
+
+        Must be called inside an application context.
+
+        Args:
+            None
+
+        Returns:
+            number of venues and artists re-read, None when rebuilt
+        """
+        if self.index is None:
+            return 0
+        cursor = self._cursor
+        latest = events.latest_id()
+        if latest == cursor:
+            return 0
+        entries = events.fetch_since(cursor, self.max_changes + 1, ('venue', 'artist'), latest)
+        if len(entries) > self.max_changes:
+            with self._lock:
+                self.rebuild()
+            return None
+        changed = {}
+        for entry in entries:
+            changed.setdefault(entry['entity'], set()).add(entry['entity_id'])
+        reread = sum(len(ids) for ids in changed.values())
+        for kind, model in (('venue', Venue), ('artist', Artist)):
+            ids = changed.get(kind)
+            if not ids:
+                continue
+            rows = db.session.execute(
+                select(model.id, model.name, model.city, model.state)
+                .where(model.id.in_(ids), model.deleted_at.is_(None)))
+            for entity_id, name, city, state in rows:
+                self.update(kind, entity_id, name, city, state)
+                ids.discard(entity_id)
+            for entity_id in ids:
+                self.remove(kind, entity_id)
+        self._cursor = latest
+        return reread
+
+    def rebuild(self):
+        """
+        Rebuilds the index from the database
+
+        Must be called inside an application context.
+
+        Args:
+            None
+
+        Returns:
+            number of indexed entries
+        """
+        t0 = time.perf_counter()
+        # Read first: writes committed while the rows are read are applied
+        # again by the next sync, which is harmless
+        cursor = events.latest_id()
+        cities, city_of, entries = {}, {}, []
+        for kind, model in (('venue', Venue), ('artist', Artist)):
+            rows = db.session.execute(
+                select(model.id, model.name, model.city, model.state)
+                .where(model.deleted_at.is_(None))
+                .execution_options(yield_per=10000))
+            for entity_id, name, city, state in rows:
+                entries.append((kind, entity_id, name, (city, state)))
+                if city:
+                    place = f'{city}, {state}'
+                    cities[place] = cities.get(place, 0) + 1
+                    city_of[(kind, entity_id)] = place
+        entries.extend(('city', place, place, None) for place in cities)
+        index = PrefixIndex()
+        index.load(entries)
+        self._cities, self._city_of = cities, city_of
+        self._cursor = cursor
+        self.index = index
+        self.build_seconds = time.perf_counter() - t0
+        return len(index)
+
+    def invalidate(self):
+        """
+        Drops the index after bulk changes, it is rebuilt on next use
+        """
+        with self._lock:
+            self.index = None
+
+    def update(self, kind, entity_id, name, city, state):
+        """
+        Adds or re-indexes a venue or artist after it was created or edited
+
+        Args:
+            kind: 'venue' or 'artist'
+            entity_id
+            name, city, state: current values
+
+        Returns:
+            None
+        """
+        if self.index is None:
+            return
+        with self._lock:
+            self._drop_city(kind, entity_id)
+            self.index.add(kind, entity_id, name, (city, state))
+            if city:
+                place = f'{city}, {state}'
+                self._city_of[(kind, entity_id)] = place
+                self._cities[place] = self._cities.get(place, 0) + 1
+                if self._cities[place] == 1:
+                    self.index.add('city', place, place)
+
+    def remove(self, kind, entity_id):
+        if self.index is None:
+            return
+        with self._lock:
+            self._drop_city(kind, entity_id)
+            self.index.remove(kind, entity_id)
+
+    def _drop_city(self, kind, entity_id):
+        place = self._city_of.pop((kind, entity_id), None)
+        if place is None:
+            return
+        self._cities[place] -= 1
+        if not self._cities[place]:
+            del self._cities[place]
+            self.index.remove('city', place)
+
+    def suggest(self, prefix, limit=10, kinds=KINDS):
+        """
+        Suggestions for what has been typed so far
+
+        Args:
+            prefix: text typed so far
+            limit: maximum number of suggestions
+            kinds: any of 'venue', 'artist', 'city'
+
+        Returns:
+            list of dicts with type, id, name and, for venues and artists,
+            city and state
+        """
+        index = self._get_index()
+        # Here rather than in _preload: threads don't survive forking
+        self._follower.start()
+        results = []
+        for kind, entity_id, text, label in index.search(prefix, limit, kinds):
+            suggestion = {'type': kind, 'id': entity_id, 'name': text}
+            if label:
+                suggestion['city'], suggestion['state'] = label
+            results.append(suggestion)
+        return results
+
+
+suggestions = Suggestions()
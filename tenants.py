@@ -0,0 +1,403 @@
+#----------------------------------------------------------------------------#
+# Imports
+#----------------------------------------------------------------------------#
+
+import contextvars
+import os
+import re
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+
+import sqlalchemy as sa
+from sqlalchemy.pool import NullPool
+from flask import g, has_request_context, request
+from flask_sqlalchemy.session import Session
+from werkzeug.exceptions import NotFound
+
+from metrics import registry
+
+# One app serves every promoter ("tenant"). Requests are routed to a tenant
+# by hostname (acme.<TENANT_DOMAIN>, or TENANT_HOSTS) or by path prefix
+# (/t/acme/...). On PostgreSQL each tenant has a schema and every
+# transaction starts with SET LOCAL search_path, so all tenants share one
+# bounded connection pool; on SQLite each tenant has a database file, and
+# all of them share one engine (and its compiled statement cache) whose
+# connections open the current tenant's file.
+
+NAME = re.compile(r'^[a-z0-9][a-z0-9_-]{0,39}$')
+ENVIRON_KEY = 'fyyur.tenant'
+
+_current = contextvars.ContextVar('tenant', default=None)
+
+#----------------------------------------------------------------------------#
+# Current tenant.
+#----------------------------------------------------------------------------#
+
+def current_tenant():
+    """
+    Name of the tenant being served
+
+    Set by use_tenant() in background work, from the request otherwise.
+
+    Args:
+        None
+
+    Returns:
+        tenant name, or None without multi-tenancy or outside any tenant
+    """
+    tenant = _current.get()
+    if tenant is None and has_request_context():
+        tenant = request.environ.get(ENVIRON_KEY)
+    return tenant
+
+
+@contextmanager
+def use_tenant(name):
+    """
+    Runs a block as `name`, for work outside requests
+
+    Push the app context inside the block, so its db.session is bound to
+    the tenant's database.
+
+    Args:
+        name: tenant name, None for the default database
+
+    Returns:
+        context manager
+    """
+    token = _current.set(name)
+    try:
+        yield name
+    finally:
+        _current.reset(token)
+
+
+class tenant_local:
+    """
+    Instance attribute with a separate value for each tenant
+
+    For the in-process indexes and tables that would otherwise mix one
+    tenant's rows into another's answers.
+
+    Args:
+        factory: makes a tenant's initial value, e.g. dict; None when omitted
+
+    Returns:
+        None
+    """
+
+    def __init__(self, factory=None):
+        self.factory = factory
+
+    def __set_name__(self, owner, name):
+        self.name = f'_tenant_{name}'
+
+    def _values(self, obj):
+        values = obj.__dict__.get(self.name)
+        if values is None:
+            values = obj.__dict__.setdefault(self.name, {})
+        return values
+
+    def __get__(self, obj, objtype=None):
+        if obj is None:
+            return self
+        values = self._values(obj)
+        tenant = current_tenant()
+        try:
+            return values[tenant]
+        except KeyError:
+            return values.setdefault(tenant, self.factory() if self.factory else None)
+
+    def __set__(self, obj, value):
+        self._values(obj)[current_tenant()] = value
+
+
+class TenantSession(Session):
+    """
+    db.session, bound to the tenants' engine on SQLite while serving a tenant
+
+    Args:
+        as for flask_sqlalchemy's Session
+
+    Returns:
+        None
+    """
+
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        if bind is None and tenancy.per_file and current_tenant() is not None:
+            return tenancy.engine
+        return super().get_bind(mapper=mapper, clause=clause, bind=bind, **kwargs)
+
+#----------------------------------------------------------------------------#
+# Routing.
+#----------------------------------------------------------------------------#
+
+class TenantMiddleware:
+    """
+    WSGI middleware resolving the tenant of every request
+
+    With path routing the /t/<tenant> prefix moves to SCRIPT_NAME, so the
+    routes see their usual paths and url_for() adds the prefix back.
+    Requests for no known tenant get a 404, except for TENANT_EXEMPT_PATHS,
+    which are served from the default database.
+
+    Args:
+        wsgi_app: the app's WSGI callable
+        tenancy: Tenancy
+
+    Returns:
+        None
+    """
+
+    def __init__(self, wsgi_app, tenancy):
+        self.wsgi_app = wsgi_app
+        self.tenancy = tenancy
+
+    def __call__(self, environ, start_response):
+        tenant, prefix = self.tenancy.resolve(environ)
+        if tenant is None:
+            if not environ.get('PATH_INFO', '/').startswith(self.tenancy.exempt_paths):
+                return NotFound()(environ, start_response)
+        elif prefix:
+            environ['SCRIPT_NAME'] = environ.get('SCRIPT_NAME', '') + prefix
+            environ['PATH_INFO'] = environ['PATH_INFO'][len(prefix):] or '/'
+        environ[ENVIRON_KEY] = tenant
+        return self.wsgi_app(environ, start_response)
+
+#----------------------------------------------------------------------------#
+# Tenancy.
+#----------------------------------------------------------------------------#
+
+class Tenancy:
+    """
+    Tenant routing, databases and provisioning
+
+    Does nothing unless TENANCY_ENABLED is set.
+
+    Args:
+        None
+
+    Returns:
+        None
+    """
+
+    def __init__(self):
+        self.app = None
+        self.db = None
+        self.enabled = False
+        self.per_file = False
+        self.routing = 'host'
+        self.domain = ''
+        self.hosts = {}
+        self.path_prefix = '/t/'
+        self.exempt_paths = ('/healthz', '/readyz', '/metrics', '/static/')
+        self.schema_prefix = 'tenant_'
+        self.sqlite_dir = None
+        self.discovery_interval = 30
+        self.engine = None
+        self._known = frozenset()
+        self._discovered_at = None
+        self._lock = threading.Lock()
+        self.requests = registry.counter('tenant_requests_total', 'Requests served per tenant',
+                                         ['tenant', 'status'])
+        self.seconds = registry.counter('tenant_request_seconds_total',
+                                        'Seconds spent serving each tenant', ['tenant'])
+        registry.callback_gauge('tenants_known', 'Tenants found in the database',
+                                lambda: len(self._known))
+
+    def init_app(self, app):
+        self.app = app
+        self.db = app.extensions['sqlalchemy']
+        self.enabled = app.config.get('TENANCY_ENABLED', False)
+        self.routing = app.config.get('TENANT_ROUTING', self.routing)
+        self.domain = app.config.get('TENANT_DOMAIN', self.domain).lower().strip('.')
+        self.hosts = {host.lower(): name for host, name in app.config.get('TENANT_HOSTS', {}).items()}
+        self.path_prefix = app.config.get('TENANT_PATH_PREFIX', self.path_prefix).rstrip('/') + '/'
+        self.exempt_paths = tuple(app.config.get('TENANT_EXEMPT_PATHS', self.exempt_paths))
+        self.schema_prefix = app.config.get('TENANT_SCHEMA_PREFIX', self.schema_prefix)
+        self.sqlite_dir = app.config.get('TENANT_SQLITE_DIR', self.sqlite_dir)
+        self.discovery_interval = app.config.get('TENANT_DISCOVERY_INTERVAL', self.discovery_interval)
+        app.extensions['tenancy'] = self
+        if not self.enabled:
+            return
+        url = sa.engine.make_url(app.config['SQLALCHEMY_DATABASE_URI'])
+        self.per_file = url.get_backend_name() == 'sqlite'
+        if self.per_file:
+            # SQLite connections are cheap to open, so none is kept and
+            # every transaction opens the file of whichever tenant it is for
+            self.engine = sa.create_engine('sqlite://', creator=self._connect, poolclass=NullPool)
+        else:
+            with app.app_context():
+                sa.event.listen(self.db.engine, 'begin', self._set_search_path)
+        app.wsgi_app = TenantMiddleware(app.wsgi_app, self)
+        app.before_request(self.before_request)
+        app.after_request(self.after_request)
+
+    # Routing
+
+    def resolve(self, environ):
+        """
+        Tenant a WSGI request is for
+
+        Args:
+            environ: WSGI environ
+
+        Returns:
+            (tenant name or None, path prefix to move to SCRIPT_NAME)
+        """
+        if self.routing == 'path':
+            path = environ.get('PATH_INFO', '')
+            if path.startswith(self.path_prefix):
+                name = path[len(self.path_prefix):].split('/', 1)[0]
+                if self.exists(name):
+                    return name, self.path_prefix + name
+            return None, ''
+        host = environ.get('HTTP_HOST', '').rsplit(':', 1)[0].lower()
+        name = self.hosts.get(host)
+        if name is None and self.domain and host.endswith('.' + self.domain):
+            name = host[:-len(self.domain) - 1]
+        return (name, '') if name and self.exists(name) else (None, '')
+
+    def exists(self, name):
+        """
+        Whether a tenant has been provisioned
+
+        Unknown names trigger a fresh discovery at most every
+        TENANT_DISCOVERY_INTERVAL seconds, so tenants provisioned by other
+        processes show up without letting random hostnames hit the
+        database on every request.
+
+        Args:
+            name: tenant name
+
+        Returns:
+            bool
+        """
+        if name in self._known:
+            return True
+        if not NAME.match(name):
+            return False
+        self.refresh()
+        return name in self._known
+
+    def refresh(self, force=False):
+        with self._lock:
+            now = time.monotonic()
+            if force or self._discovered_at is None \
+                    or now - self._discovered_at >= self.discovery_interval:
+                self._known = frozenset(self.discover())
+                self._discovered_at = now
+
+    def names(self):
+        """
+        Every database background maintenance should visit
+
+        Args:
+            None
+
+        Returns:
+            list of tenant names, None (the default database) first
+        """
+        if not self.enabled:
+            return [None]
+        if self._discovered_at is None:
+            self.refresh()
+        return [None] + sorted(self._known)
+
+    def before_request(self):
+        g.tenant_started = time.perf_counter()
+
+    def after_request(self, response):
+        tenant = current_tenant()
+        if tenant is not None:
+            self.requests.inc(tenant, response.status_code)
+            # Unset when an earlier before_request handler refused the request
+            started = g.pop('tenant_started', None)
+            if started is not None:
+                self.seconds.inc(tenant, amount=time.perf_counter() - started)
+        return response
+
+    # Databases
+
+    def schema(self, name):
+        return f'{self.schema_prefix}{name}'
+
+    def path(self, name):
+        return os.path.join(self.sqlite_dir, f'{name}.db')
+
+    def _set_search_path(self, connection):
+        tenant = current_tenant()
+        if tenant is not None and not connection.get_execution_options().get('tenant_shared'):
+            # Until the transaction ends, so a pooled connection is back on
+            # the default schema for whoever checks it out next
+            connection.exec_driver_sql(f'SET LOCAL search_path TO "{self.schema(tenant)}", public')
+
+    def _connect(self):
+        tenant = current_tenant()
+        if tenant is None:
+            raise RuntimeError('no tenant to connect to')
+        return sqlite3.connect(self.path(tenant), check_same_thread=False)
+
+    def discover(self):
+        """
+        Tenants provisioned in the database
+
+        Args:
+            None
+
+        Returns:
+            list of tenant names
+        """
+        if self.per_file:
+            if not os.path.isdir(self.sqlite_dir):
+                return []
+            return [entry[:-3] for entry in os.listdir(self.sqlite_dir)
+                    if entry.endswith('.db') and NAME.match(entry[:-3])]
+        with self.db.engine.connect() as connection:
+            schemas = connection.execute(
+                sa.text('SELECT schema_name FROM information_schema.schemata '
+                        'WHERE starts_with(schema_name, :prefix)'),
+                {'prefix': self.schema_prefix}).scalars()
+            return [schema[len(self.schema_prefix):] for schema in schemas
+                    if NAME.match(schema[len(self.schema_prefix):])]
+
+    def create(self, name):
+        """
+        Provisions a tenant: its schema or database file, with every table
+
+        Creating a tenant that exists adds the tables it is missing.
+
+        Args:
+            name: lowercase letters, digits, '-' and '_'
+
+        Returns:
+            None
+
+        Raises:
+            ValueError: for an invalid name
+        """
+        if not NAME.match(name):
+            raise ValueError(f'invalid tenant name: {name!r}')
+        if self.per_file:
+            os.makedirs(self.sqlite_dir, exist_ok=True)
+            engine = sa.create_engine(f'sqlite:///{self.path(name)}')
+            try:
+                self.db.metadata.create_all(engine)
+            finally:
+                engine.dispose()
+        else:
+            schema = self.schema(name)
+            with self.db.engine.begin() as connection:
+                connection.exec_driver_sql(f'CREATE SCHEMA IF NOT EXISTS "{schema}"')
+                # Tables go into the schema; the DDL the models run after
+                # creating them (partitions, indexes) finds them by search_path
+                connection.exec_driver_sql(f'SET LOCAL search_path TO "{schema}", public')
+                self.db.metadata.create_all(
+                    connection.execution_options(schema_translate_map={None: schema}))
+        with self._lock:
+            self._known = self._known | {name}
+
+
+tenancy = Tenancy()
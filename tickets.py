@@ -0,0 +1,400 @@
+#----------------------------------------------------------------------------#
+# Imports
+#----------------------------------------------------------------------------#
+
+import random
+import secrets
+import threading
+from collections import Counter
+from datetime import datetime, timedelta
+
+from sqlalchemy import delete, func, insert, select, update
+
+from metrics import registry
+from models import db, Artist, Show, TicketShard, TicketHold, Venue
+from tenants import current_tenant, use_tenant
+
+# A popular show gets thousands of buyers in its first seconds. Every hold
+# is one conditional UPDATE ... SET remaining = remaining - n WHERE
+# remaining >= n on a random shard of the show's tickets, so buyers lock
+# different rows and can never take more than is left; only when that
+# shard runs short are the others gathered, in shard order so two buyers
+# never wait on each other's locks.
+
+holds_counter = registry.counter('ticket_holds_total', 'Ticket hold attempts', ['result'])
+purchases_counter = registry.counter('ticket_purchases_total', 'Hold purchase attempts', ['result'])
+returned_counter = registry.counter('tickets_returned_total', 'Held tickets given back to sale', ['reason'])
+
+#----------------------------------------------------------------------------#
+# Inventory.
+#----------------------------------------------------------------------------#
+
+# Shard count per (tenant, show), fixed once its sales open
+_shard_counts = {}
+
+
+def shard_count(show_id):
+    """
+    Number of shards holding the show's tickets, 0 when it isn't on sale
+
+    Args:
+        show_id
+
+    Returns:
+        int
+    """
+    key = (current_tenant(), show_id)
+    count = _shard_counts.get(key)
+    if count is None:
+        count = db.session.execute(
+            select(func.count()).select_from(TicketShard).where(TicketShard.show_id == show_id)).scalar()
+        if count:
+            _shard_counts[key] = count
+    return count
+
+
+def open_sales(show_id, capacity, shards=16):
+    """
+    Puts a show's tickets on sale, split evenly over `shards` rows
+
+    Runs in the caller's transaction.
+
+    Args:
+        show_id
+        capacity: tickets for sale
+        shards: counter rows; more shards mean less lock contention, but
+            a show never gets more shards than tickets
+
+    Returns:
+        number of shards, or 0 when the show is already on sale
+    """
+    if shard_count(show_id):
+        return 0
+    shards = max(min(shards, capacity), 1)
+    size, extra = divmod(capacity, shards)
+    db.session.execute(insert(TicketShard), [
+        {'show_id': show_id, 'shard': shard, 'capacity': size + (shard < extra),
+         'remaining': size + (shard < extra)}
+        for shard in range(shards)])
+    return shards
+
+
+def close_sales(show_ids):
+    """
+    Takes shows that are being deleted off sale, with their holds
+
+    Runs in the caller's transaction.
+
+    Args:
+        show_ids: list of show ids
+
+    Returns:
+        None
+    """
+    if not show_ids:
+        return
+    for model in (TicketHold, TicketShard):
+        db.session.execute(delete(model).where(model.show_id.in_(show_ids))
+                           .execution_options(synchronize_session=False))
+    tenant = current_tenant()
+    for show_id in show_ids:
+        _shard_counts.pop((tenant, show_id), None)
+
+
+def bookable(show_id):
+    """
+    Whether a show can still be booked: it hasn't started, and its venue
+    and artist aren't deleted
+
+    Shard counts are cached per process, so another worker may still
+    count a show that is gone.
+
+    Args:
+        show_id
+
+    Returns:
+        bool
+    """
+    return db.session.execute(
+        select(Show.id)
+        .join(Venue, Venue.id == Show.venue_id)
+        .join(Artist, Artist.id == Show.artist_id)
+        .where(Show.id == show_id, Show.start_time > datetime.now(),
+               Venue.deleted_at.is_(None), Artist.deleted_at.is_(None))).first() is not None
+
+
+def _take(show_id, shard, quantity):
+    return db.session.execute(
+        update(TicketShard)
+        .where(TicketShard.show_id == show_id, TicketShard.shard == shard,
+               TicketShard.remaining >= quantity)
+        .values(remaining=TicketShard.remaining - quantity)
+        .execution_options(synchronize_session=False)).rowcount == 1
+
+
+def _gather(show_id, quantity):
+    """
+    Takes `quantity` tickets from whichever shards have some left
+
+    Returns:
+        dict of shard -> tickets taken, or None when there aren't enough
+    """
+    available = db.session.execute(
+        select(TicketShard.shard, TicketShard.remaining)
+        .where(TicketShard.show_id == show_id, TicketShard.remaining > 0)
+        .order_by(TicketShard.shard)).all()
+    if sum(remaining for _, remaining in available) < quantity:
+        return None
+    taken = {}
+    for shard, remaining in available:
+        take = min(remaining, quantity)
+        # Other buyers may have emptied the shard since it was read
+        while take and not _take(show_id, shard, take):
+            take = min(take, db.session.execute(
+                select(TicketShard.remaining)
+                .where(TicketShard.show_id == show_id, TicketShard.shard == shard)).scalar())
+        if take:
+            taken[shard] = take
+            quantity -= take
+        if not quantity:
+            return taken
+    return None
+
+
+def hold(show_id, quantity, ttl):
+    """
+    Holds tickets for a buyer until they purchase them or `ttl` runs out
+
+    Must be called inside an application context; commits the session.
+
+    Args:
+        show_id: a show on sale
+        quantity: tickets to hold
+        ttl: seconds until the hold expires
+
+    Returns:
+        (hold id, expiry datetime), or None when there aren't enough
+        tickets left
+    """
+    shards = shard_count(show_id)
+    if not shards:
+        return None
+    shard = random.randrange(shards)
+    taken = {shard: quantity} if _take(show_id, shard, quantity) else _gather(show_id, quantity)
+    if taken is None:
+        # Expired holds not swept yet (say the workers just restarted)
+        # would otherwise keep the show sold out
+        db.session.rollback()
+        if sweep(show_id=show_id):
+            taken = _gather(show_id, quantity)
+    if taken is None:
+        db.session.rollback()
+        holds_counter.inc('sold_out')
+        return None
+    hold_id = secrets.token_urlsafe(32)
+    expires_at = datetime.now() + timedelta(seconds=ttl)
+    db.session.execute(insert(TicketHold), [
+        {'id': hold_id, 'shard': shard, 'show_id': show_id, 'quantity': count,
+         'status': 'held', 'expires_at': expires_at}
+        for shard, count in taken.items()])
+    db.session.commit()
+    holds_counter.inc('held')
+    return hold_id, expires_at
+
+
+def purchase(hold_id):
+    """
+    Confirms the purchase of held tickets
+
+    Purchasing a hold twice succeeds twice; an expired or released hold
+    can't be purchased, whether or not the sweeper has returned it yet.
+
+    Must be called inside an application context; commits the session.
+
+    Args:
+        hold_id
+
+    Returns:
+        'purchased', or None when the hold expired, was released or
+        doesn't exist
+    """
+    purchased = db.session.execute(
+        update(TicketHold)
+        .where(TicketHold.id == hold_id, TicketHold.status == 'held',
+               TicketHold.expires_at > datetime.now())
+        .values(status='purchased')
+        .execution_options(synchronize_session=False)).rowcount
+    db.session.commit()
+    if not purchased:
+        status = db.session.execute(
+            select(TicketHold.status).where(TicketHold.id == hold_id).limit(1)).scalar()
+        if status != 'purchased':
+            purchases_counter.inc('rejected')
+            return None
+    purchases_counter.inc('purchased')
+    return 'purchased'
+
+
+def _return(condition, status):
+    """
+    Moves matching held rows to `status` and gives their tickets back
+
+    The status change is the claim: of two transactions returning the same
+    hold, or a return racing a purchase, only one matches status = 'held'.
+
+    Returns:
+        number of tickets given back
+    """
+    returned = db.session.execute(
+        update(TicketHold)
+        .where(condition, TicketHold.status == 'held')
+        .values(status=status)
+        .returning(TicketHold.show_id, TicketHold.shard, TicketHold.quantity)
+        .execution_options(synchronize_session=False)).all()
+    shards = Counter()
+    for show_id, shard, quantity in returned:
+        shards[(show_id, shard)] += quantity
+    # Shard order, like _gather, so returns and holds don't deadlock
+    for (show_id, shard), quantity in sorted(shards.items()):
+        db.session.execute(
+            update(TicketShard)
+            .where(TicketShard.show_id == show_id, TicketShard.shard == shard)
+            .values(remaining=TicketShard.remaining + quantity)
+            .execution_options(synchronize_session=False))
+    return sum(shards.values())
+
+
+def release(hold_id):
+    """
+    Gives held tickets back before their hold expires
+
+    Must be called inside an application context; commits the session.
+
+    Args:
+        hold_id
+
+    Returns:
+        number of tickets given back, 0 when the hold isn't held anymore
+    """
+    returned = _return(TicketHold.id == hold_id, 'released')
+    db.session.commit()
+    returned_counter.inc('released', amount=returned)
+    return returned
+
+
+def sweep(batch_size=1000, show_id=None):
+    """
+    Gives the tickets of expired holds back, `batch_size` holds per
+    transaction
+
+    Must be called inside an application context; commits the session.
+
+    Args:
+        batch_size: holds per transaction
+        show_id: only sweep this show's holds, None for every show
+
+    Returns:
+        number of tickets given back
+    """
+    total = 0
+    while True:
+        expired = select(TicketHold.id) \
+            .where(TicketHold.status == 'held', TicketHold.expires_at <= datetime.now()) \
+            .limit(batch_size)
+        if show_id is not None:
+            expired = expired.where(TicketHold.show_id == show_id)
+        returned = _return(TicketHold.id.in_(expired.scalar_subquery()), 'expired')
+        db.session.commit()
+        if not returned:
+            return total
+        returned_counter.inc('expired', amount=returned)
+        total += returned
+
+
+def availability(show_id):
+    """
+    Ticket counts of a show
+
+    Args:
+        show_id
+
+    Returns:
+        dict of capacity, remaining, held and sold, or None when the show
+        isn't on sale
+    """
+    capacity, remaining = db.session.execute(
+        select(func.sum(TicketShard.capacity), func.sum(TicketShard.remaining))
+        .where(TicketShard.show_id == show_id)).one()
+    if capacity is None:
+        return None
+    counts = dict(db.session.execute(
+        select(TicketHold.status, func.sum(TicketHold.quantity))
+        .where(TicketHold.show_id == show_id, TicketHold.status.in_(('held', 'purchased')))
+        .group_by(TicketHold.status)).all())
+    return {'capacity': capacity, 'remaining': remaining,
+            'held': counts.get('held', 0), 'sold': counts.get('purchased', 0)}
+
+#----------------------------------------------------------------------------#
+# Sweeper.
+#----------------------------------------------------------------------------#
+
+class HoldSweeper:
+    """
+    Background worker giving the tickets of expired holds back to sale
+
+    Started by the first hold a worker is asked for, then sweeps every
+    TICKET_SWEEP_INTERVAL seconds, in every tenant the worker took holds
+    for. Several workers sweeping at once is safe: each expired hold is
+    claimed by exactly one of them.
+
+    Args:
+        None
+
+    Returns:
+        None
+    """
+
+    def __init__(self):
+        self.app = None
+        self.interval = 5
+        self.batch_size = 1000
+        self._thread = None
+        self._tenants = set()
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+
+    def init_app(self, app):
+        self.app = app
+        self.interval = app.config.get('TICKET_SWEEP_INTERVAL', self.interval)
+        self.batch_size = app.config.get('TICKET_SWEEP_BATCH_SIZE', self.batch_size)
+        app.extensions['tickets'] = self
+
+    def start(self):
+        with self._lock:
+            self._tenants.add(current_tenant())
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name='ticket-sweeper', daemon=True)
+                self._thread.start()
+
+    def run_once(self):
+        with self._lock:
+            tenants = list(self._tenants)
+        returned = 0
+        for tenant in tenants:
+            with use_tenant(tenant), self.app.app_context():
+                try:
+                    returned += sweep(self.batch_size)
+                except Exception:
+                    db.session.rollback()
+                    self.app.logger.exception('Sweeping expired ticket holds failed')
+        return returned
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self.run_once()
+
+    def stop(self):
+        self._stop.set()
+
+
+sweeper = HoldSweeper()